@@ -1,28 +1,62 @@
-from flask import Flask, request, jsonify
+import time
+IMPORT_STARTED = time.perf_counter()  # startup timings are reported by /health
+
+from flask import Flask, request, jsonify, Response, g, send_file, url_for
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import tuple_, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timezone
 import json
 import os
 from typing import Dict, List, Optional
 import threading
-import time
 import pytz
+import sqlite3
+import contextvars
+import functools
+import asyncio
+import inspect
+import weakref
+import random
+import importlib
+from email.utils import parsedate_to_datetime
+from email.header import decode_header, make_header
+import mailbox
+import hashlib
+import uuid
+import tempfile
+import mimetypes
+import click
+import re
+import html
+import itertools
+import heapq
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from typing import Annotated, Sequence, TypedDict
+from typing import Annotated, Literal, Sequence, TypedDict
+import base64
+import operator
 from dotenv import load_dotenv  
 from langchain_core.messages import BaseMessage, ToolMessage, SystemMessage, HumanMessage, AIMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.tools import tool
-from langgraph.graph.message import add_messages
-from langgraph.graph import StateGraph, START, END
-from langgraph.prebuilt import ToolNode
-import requests 
+from langchain_core.callbacks import UsageMetadataCallbackHandler, BaseCallbackHandler
+from langchain_core.caches import BaseCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.load import dumps, loads
+from langchain_core._api import suppress_langchain_beta_warning
+from langchain_core.tools import tool, StructuredTool
+from langchain_core.runnables import RunnableLambda
+import httpx
 import pickle
 import datetime as dt
-import dateparser
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from pydantic import BaseModel, Field
+from cachetools import TTLCache
+import xxhash
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+# The Gemini client, Google API clients, LangGraph, dateparser and pypdf are slow to import
+# and are imported where first used, so the CLI and a recycled worker start quickly.
 
 load_dotenv()
 
@@ -33,12 +67,47 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///min
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+# Local state files (LLM cache, preferences version, attachment blobs) default to the
+# instance folder, where a relative sqlite:/// database is created as well.
+os.makedirs(app.instance_path, exist_ok=True)
+
+def instance_file(name: str) -> str:
+    return os.path.join(app.instance_path, name)
+
+# SQLite tuning applied to every connection. WAL lets readers run alongside the webhook
+# and worker writers; synchronous=NORMAL is durable across application crashes in WAL
+# mode. cache_size is in KiB (passed negated), mmap_size in bytes.
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '65536'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={-SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+def add_messages(left, right):
+    """Reducer of the message history, from LangGraph, which is imported when a graph is built"""
+    from langgraph.graph.message import add_messages as merge_messages
+    return merge_messages(left, right)
+
+# Nodes return partial updates. Fields written by parallel branches need a reducer.
 class AgentState(TypedDict, total=False):
     email_body: str
     email_subject: str
     email_to: str
     email_from: str
-    email_tag: list[str]
+    email_headers: dict[str, str]
+    email_tag: Annotated[list[str], operator.add]
     email_attachments: Sequence[str]
     email_reply: str
     meeting: str
@@ -46,7 +115,7 @@ class AgentState(TypedDict, total=False):
     ticket_id: str
     ticket_url: str
     tool_call: bool
-    messages: list[BaseMessage]  
+    messages: Annotated[list[BaseMessage], add_messages]
     event_summary: str
     event_attendees: list[str]
     event_start: str
@@ -56,19 +125,26 @@ class AgentState(TypedDict, total=False):
     ai_summary: str
     ai_reply: str
     extracted_tasks: list[dict[str, str | None]]
+    alert_message: str
+    needs_meeting: bool
+    needs_ticket: bool
+    rule_tag: Optional[str]  # classification rule match, decided before the graph runs
+    llm_lane: str  # lane of the email's chat model calls, decided before the graph runs
 
 class Email(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     from_address = db.Column(db.String(255), nullable=False)
     to_address = db.Column(db.String(255), nullable=False)
     subject = db.Column(db.String(500), nullable=False)
-    body = db.Column(db.Text, nullable=False)
-    text_body = db.Column(db.Text)
-    html_body = db.Column(db.Text)
+    # Large text columns are only read when accessed or explicitly undeferred with
+    # undefer_group('content'), so list queries never load message bodies.
+    body = db.deferred(db.Column(db.Text, nullable=False), group='content')
+    text_body = db.deferred(db.Column(db.Text), group='content')
+    html_body = db.deferred(db.Column(db.Text), group='content')
     received_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     processed_at = db.Column(db.DateTime)
     ai_summary = db.Column(db.Text)
-    ai_reply = db.Column(db.Text)
+    ai_reply = db.deferred(db.Column(db.Text), group='content')
     tags = db.Column(db.JSON)
     priority = db.Column(db.String(50))
     jira_ticket_id = db.Column(db.String(100))
@@ -80,6 +156,47 @@ class Email(db.Model):
     event_attendees = db.Column(db.JSON)
     is_processed = db.Column(db.Boolean, default=False)
     processing_error = db.Column(db.Text)
+    headers = db.deferred(db.Column(db.JSON), group='content')  # Postmark Headers as {lowercased name: value}
+    fingerprint = db.Column(db.BigInteger)  # SimHash of normalised subject and body, stored signed
+    duplicate_of_id = db.Column(db.Integer, db.ForeignKey('email.id'))
+    message_id = db.Column(db.String(500))  # RFC 5322 Message-ID, used to skip re-ingested mail
+    clean_body = db.deferred(db.Column(db.Text), group='content')  # preprocessed text the pipeline reads
+
+    __table_args__ = (
+        db.Index('ix_email_processed_received', 'is_processed', 'received_at', 'id'),
+        db.Index('ix_email_message_id', 'message_id'),
+        db.Index('ix_email_jira_ticket', 'jira_ticket_id'),
+        db.Index('ix_email_calendar_event', 'calendar_event_id'),
+    )
+
+class EmailTag(db.Model):
+    """Filterable labels of a processed email: its classification tags, plus 'meeting'
+    or 'issue' when it has a calendar event or JIRA ticket. received_at is copied from
+    the email so a filter is one ordered range scan of ix_email_tag_tag_received."""
+    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), primary_key=True)
+    tag = db.Column(db.String(100), primary_key=True)
+    received_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_email_tag_tag_received', 'tag', 'received_at', 'email_id'),
+    )
+
+class Attachment(db.Model):
+    """Metadata of an inbound attachment. The content lives in the blob store under its
+    SHA-256, shared by every attachment with the same bytes."""
+    id = db.Column(db.Integer, primary_key=True)
+    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=False)
+    name = db.Column(db.String(500), nullable=False)
+    content_type = db.Column(db.String(255))
+    content_id = db.Column(db.String(500))  # set for inline images referenced as cid: in the HTML
+    size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    email = db.relationship('Email', backref=db.backref('attachments', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_attachment_email', 'email_id'),
+        db.Index('ix_attachment_sha256', 'sha256'),
+    )
 
 class UserPreferences(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -87,9 +204,21 @@ class UserPreferences(db.Model):
     work_summary = db.Column(db.Text)
     urgent_criteria = db.Column(db.Text)
     high_priority_criteria = db.Column(db.Text)
+    version = db.Column(db.Integer, nullable=False, default=1)  # Bumped on every save
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
+class ClassificationRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(100), nullable=False, index=True)
+    field = db.Column(db.String(100), nullable=False)  # from, to, subject or header:<Name>
+    pattern = db.Column(db.String(500), nullable=False)  # case-insensitive regex
+    tag = db.Column(db.String(50), nullable=False)
+    confidence = db.Column(db.Float, default=1.0)
+    position = db.Column(db.Integer, default=0)  # lower positions are tried first
+    enabled = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
 class Task(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=True)
@@ -102,8 +231,162 @@ class Task(db.Model):
     completed_at = db.Column(db.DateTime)
     email = db.relationship('Email', backref=db.backref('tasks', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_task_created', 'created_at', 'id'),
+        db.Index('ix_task_status_created', 'status', 'created_at', 'id'),
+        db.Index('ix_task_priority_created', 'priority', 'created_at', 'id'),
+        db.Index('ix_task_status_due', 'status', 'due_date'),
+        db.Index('ix_task_email', 'email_id'),
+    )
+
+class ProcessingJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=False)
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, default=0)
+    worker_id = db.Column(db.String(100))
+    lease_expires_at = db.Column(db.DateTime)
+    available_at = db.Column(db.DateTime)  # queued jobs are not claimed before this (bulk ingestion, retries)
+    lane = db.Column(db.String(20), default='live', server_default='live')  # LLM lane: live, or backfill for bulk ingestion
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_processing_job_status_lease', 'status', 'lease_expires_at'),
+        db.Index('ix_processing_job_email', 'email_id'),
+    )
+
+class SideEffect(db.Model):
+    """A completed external action of an email's pipeline, such as a calendar event or a
+    Telegram alert. A retry of the email returns the stored result instead of repeating it."""
+    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), primary_key=True)
+    key = db.Column(db.String(100), primary_key=True)  # action name and call ordinal
+    result = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class ChangeEvent(db.Model):
+    """The /api/events change feed. AUTOINCREMENT never reuses an id, so ids only grow and
+    a reconnecting client resumes from its Last-Event-ID."""
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class EmailTrace(db.Model):
+    """One processing attempt of an email: its queue wait, totals, and the graph node,
+    LLM and tool spans recorded by PipelineTrace (offsets and durations in ms)."""
+    id = db.Column(db.Integer, primary_key=True)
+    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=False)
+    mode = db.Column(db.String(20))
+    outcome = db.Column(db.String(20))  # ok, error
+    started_at = db.Column(db.DateTime, nullable=False)
+    queue_wait_ms = db.Column(db.Float)
+    duration_ms = db.Column(db.Float, nullable=False)
+    llm_calls = db.Column(db.Integer, default=0)
+    cache_hits = db.Column(db.Integer, default=0)
+    input_tokens = db.Column(db.Integer, default=0)
+    output_tokens = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    spans = db.deferred(db.Column(db.JSON))
+
+    __table_args__ = (
+        db.Index('ix_email_trace_email', 'email_id', 'started_at'),
+        db.Index('ix_email_trace_started', 'started_at'),
+    )
+
+class StatsCounters(db.Model):
+    """Single row (id=1) of dashboard counters, updated in the same transaction as
+    the change they count and periodically reconciled against the real tables."""
+    id = db.Column(db.Integer, primary_key=True)
+    total_emails = db.Column(db.Integer, nullable=False, default=0)
+    processed_emails = db.Column(db.Integer, nullable=False, default=0)
+    urgent_emails = db.Column(db.Integer, nullable=False, default=0)
+    tickets_created = db.Column(db.Integer, nullable=False, default=0)
+    meetings_scheduled = db.Column(db.Integer, nullable=False, default=0)
+    total_tasks = db.Column(db.Integer, nullable=False, default=0)
+    pending_tasks = db.Column(db.Integer, nullable=False, default=0)
+    completed_tasks = db.Column(db.Integer, nullable=False, default=0)
+    high_priority_tasks = db.Column(db.Integer, nullable=False, default=0)
+    reconciled_at = db.Column(db.DateTime)
+
+class LazyResource:
+    """A process-wide object built on first use, or ahead of time by the startup warm-up.
+    Attribute access is forwarded to the built object, so callers use it directly."""
+
+    registry: List["LazyResource"] = []
+
+    def __init__(self, name: str, factory):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+        self.init_seconds: Optional[float] = None
+        LazyResource.registry.append(self)
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    started = time.perf_counter()
+                    self._value = self._factory()
+                    self.init_seconds = time.perf_counter() - started
+                    RESOURCE_INIT_SECONDS.labels(self.name).set(self.init_seconds)
+                    print(f"🔌 Initialized {self.name} in {self.init_seconds * 1000:.0f} ms")
+                value = self._value
+        return value
+
+    @property
+    def ready(self) -> bool:
+        return self._value is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def gemini_retry_decorator():
+    """langchain-google-genai's retry of a Gemini call, minus 429s. The library retries any
+    API error once after a backoff, whatever max_retries says; a 429 must reach llm_limiter
+    at once, which holds all calls back and queues the rejected one again."""
+    import tenacity
+    from google.api_core.exceptions import GoogleAPIError
+    return tenacity.retry(
+        reraise=True,
+        stop=tenacity.stop_after_attempt(2),
+        wait=tenacity.wait_exponential(multiplier=2, min=1, max=60),
+        retry=tenacity.retry_if_exception(lambda e: isinstance(e, GoogleAPIError) and not is_throttled(e))
+    )
+
+def install_gemini_retry():
+    """Replace the library's retry decorator with gemini_retry_decorator.
+
+    langchain-google-genai 2.1.3 ignores max_retries, and has no other switch, so the
+    module function is replaced. The version is pinned in requirements.txt; if an
+    upgrade changes the function or its callers, fail here rather than retry 429s."""
+    from langchain_google_genai import chat_models
+    current = getattr(chat_models, "_create_retry_decorator", None)
+    if current is gemini_retry_decorator:
+        return
+    callers = [getattr(chat_models, name, None) for name in ("_chat_with_retry", "_achat_with_retry")]
+    if current is None or inspect.signature(current).parameters or not all(
+        caller and "_create_retry_decorator" in caller.__code__.co_names for caller in callers
+    ):
+        raise RuntimeError(
+            "langchain_google_genai.chat_models._create_retry_decorator changed; check that "
+            "gemini_retry_decorator still applies before moving the pin in requirements.txt"
+        )
+    chat_models._create_retry_decorator = gemini_retry_decorator
+
+def chat_model(**kwargs):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    install_gemini_retry()
+    kwargs.setdefault("max_retries", 0)
+    return rate_limited(ChatGoogleGenerativeAI)(**kwargs)
+
 os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-vanilla_model = ChatGoogleGenerativeAI(model="models/gemini-2.0-flash-001", temperature=0.3)
+vanilla_model = LazyResource("vanilla_model", lambda: chat_model(model="models/gemini-2.0-flash-001", temperature=0.3))
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
@@ -113,182 +396,1711 @@ JIRA_PROJECT_KEY = os.getenv('JIRA_PROJECT_KEY')
 JIRA_EMAIL = os.getenv("JIRA_EMAIL")
 JIRA_API_TOKEN = os.getenv("JIRA_API_TOKEN")
 
+# Integration HTTP clients. Base URLs can point at a local stub server for testing.
+JIRA_BASE_URL = os.getenv('JIRA_BASE_URL') or f"https://{JIRA_DOMAIN}"
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+INTEGRATION_CONNECT_TIMEOUT = float(os.getenv('INTEGRATION_CONNECT_TIMEOUT', '5'))
+INTEGRATION_READ_TIMEOUT = float(os.getenv('INTEGRATION_READ_TIMEOUT', '20'))
+INTEGRATION_MAX_RETRIES = int(os.getenv('INTEGRATION_MAX_RETRIES', '3'))
+INTEGRATION_BACKOFF_SECONDS = float(os.getenv('INTEGRATION_BACKOFF_SECONDS', '0.5'))
+INTEGRATION_BACKOFF_MAX_SECONDS = float(os.getenv('INTEGRATION_BACKOFF_MAX_SECONDS', '30'))
+INTEGRATION_MAX_CONNECTIONS = int(os.getenv('INTEGRATION_MAX_CONNECTIONS', '10'))
+
 SCOPES = ['https://www.googleapis.com/auth/calendar']
+
+# Preference versions are mirrored to this file so other processes notice saves
+# without querying the database.
+PREFERENCES_VERSION_PATH = os.getenv('PREFERENCES_VERSION_PATH') or instance_file('preferences.version')
+
+# Google Calendar client: credentials are refreshed in the background this long before
+# they expire. Event inserts arriving within the batch window share one batch request.
+GOOGLE_TOKEN_PATH = os.getenv('GOOGLE_TOKEN_PATH', 'token.pkl')
+GOOGLE_CREDENTIALS_PATH = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
+CALENDAR_REFRESH_MARGIN_SECONDS = int(os.getenv('CALENDAR_REFRESH_MARGIN_SECONDS', '300'))
+CALENDAR_BATCH_WINDOW_MS = int(os.getenv('CALENDAR_BATCH_WINDOW_MS', '50'))
+CALENDAR_BATCH_MAX_SIZE = int(os.getenv('CALENDAR_BATCH_MAX_SIZE', '50'))
+# Alternative Calendar API root (e.g. http://localhost:8099/), used by the offline benchmark
+CALENDAR_API_BASE = os.getenv('CALENDAR_API_BASE')
+
+# Processing queue: number of worker threads, how long a claimed job stays leased
+# before another worker may pick it up again, and how often a crashed job is retried.
+EMAIL_WORKER_CONCURRENCY = int(os.getenv('EMAIL_WORKER_CONCURRENCY', '4'))
+EMAIL_JOB_LEASE_SECONDS = int(os.getenv('EMAIL_JOB_LEASE_SECONDS', '300'))
+EMAIL_JOB_MAX_ATTEMPTS = int(os.getenv('EMAIL_JOB_MAX_ATTEMPTS', '3'))
+EMAIL_JOB_POLL_SECONDS = float(os.getenv('EMAIL_JOB_POLL_SECONDS', '1.0'))
+# A failed attempt is retried after this delay, doubled on each further attempt.
+EMAIL_JOB_RETRY_BACKOFF_SECONDS = float(os.getenv('EMAIL_JOB_RETRY_BACKOFF_SECONDS', '30'))
+# "thread" runs one pipeline per worker thread. "asyncio" runs EMAIL_WORKER_CONCURRENCY
+# coroutines on a single event loop, with database work on EMAIL_ASYNC_DB_THREADS threads.
+EMAIL_WORKER_MODE = os.getenv('EMAIL_WORKER_MODE', 'thread')
+EMAIL_ASYNC_DB_THREADS = int(os.getenv('EMAIL_ASYNC_DB_THREADS', '4'))
+# Whether the web server process runs the workers: from startup under `python app.py`,
+# otherwise from its first request. Set to false when `flask run-workers` processes own
+# the queue; any number of them can share it.
+EMAIL_WORKERS_IN_WEB = os.getenv('EMAIL_WORKERS_IN_WEB', 'true').lower() == 'true'
+
+# Pipeline mode: "graph" runs one LLM call per step, "fused" asks for tag, summary,
+# reply and tasks in a single structured call. PIPELINE_FUSED_RATIO routes a share
+# of emails to the fused mode regardless of PIPELINE_MODE, for A/B comparisons.
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'graph')
+PIPELINE_FUSED_RATIO = float(os.getenv('PIPELINE_FUSED_RATIO', '0'))
+
+# LLM response cache: in-memory LRU in front of a SQLite file, both expiring after the TTL.
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH') or instance_file('llm_cache.db')
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '1024'))
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', '86400'))
+
+# Client-side limits for Gemini calls (cache hits are not counted). Requests and estimated
+# tokens are drawn from per-minute buckets holding about 10 seconds of quota (0 disables a
+# bucket). Concurrency starts at LLM_MAX_CONCURRENCY, is halved on a 429 or a call slower
+# than LLM_LATENCY_TARGET_SECONDS and grows back by one per round of fast calls. A 429
+# pauses all calls with exponential backoff; the rejected call is retried up to
+# LLM_RATE_LIMIT_RETRIES times.
+LLM_RATE_LIMIT_RPM = int(os.getenv('LLM_RATE_LIMIT_RPM', '0'))
+LLM_RATE_LIMIT_TPM = int(os.getenv('LLM_RATE_LIMIT_TPM', '0'))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))
+LLM_LATENCY_TARGET_SECONDS = float(os.getenv('LLM_LATENCY_TARGET_SECONDS', '30'))
+LLM_RATE_LIMIT_RETRIES = int(os.getenv('LLM_RATE_LIMIT_RETRIES', '5'))
+
+# Rule-based pre-classification: a matching rule at or above this confidence replaces
+# the LLM classification call. Compiled rules are reloaded after this many seconds.
+RULE_CONFIDENCE_THRESHOLD = float(os.getenv('RULE_CONFIDENCE_THRESHOLD', '0.9'))
+RULE_CACHE_SECONDS = int(os.getenv('RULE_CACHE_SECONDS', '60'))
+
+# Micro-batching of classification calls: while a classification is in flight, requests
+# sharing a system prompt are collected for up to the window (or until the batch is
+# full) and sent as one prompt. A request arriving when none is in flight is sent at once.
+CLASSIFY_BATCH_WINDOW_MS = int(os.getenv('CLASSIFY_BATCH_WINDOW_MS', '100'))
+CLASSIFY_BATCH_MAX_SIZE = int(os.getenv('CLASSIFY_BATCH_MAX_SIZE', '10'))
+
+# Near-duplicate detection: emails whose SimHash similarity to an email processed
+# within the window reaches the threshold reuse its analysis instead of running the graph.
+# A duplicate of an email still in flight waits up to DUPLICATE_WAIT_SECONDS for it.
+DUPLICATE_DETECTION_ENABLED = os.getenv('DUPLICATE_DETECTION_ENABLED', 'true').lower() == 'true'
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.getenv('DUPLICATE_SIMILARITY_THRESHOLD', '0.9'))
+DUPLICATE_WINDOW_MINUTES = int(os.getenv('DUPLICATE_WINDOW_MINUTES', '60'))
+DUPLICATE_WAIT_SECONDS = int(os.getenv('DUPLICATE_WAIT_SECONDS', '120'))
+
+# List endpoints return pages of `limit` rows (default API_PAGE_SIZE, at most API_MAX_PAGE_SIZE).
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', '50'))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', '200'))
+
+# Change feed: idle /api/events streams send a keep-alive comment this often, and this
+# many recent events are kept so reconnecting clients can resume from Last-Event-ID.
+# Streams poll the feed for events of other processes every EVENT_POLL_SECONDS. Each
+# holds a server thread, so at most EVENT_MAX_SUBSCRIBERS are open at once.
+EVENT_HEARTBEAT_SECONDS = int(os.getenv('EVENT_HEARTBEAT_SECONDS', '15'))
+EVENT_BUFFER_SIZE = int(os.getenv('EVENT_BUFFER_SIZE', '1000'))
+EVENT_POLL_SECONDS = float(os.getenv('EVENT_POLL_SECONDS', '1.0'))
+EVENT_MAX_SUBSCRIBERS = int(os.getenv('EVENT_MAX_SUBSCRIBERS', '100'))
+
+# Gemini clients, the compiled graphs and the Google Calendar service are built on first
+# use. With STARTUP_WARMUP on, the first request (typically a /health probe) starts a
+# background thread that builds them before the first email needs them.
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', 'true').lower() == 'true'
+
+# Dashboard counters are recomputed from the tables this often to correct drift.
+STATS_RECONCILE_SECONDS = int(os.getenv('STATS_RECONCILE_SECONDS', '300'))
+
+# Bulk ingestion (/inbound/batch and `flask ingest-emails`): emails are inserted this many
+# per transaction, and their jobs are released to the workers at INGEST_RATE_PER_MINUTE
+# (0 releases them at once) so a replayed archive does not crowd out live mail.
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '500'))
+INGEST_RATE_PER_MINUTE = float(os.getenv('INGEST_RATE_PER_MINUTE', '60'))
+INGEST_BATCH_MAX_SIZE = int(os.getenv('INGEST_BATCH_MAX_SIZE', '1000'))
+
+# Email bodies are cleaned once before the graph runs (HTML to text, quoted replies and
+# signatures removed) and cut to about this many tokens. 0 disables truncation.
+BODY_TOKEN_BUDGET = int(os.getenv('BODY_TOKEN_BUDGET', '2000'))
+BODY_CHARS_PER_TOKEN = 4
+
+# Inbound attachments are base64-decoded while the request streams in and stored once
+# per SHA-256 under ATTACHMENT_STORE_PATH; the database only keeps their metadata. Their
+# text is extracted the first time the pipeline reads it, up to ATTACHMENT_TOKEN_BUDGET
+# tokens per email, and cached next to the blob. 0 leaves attachments out of the prompts.
+ATTACHMENT_STORE_PATH = os.getenv('ATTACHMENT_STORE_PATH') or instance_file('attachments')
+ATTACHMENT_TOKEN_BUDGET = int(os.getenv('ATTACHMENT_TOKEN_BUDGET', '1000'))
+
+# Per-email traces (node, LLM and tool spans of each processing attempt) are kept this long.
+EMAIL_TRACE_RETENTION_DAYS = int(os.getenv('EMAIL_TRACE_RETENTION_DAYS', '14'))
+
+# Prometheus metrics, served from /metrics. Buckets span database-only nodes to slow LLM calls.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+NODE_LATENCY = Histogram('pipeline_node_seconds', 'LangGraph node latency', ['node'], buckets=LATENCY_BUCKETS)
+NODE_ERRORS = Counter('pipeline_node_errors_total', 'LangGraph node failures', ['node'])
+LLM_LATENCY = Histogram('llm_request_seconds', 'Chat model call latency, cache hits excluded', ['node'], buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter('llm_tokens_total', 'Tokens sent to (input) and generated by (output) the chat model', ['node', 'direction'])
+LLM_ERRORS = Counter('llm_errors_total', 'Failed chat model calls', ['node'])
+LLM_CACHE_LOOKUPS = Counter('llm_cache_lookups_total', 'LLM response cache lookups', ['result'])
+TOOL_LATENCY = Histogram('tool_call_seconds', 'Tool call latency', ['tool'], buckets=LATENCY_BUCKETS)
+TOOL_ERRORS = Counter('tool_errors_total', 'Failed tool calls', ['tool'])
+INTEGRATION_LATENCY = Histogram('integration_request_seconds', 'External API request latency per attempt',
+                                ['service', 'outcome'], buckets=LATENCY_BUCKETS)
+HTTP_LATENCY = Histogram('http_request_seconds', 'Flask route latency', ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+EMAIL_PROCESSING = Histogram('email_processing_seconds', 'Pipeline time per email', ['mode', 'outcome'], buckets=LATENCY_BUCKETS)
+QUEUE_WAIT = Histogram('email_queue_wait_seconds', 'Time from enqueue (or scheduled release) to first claim', buckets=LATENCY_BUCKETS)
+QUEUE_DEPTH = Gauge('email_queue_depth', 'Jobs waiting to be claimed')
+BODY_CHARS = Counter('email_body_chars_total', 'Email body characters before (raw) and after (clean) preprocessing', ['stage'])
+STARTUP_SECONDS = Gauge('app_startup_seconds', 'Startup phases: import, warmup, first_request (its latency) and to_first_response (from import start)', ['phase'])
+RESOURCE_INIT_SECONDS = Gauge('lazy_resource_init_seconds', 'Time to build each lazily initialized resource', ['resource'])
+ATTACHMENT_BYTES = Counter('attachment_bytes_total', 'Decoded attachment bytes, new blobs (stored) or already present (deduplicated)', ['result'])
+LLM_LIMITER_WAIT = Histogram('llm_limiter_wait_seconds', 'Time chat model calls waited for the rate limiter', ['lane'], buckets=LATENCY_BUCKETS)
+LLM_THROTTLED = Counter('llm_throttled_total', 'Chat model calls rejected with a 429, then retried or failed', ['outcome'])
+LLM_CONCURRENCY_LIMIT = Gauge('llm_concurrency_limit', 'Current adaptive limit on concurrent chat model calls')
+LLM_IN_FLIGHT = Gauge('llm_in_flight', 'Chat model calls currently admitted by the rate limiter')
+
+_llm_cache_bypass = contextvars.ContextVar('llm_cache_bypass', default=False)
+
+class LLMResponseCache(BaseCache):
+    """Content-addressed cache for chat model responses.
+
+    LangChain passes the serialized messages as ``prompt`` and the serialized
+    model (name, temperature, bound tools) as ``llm_string``; the key is an
+    xxh3 hash of both. Hits are served from a bounded LRU first, then from SQLite.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self._memory = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return xxhash.xxh3_128_hexdigest(f"{llm_string}\x00{prompt}")
+
+    def lookup(self, prompt: str, llm_string: str):
+        if _llm_cache_bypass.get():
+            with self._lock:
+                self.bypassed += 1
+            LLM_CACHE_LOOKUPS.labels('bypassed').inc()
+            return None
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self.memory_hits += 1
+                result = 'memory_hit'
+            else:
+                row = self._conn.execute(
+                    "SELECT value FROM llm_cache WHERE key = ? AND created_at >= ?",
+                    (key, time.time() - self.ttl_seconds)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    LLM_CACHE_LOOKUPS.labels('miss').inc()
+                    return None
+                value = row[0]
+                self._memory[key] = value
+                self.disk_hits += 1
+                result = 'disk_hit'
+        LLM_CACHE_LOOKUPS.labels(result).inc()
+        with suppress_langchain_beta_warning():
+            generations = [loads(item) for item in json.loads(value)]
+        # Lets PipelineTrace tell a cached answer from a model call
+        for generation in generations:
+            if getattr(generation, 'message', None) is not None:
+                generation.message.response_metadata['cache_hit'] = True
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val):
+        if _llm_cache_bypass.get():
+            return
+        key = self._key(prompt, llm_string)
+        value = json.dumps([dumps(generation) for generation in return_val])
+        with self._lock:
+            self._memory[key] = value
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._evict_expired()
+            self._conn.commit()
+
+    def _evict_expired(self):
+        self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            }
+
+def without_llm_cache(node):
+    """Opt a graph node out of the LLM cache, e.g. when its response triggers side effects"""
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(state):
+            token = _llm_cache_bypass.set(True)
+            try:
+                return await node(state)
+            finally:
+                _llm_cache_bypass.reset(token)
+        return async_wrapper
+
+    @functools.wraps(node)
+    def wrapper(state):
+        token = _llm_cache_bypass.set(True)
+        try:
+            return node(state)
+        finally:
+            _llm_cache_bypass.reset(token)
+    return wrapper
+
+# Priority lane of the chat model calls made in the current context, in admission order.
+# Calls made outside the job queue are "interactive"; queued emails are "live", or
+# "backfill" when bulk ingestion queued them. An email a classification rule tags urgent,
+# or its sender marks high priority, runs "urgent" (decided before its graph runs).
+LLM_LANES = ("urgent", "interactive", "live", "backfill")
+llm_lane = contextvars.ContextVar('llm_lane', default='interactive')
+
+def is_throttled(error: Exception) -> bool:
+    """True for a quota rejection (HTTP 429, RESOURCE_EXHAUSTED) from the model API"""
+    return getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error)
+
+class TokenBucket:
+    """Refills at `per_minute` / 60 per second and holds `burst_seconds` of quota. A call
+    needing more than the bucket can hold waits for a full bucket and leaves it in debt."""
+
+    def __init__(self, per_minute: int, burst_seconds: float = 10):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, 0 if it can be now"""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+class LLMLease:
+    """An admitted chat model call; `epoch` is the limiter's decrease count at admission"""
+
+    def __init__(self, lane: str, seq: int, tokens: int, epoch: int):
+        self.lane = lane
+        self.seq = seq
+        self.tokens = tokens
+        self.epoch = epoch
+
+class LLMRateLimiter:
+    """Shared admission control for chat model calls.
+
+    Waiting calls are ordered by lane, then arrival, and a dispatcher thread admits the
+    first one once the request and token buckets allow it and fewer calls than the
+    concurrency limit are in flight. The limit is adjusted AIMD-style: it grows by
+    1/limit per call finishing within the latency target and is halved on a 429 or a
+    slower call, at most once per round of calls admitted under the previous limit.
+    A 429 also holds all admissions back, twice as long for each round in a row that
+    is throttled, and its call is queued again in its original place.
+    Tokens are estimated from the prompt and corrected with the usage the API reports.
+    """
+
+    def __init__(self, rpm: int, tpm: int, max_concurrency: int, latency_target: float, max_retries: int):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (lane rank, seq, enqueued at, tokens, lane, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._in_flight = 0
+        self._epoch = 0
+        self._throttled_rounds = 0
+        self._hold_until = 0.0
+        self._output_tokens = 256.0  # moving average of generated tokens per call
+        self.admitted = {lane: 0 for lane in LLM_LANES}
+        self.throttled = 0
+        self.retried = 0
+        self.decreases = 0
+        LLM_CONCURRENCY_LIMIT.set(self.limit)
+
+    def estimate_tokens(self, messages: Sequence[BaseMessage]) -> int:
+        chars = sum(len(m.content if isinstance(m.content, str) else str(m.content)) for m in messages)
+        return int(chars / BODY_CHARS_PER_TOKEN + self._output_tokens)
+
+    def acquire(self, tokens: int, lane: str, seq: Optional[int] = None) -> Future:
+        """Queue a call; the future resolves to its LLMLease once admitted. A retry passes
+        the seq of its first attempt to keep its place in the lane."""
+        future = Future()
+        with self._cond:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_loop, name="llm-limiter", daemon=True)
+                self._dispatcher.start()
+            if seq is None:
+                seq = next(self._seq)
+            heapq.heappush(self._waiting, (LLM_LANES.index(lane), seq, time.monotonic(), tokens, lane, future))
+            self._cond.notify()
+        return future
+
+    def release(self, lease: LLMLease, latency: float, outcome: str = "ok", usage: Optional[dict] = None):
+        """Return an admitted call's slot. `outcome` is "ok", "throttled" or "error"."""
+        with self._cond:
+            self._in_flight -= 1
+            if usage:
+                self._output_tokens += 0.1 * (usage.get('output_tokens', 0) - self._output_tokens)
+                if self.tokens:
+                    correction = lease.tokens - usage.get('total_tokens', lease.tokens)
+                    self.tokens.level = min(self.tokens.capacity, self.tokens.level + correction)
+            if outcome == "throttled" or latency > self.latency_target:
+                if lease.epoch == self._epoch:
+                    self._epoch += 1
+                    self.decreases += 1
+                    self.limit = max(1.0, self.limit / 2)
+                    if outcome == "throttled":
+                        self._throttled_rounds += 1
+                        backoff = min(2 ** self._throttled_rounds, 60)
+                        self._hold_until = time.monotonic() + random.uniform(backoff / 2, backoff)
+                if outcome == "throttled" and self.requests:
+                    self.requests.level = min(self.requests.level, 0.0)
+            elif outcome == "ok":
+                self._throttled_rounds = 0
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            LLM_CONCURRENCY_LIMIT.set(self.limit)
+            LLM_IN_FLIGHT.set(self._in_flight)
+            self._cond.notify()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                granted, delay = self._admit(time.monotonic())
+                if not granted:
+                    self._cond.wait(delay)
+                    continue
+            for future, lease, waited in granted:
+                LLM_LIMITER_WAIT.labels(lease.lane).observe(waited)
+                future.set_result(lease)
+
+    def _admit(self, now: float) -> tuple[list, Optional[float]]:
+        """Admit waiting calls in order; returns them and, when the first remaining call
+        waits for a bucket or a 429 hold, how long (None when it waits for a free slot)"""
+        granted = []
+        if now < self._hold_until:
+            return granted, self._hold_until - now
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.refill(now)
+        while self._waiting:
+            _, seq, enqueued, tokens, lane, future = self._waiting[0]
+            if future.cancelled():
+                heapq.heappop(self._waiting)
+                continue
+            if self._in_flight >= int(self.limit):
+                return granted, None
+            delay = max(self.requests.delay(1) if self.requests else 0.0,
+                        self.tokens.delay(tokens) if self.tokens else 0.0)
+            if delay > 0:
+                return granted, max(delay, 0.001)
+            heapq.heappop(self._waiting)
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.requests:
+                self.requests.level -= 1
+            if self.tokens:
+                self.tokens.level -= tokens
+            self._in_flight += 1
+            self.admitted[lane] += 1
+            granted.append((future, LLMLease(lane, seq, tokens, self._epoch), now - enqueued))
+        LLM_IN_FLIGHT.set(self._in_flight)
+        return granted, None
+
+    def _release_abandoned(self, future: Future):
+        if not future.cancelled():
+            self.release(future.result(), 0.0, "error")
+
+    def _retry(self, lease: LLMLease, started: float, error: Exception, attempt: int) -> bool:
+        """Release a failed call; True if it was throttled and should be queued again"""
+        throttled = is_throttled(error)
+        self.release(lease, time.monotonic() - started, "throttled" if throttled else "error")
+        if not throttled:
+            return False
+        retry = attempt < self.max_retries
+        with self._cond:
+            self.throttled += 1
+            self.retried += retry
+        LLM_THROTTLED.labels('retried' if retry else 'failed').inc()
+        if not retry:
+            print(f"❌ Gemini rate limit: giving up after {attempt + 1} attempts ({lease.lane})")
+        return retry
+
+    def call(self, generate, messages: Sequence[BaseMessage]):
+        """Run `generate()`, one API call, once admitted; 429s are queued again"""
+        lane, tokens, seq = llm_lane.get(), self.estimate_tokens(messages), None
+        for attempt in itertools.count():
+            lease = self.acquire(tokens, lane, seq).result()
+            seq = lease.seq
+            started = time.monotonic()
+            try:
+                result = generate()
+            except Exception as e:
+                if not self._retry(lease, started, e, attempt):
+                    raise
+                continue
+            self.release(lease, time.monotonic() - started, usage=chat_result_usage(result))
+            return result
+
+    async def acall(self, agenerate, messages: Sequence[BaseMessage]):
+        """Async counterpart of call: waits for admission without blocking the loop"""
+        lane, tokens, seq = llm_lane.get(), self.estimate_tokens(messages), None
+        for attempt in itertools.count():
+            future = self.acquire(tokens, lane, seq)
+            try:
+                lease = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                # Admitted just as the task was cancelled: give the slot back
+                future.add_done_callback(self._release_abandoned)
+                raise
+            seq = lease.seq
+            started = time.monotonic()
+            try:
+                result = await agenerate()
+            except Exception as e:
+                if not self._retry(lease, started, e, attempt):
+                    raise
+                continue
+            except BaseException:
+                self.release(lease, time.monotonic() - started, "error")
+                raise
+            self.release(lease, time.monotonic() - started, usage=chat_result_usage(result))
+            return result
+
+    def stats(self) -> Dict:
+        with self._cond:
+            waiting = {lane: 0 for lane in LLM_LANES}
+            for entry in self._waiting:
+                if not entry[-1].cancelled():
+                    waiting[entry[4]] += 1
+            return {
+                "requests_per_minute": self.requests.per_minute if self.requests else None,
+                "tokens_per_minute": self.tokens.per_minute if self.tokens else None,
+                "max_concurrency": self.max_concurrency,
+                "concurrency_limit": round(self.limit, 2),
+                "in_flight": self._in_flight,
+                "waiting": waiting,
+                "admitted": dict(self.admitted),
+                "throttled": self.throttled,
+                "retried": self.retried,
+                "decreases": self.decreases,
+                "estimated_output_tokens": round(self._output_tokens)
+            }
+
+def chat_result_usage(result) -> Optional[dict]:
+    """Usage metadata of the first generation of a ChatResult, if the API reported it"""
+    message = getattr(result.generations[0], 'message', None) if result.generations else None
+    return getattr(message, 'usage_metadata', None)
+
+llm_limiter = LLMRateLimiter(LLM_RATE_LIMIT_RPM, LLM_RATE_LIMIT_TPM, LLM_MAX_CONCURRENCY,
+                             LLM_LATENCY_TARGET_SECONDS, LLM_RATE_LIMIT_RETRIES)
+
+class RateLimitedChatModel:
+    """Chat model mixin sending API calls through llm_limiter. BaseChatModel only calls
+    _generate/_agenerate on a cache miss, so cached answers are never held back."""
+
+    def _generate(self, messages, *args, **kwargs):
+        return llm_limiter.call(functools.partial(super()._generate, messages, *args, **kwargs), messages)
+
+    async def _agenerate(self, messages, *args, **kwargs):
+        return await llm_limiter.acall(functools.partial(super()._agenerate, messages, *args, **kwargs), messages)
+
+@functools.cache
+def rate_limited(model_class):
+    """`model_class` with RateLimitedChatModel mixed in. The subclass keeps the class name
+    and module, which are part of the serialized model in LLM cache keys."""
+    return type(model_class.__name__, (RateLimitedChatModel, model_class), {"__module__": model_class.__module__})
+
+def state_lane(node):
+    """Run a node's chat model calls in the llm_lane of its state, if it has one"""
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(state):
+            if "llm_lane" not in state:
+                return await node(state)
+            token = llm_lane.set(state["llm_lane"])
+            try:
+                return await node(state)
+            finally:
+                llm_lane.reset(token)
+        return async_wrapper
+
+    @functools.wraps(node)
+    def wrapper(state):
+        if "llm_lane" not in state:
+            return node(state)
+        token = llm_lane.set(state["llm_lane"])
+        try:
+            return node(state)
+        finally:
+            llm_lane.reset(token)
+    return wrapper
+
+def graph_node(func, afunc=None):
+    """Wrap a node so the graph runs `func` under invoke and `afunc` under ainvoke, with
+    its chat model calls in the lane chosen for the email before the graph ran"""
+    return RunnableLambda(state_lane(func), afunc=state_lane(afunc) if afunc else None, name=func.__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class IntegrationClient:
+    """Shared HTTP client for one external service.
+
+    Keeps a keep-alive connection pool (one httpx.Client, plus one AsyncClient per
+    event loop), applies explicit connect/read timeouts, and retries 429s, 5xx
+    responses and transport errors with capped exponential backoff that honours
+    Retry-After. For requests that must not be repeated blindly, ``recover`` is
+    called before retrying an ambiguous failure (a timeout or 5xx after the
+    request may have been applied); if it returns True the retry is skipped.
+    """
+
+    def __init__(self, name: str, base_url: str, auth: Optional[tuple] = None, headers: Optional[dict] = None):
+        self.name = name
+        self.base_url = base_url
+        self._client_kwargs = {
+            "base_url": base_url,
+            "auth": auth,
+            "headers": headers,
+            "timeout": httpx.Timeout(INTEGRATION_READ_TIMEOUT, connect=INTEGRATION_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=INTEGRATION_MAX_CONNECTIONS,
+                max_keepalive_connections=INTEGRATION_MAX_CONNECTIONS
+            )
+        }
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    @property
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(**self._client_kwargs)
+            return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # AsyncClient connections belong to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(**self._client_kwargs)
+            self._async_clients[loop] = client
+        return client
+
+    @staticmethod
+    def _retry_after(response: Optional[httpx.Response]) -> Optional[float]:
+        if response is None:
+            return None
+        value = response.headers.get("Retry-After")
+        if not value:
+            # Telegram reports flood-control waits in the body instead
+            try:
+                return float(response.json()["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                return None
+
+    def _delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        retry_after = self._retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, INTEGRATION_BACKOFF_MAX_SECONDS)
+        backoff = min(INTEGRATION_BACKOFF_SECONDS * 2 ** attempt, INTEGRATION_BACKOFF_MAX_SECONDS)
+        return random.uniform(backoff / 2, backoff)
+
+    def _should_retry(self, attempt: int, response: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+        if attempt >= INTEGRATION_MAX_RETRIES:
+            return False
+        if error is not None:
+            return isinstance(error, httpx.TransportError)
+        return response.status_code in RETRYABLE_STATUS_CODES
+
+    @staticmethod
+    def _ambiguous(response: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+        """Whether the server may have applied a request that failed"""
+        if error is not None:
+            return not isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+        return response.status_code >= 500
+
+    def _observe(self, started: float, response: Optional[httpx.Response], error: Optional[Exception]):
+        outcome = str(response.status_code) if response is not None else type(error).__name__
+        INTEGRATION_LATENCY.labels(self.name, outcome).observe(time.perf_counter() - started)
+
+    def _record(self, retried: bool, failed: bool):
+        with self._lock:
+            self.requests += 1
+            self.retries += int(retried)
+            self.failures += int(failed)
+
+    def request(self, method: str, path: str, recover=None, **kwargs) -> Optional[httpx.Response]:
+        """Send a request with retries. Returns None if ``recover`` resolved a failure."""
+        attempt = 0
+        while True:
+            response, error = None, None
+            started = time.perf_counter()
+            try:
+                response = self.client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                error = e
+            self._observe(started, response, error)
+            if not self._should_retry(attempt, response, error):
+                self._record(attempt > 0, error is not None or response.status_code >= 400)
+                if error is not None:
+                    raise error
+                return response
+            if recover and self._ambiguous(response, error) and recover():
+                self._record(attempt > 0, False)
+                return None
+            delay = self._delay(attempt, response)
+            print(f"🔁 {self.name} {method} failed ({error or response.status_code}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    async def arequest(self, method: str, path: str, recover=None, **kwargs) -> Optional[httpx.Response]:
+        attempt = 0
+        while True:
+            response, error = None, None
+            started = time.perf_counter()
+            try:
+                response = await self.async_client.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                error = e
+            self._observe(started, response, error)
+            if not self._should_retry(attempt, response, error):
+                self._record(attempt > 0, error is not None or response.status_code >= 400)
+                if error is not None:
+                    raise error
+                return response
+            if recover and self._ambiguous(response, error) and await recover():
+                self._record(attempt > 0, False)
+                return None
+            delay = self._delay(attempt, response)
+            print(f"🔁 {self.name} {method} failed ({error or response.status_code}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"requests": self.requests, "retries": self.retries, "failures": self.failures}
+
+jira_client = IntegrationClient(
+    "jira",
+    JIRA_BASE_URL,
+    auth=(JIRA_EMAIL or "", JIRA_API_TOKEN or ""),
+    headers={"Accept": "application/json", "Content-Type": "application/json"}
+)
+telegram_client = IntegrationClient("telegram", TELEGRAM_API_BASE)
+
+# Id of the email being processed, used to make side effects idempotent across retries
+current_email_id = contextvars.ContextVar('current_email_id', default=None)
+# Tool calls made per tool name while the current email is processed. A retry of the email
+# starts from zero again, so its n-th call of a tool gets the key the first attempt used.
+tool_call_counts = contextvars.ContextVar('tool_call_counts', default=None)
+_tool_call_counts_lock = threading.Lock()
+
+def tool_call_ordinal(name: str) -> Optional[int]:
+    """Ordinal of this call of tool `name` for the current email, None outside the job queue"""
+    counts = tool_call_counts.get()
+    if counts is None or current_email_id.get() is None:
+        return None
+    with _tool_call_counts_lock:
+        counts[name] = counts.get(name, 0) + 1
+        return counts[name]
+
+def side_effect_key(name: str) -> Optional[str]:
+    ordinal = tool_call_ordinal(name)
+    return None if ordinal is None else f"{name}:{ordinal}"
+
+# Side effects are read and recorded on their own connection: tools and graph nodes run on
+# executor threads, which must not share the request's session.
+def completed_side_effect(key: Optional[str]) -> Optional[dict]:
+    """Result an earlier attempt of the current email stored under `key`, if any"""
+    if key is None:
+        return None
+    with db.engine.connect() as conn:
+        return conn.execute(
+            db.select(SideEffect.result).where(SideEffect.email_id == current_email_id.get(), SideEffect.key == key)
+        ).scalar()
+
+def record_side_effect(key: Optional[str], result: dict):
+    if key is None:
+        return
+    with db.engine.begin() as conn:
+        conn.execute(db.insert(SideEffect).prefix_with("OR REPLACE").values(
+            email_id=current_email_id.get(), key=key, result=result, created_at=datetime.now(timezone.utc)
+        ))
+
+llm_cache = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS) if LLM_CACHE_ENABLED else None
+if llm_cache:
+    set_llm_cache(llm_cache)
+
 def priority_check(state: AgentState) -> str:
     if "urgent" in state.get("email_tag", []):
         return "notify"
     return "skip"
 
-def send_telegram_alert(state: AgentState) -> AgentState:
+def _alert_prompt(state: AgentState) -> str:
     email_subject = state.get("email_subject", "No Subject")
     email_body = state.get("email_body", "No Body")
-    prompt = (
+    return (
         f"You're an alert system. Generate a short, high-priority alert message "
         f"based on the following email.\n\n"
         f"Subject: {email_subject}\n"
         f"Body: {email_body}\n\n"
         f"Respond only with the alert message."
     )
-    generated_alert = vanilla_model.invoke(prompt).content.strip()
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+
+def alert_already_sent(key: Optional[str]) -> bool:
+    if completed_side_effect(key) is None:
+        return False
+    print("⏭️ Telegram alert was sent by an earlier attempt.")
+    return True
+
+def send_telegram_alert(state: AgentState) -> AgentState:
+    key = side_effect_key("telegram_alert")
+    if alert_already_sent(key):
+        return {}
+    generated_alert = vanilla_model.invoke(_alert_prompt(state)).content.strip()
+    if post_telegram_message(generated_alert):
+        record_side_effect(key, {"text": generated_alert})
+    return {}
+
+async def asend_telegram_alert(state: AgentState) -> AgentState:
+    key = side_effect_key("telegram_alert")
+    if await asyncio.to_thread(alert_already_sent, key):
+        return {}
+    generated_alert = (await vanilla_model.ainvoke(_alert_prompt(state))).content.strip()
+    if await apost_telegram_message(generated_alert):
+        await asyncio.to_thread(record_side_effect, key, {"text": generated_alert})
+    return {}
+
+def _telegram_request(text: str) -> tuple[str, dict]:
+    url = f"/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": TELEGRAM_CHAT_ID,
-        "text": generated_alert,
+        "text": text,
         "parse_mode": "Markdown"
     }
-    response = requests.post(url, json=payload)
-    if response.status_code == 200:
+    return url, payload
+
+def _report_telegram_response(status_code: int, text: str) -> bool:
+    if status_code == 200:
         print("✅ Telegram alert sent.")
-    else:
-        print("❌ Telegram alert failed:", response.text)
-    return state
+        return True
+    print("❌ Telegram alert failed:", text)
+    return False
 
-def classify_email(state: AgentState) -> AgentState:
-    # Fetch user preferences if available
-    user_id = "default_user"
-    prefs = UserPreferences.query.filter_by(user_id=user_id).first()
-    urgent_criteria = prefs.urgent_criteria if prefs and prefs.urgent_criteria else ""
-    high_priority_criteria = prefs.high_priority_criteria if prefs and prefs.high_priority_criteria else ""
-
-    system_message = (
-        "You are a helpful assistant that classifies emails based on their content. "
-        "Classify the email into one of these categories: 'urgent', 'high_priority', "
-        "'low_priority', 'spam', or 'other'. Just return the tag."
-    )
-    if urgent_criteria or high_priority_criteria:
-        system_message += (
+def post_telegram_message(text: str) -> bool:
+    url, payload = _telegram_request(text)
+    response = telegram_client.request("POST", url, json=payload)
+    return _report_telegram_response(response.status_code, response.text)
+
+async def apost_telegram_message(text: str) -> bool:
+    url, payload = _telegram_request(text)
+    response = await telegram_client.arequest("POST", url, json=payload)
+    return _report_telegram_response(response.status_code, response.text)
+
+CLASSIFICATION_TAGS = ("urgent", "high_priority", "low_priority", "spam", "other")
+
+def parse_json_response(content: str):
+    """Parse a JSON model response, tolerating a Markdown code fence around it"""
+    text = content.strip()
+    # Clean up the response to ensure it's valid JSON
+    if text.startswith('```json'):
+        text = text[7:-3].strip()
+    elif text.startswith('```'):
+        text = text[3:-3].strip()
+    return json.loads(text)
+
+class PreferencesCache:
+    """Rendered classification prompts per user.
+
+    Each entry holds the preferences fragment and the system messages built from it.
+    Saving preferences bumps UserPreferences.version and records it in a version
+    file; other processes compare that file's stat signature with the one they last
+    saw and drop entries whose version changed, so steady-state lookups never touch
+    the database.
+    """
+
+    def __init__(self, version_path: str):
+        self.version_path = version_path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}  # user_id -> {"version", "fragment", "messages"}
+        self._file_signature = None
+        self.hits = 0
+        self.loads = 0
+
+    def _read_versions(self) -> Dict[str, int]:
+        try:
+            with open(self.version_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _check_version_file(self):
+        try:
+            st = os.stat(self.version_path)
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            signature = None
+        with self._lock:
+            if signature == self._file_signature:
+                return
+            self._file_signature = signature
+        versions = self._read_versions()
+        with self._lock:
+            for user_id in [u for u, entry in self._entries.items() if versions.get(u) != entry["version"]]:
+                del self._entries[user_id]
+
+    @staticmethod
+    def _render_fragment(prefs: Optional[UserPreferences]) -> str:
+        urgent_criteria = prefs.urgent_criteria if prefs and prefs.urgent_criteria else ""
+        high_priority_criteria = prefs.high_priority_criteria if prefs and prefs.high_priority_criteria else ""
+        if not (urgent_criteria or high_priority_criteria):
+            return ""
+        return (
             "\n\nUser preferences for classification:\n"
             f"- Urgent criteria: {urgent_criteria}\n"
             f"- High priority criteria: {high_priority_criteria}\n"
             "Use these preferences to improve your classification."
         )
 
-    messages = [
-        SystemMessage(content=system_message),
-        HumanMessage(content=f"Classify this email:\n\n{state['email_body']}")
-    ]
+    def _load(self, user_id: str) -> dict:
+        prefs = UserPreferences.query.filter_by(user_id=user_id).first()
+        entry = {
+            "version": prefs.version if prefs else None,
+            "fragment": self._render_fragment(prefs),
+            "messages": {}
+        }
+        with self._lock:
+            self._entries[user_id] = entry
+            self.loads += 1
+        return entry
 
-    response = vanilla_model.invoke(messages)
-    classification = response.content.strip()
-    
-    if "email_tag" not in state or state["email_tag"] is None:
-        state["email_tag"] = []
-    state["email_tag"].append(classification)
-    print(f"📧 Classified email as: {classification}")
-    return state
+    def classification_system_message(self, user_id: str, output_instruction: str) -> str:
+        self._check_version_file()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self.hits += 1
+        if entry is None:
+            entry = self._load(user_id)
+        message = entry["messages"].get(output_instruction)
+        if message is None:
+            message = (
+                "You are a helpful assistant that classifies emails based on their content. "
+                "Classify the email into one of these categories: 'urgent', 'high_priority', "
+                f"'low_priority', 'spam', or 'other'. {output_instruction}"
+            ) + entry["fragment"]
+            entry["messages"][output_instruction] = message
+        return message
 
-def get_calendar_service():
-    creds = None
-    if os.path.exists('token.pkl'):
-        with open('token.pkl', 'rb') as token:
-            creds = pickle.load(token)
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-        creds = flow.run_local_server(port=0)
-        with open('token.pkl', 'wb') as token:
-            pickle.dump(creds, token)
-    return build('calendar', 'v3', credentials=creds)
+    def invalidate(self, user_id: str, version: int):
+        """Drop the cached entry and publish the new version to other processes"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            versions = self._read_versions()
+            versions[user_id] = version
+            tmp_path = f"{self.version_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(versions, f)
+            os.replace(tmp_path, self.version_path)
 
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"cached_users": len(self._entries), "hits": self.hits, "loads": self.loads}
 
-@tool
-def create_calendar_event(
-    meeting: str,
-    time_description: Optional[str] = None,
-    attendees: Optional[List[str]] = None,
-    sender_email: Optional[str] = None,
-) -> dict:
-    """Create a Google Calendar event with optional time and attendees.
+preferences_cache = PreferencesCache(PREFERENCES_VERSION_PATH)
 
-    Args:
-        meeting (str): Description of the meeting.
-        time_description (Optional[str]): Time like 'tomorrow at 5pm'.
-        attendees (Optional[List[str]]): Attendee email list.
-        sender_email (Optional[str]): Email of the sender (to be added as an attendee).
+def build_classification_system_message(output_instruction: str = "Just return the tag.") -> str:
+    return preferences_cache.classification_system_message("default_user", output_instruction)
 
-    Returns:
-        dict: Summary, event ID, event link, and meet link.
-    """
-    service = get_calendar_service()
-    tz = pytz.timezone("Asia/Kolkata")
+RULE_FIELDS = ("from", "to", "subject")
 
-    print(f"Creating calendar event for meeting: {meeting}")
-    print(f"Time description: {time_description}")
-    print(f"Attendees: {attendees}")
-    print(f"Sender email: {sender_email}")
+class RuleEngine:
+    """Compiled per-user classification rules, checked before the LLM classifier."""
 
-    if time_description:
-        start_time = dateparser.parse(
-            time_description,
-            settings={
-                "TIMEZONE": "Asia/Kolkata",
-                "RETURN_AS_TIMEZONE_AWARE": True,
-                "TO_TIMEZONE": "Asia/Kolkata",
-                "PREFER_DATES_FROM": "future"
-            }
-        )
-    if not start_time:
-        raise ValueError(f"Invalid time format: {time_description}")
+    def __init__(self, confidence_threshold: float, cache_seconds: int):
+        self.confidence_threshold = confidence_threshold
+        self.cache_seconds = cache_seconds
+        self._lock = threading.Lock()
+        self._compiled: Dict[str, tuple[float, list]] = {}  # user_id -> (loaded at, rules)
+        self.evaluations = 0
+        self.matches = 0
+        self.llm_calls_saved = 0
+        self.rule_hits: Dict[int, int] = {}
 
-    print(f"Parsed start time: {start_time}")
+    @staticmethod
+    def validate(field: str, pattern: str):
+        if field not in RULE_FIELDS and not (field.startswith("header:") and len(field) > 7):
+            raise ValueError(f"Unknown rule field: {field}")
+        re.compile(pattern)
 
-    end_time = start_time + dt.timedelta(hours=1)
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._compiled.pop(user_id, None)
 
-    attendees = set(attendees or [])
-    if sender_email:
-        attendees.add(sender_email)
+    def _rules_for(self, user_id: str) -> list:
+        with self._lock:
+            cached = self._compiled.get(user_id)
+        if cached and time.monotonic() - cached[0] < self.cache_seconds:
+            return cached[1]
+        rows = ClassificationRule.query.filter_by(user_id=user_id, enabled=True).order_by(
+            ClassificationRule.position, ClassificationRule.id
+        ).all()
+        rules = []
+        for rule in rows:
+            try:
+                rules.append((rule.id, rule.field.lower(), re.compile(rule.pattern, re.I), rule.tag, rule.confidence))
+            except re.error as e:
+                print(f"❌ Skipping rule {rule.id} with invalid pattern: {e}")
+        with self._lock:
+            self._compiled[user_id] = (time.monotonic(), rules)
+        return rules
 
-    event = {
-        'summary': meeting,
-        'start': {
-            'dateTime': start_time.isoformat(),
-        },
-        'end': {
-            'dateTime': end_time.isoformat(),
-        },
-        'attendees': [{'email': email} for email in attendees],
-        'conferenceData': {
-            'createRequest': {
-                'requestId': f"meet-{dt.datetime.now().timestamp()}",
-                'conferenceSolutionKey': {
-                    'type': 'hangoutsMeet'
-                },
+    def match(self, user_id: str, state: AgentState) -> Optional[tuple[str, float]]:
+        """Return (tag, confidence) of the first matching rule, if any"""
+        values = {
+            "from": state.get("email_from") or "",
+            "to": state.get("email_to") or "",
+            "subject": state.get("email_subject") or ""
+        }
+        headers = state.get("email_headers") or {}
+        result = None
+        for rule_id, field, regex, tag, confidence in self._rules_for(user_id):
+            if field.startswith("header:"):
+                value = headers.get(field[7:])
+                if value is None:
+                    continue
+            else:
+                value = values[field]
+            if regex.search(value):
+                result = (rule_id, tag, confidence)
+                break
+        with self._lock:
+            self.evaluations += 1
+            if result:
+                self.matches += 1
+                self.rule_hits[result[0]] = self.rule_hits.get(result[0], 0) + 1
+                if result[2] >= self.confidence_threshold:
+                    self.llm_calls_saved += 1
+        return result[1:] if result else None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "evaluations": self.evaluations,
+                "matches": self.matches,
+                "hit_rate": self.matches / self.evaluations if self.evaluations else 0.0,
+                "llm_calls_saved": self.llm_calls_saved,
+                "rule_hits": dict(self.rule_hits)
             }
-        },
-    }
 
-    created_event = service.events().insert(
-        calendarId='primary',
-        body=event,
-        conferenceDataVersion=1
-    ).execute()
+rule_engine = RuleEngine(RULE_CONFIDENCE_THRESHOLD, RULE_CACHE_SECONDS)
 
-    print(f"✅ Created calendar event: {created_event.get('htmlLink')}")
-    print("Start time (ISO):", created_event['start']['dateTime'])
-    print("End time (ISO):", created_event['end']['dateTime'])
+def match_classification_rule(state: AgentState) -> Optional[str]:
+    if "rule_tag" in state:
+        return state["rule_tag"]
+    rule_match = rule_engine.match("default_user", state)
+    if rule_match and rule_match[1] >= rule_engine.confidence_threshold:
+        print(f"📧 Classified email as: {rule_match[0]} (rule)")
+        return rule_match[0]
+    return None
 
+# Sender priority headers (lower-cased names) and the leading values marking an email urgent
+URGENT_PRIORITY_HEADERS = {"importance": {"high"}, "x-priority": {"1", "2"}, "priority": {"urgent"}}
 
-    return {
-        "event_summary": meeting,
-        "event_id": created_event.get("id"),
-        "event_link": created_event.get("htmlLink"),
-        "event_attendees": list(attendees),
-        "event_start": created_event['start']['dateTime'],
-        "event_end": created_event['end']['dateTime'],
-        "event_meet_link": created_event.get('conferenceData', {}).get('entryPoints', [{}])[0].get('uri'),
-        "event_calendar_link": created_event.get('htmlLink')
-    }
+def is_marked_urgent(state: AgentState) -> bool:
+    headers = state.get("email_headers") or {}
+    for name, values in URGENT_PRIORITY_HEADERS.items():
+        value = str(headers.get(name) or "").strip().lower()
+        if value and value.split()[0] in values:
+            return True
+    return False
 
-@tool
-def create_jira_ticket(issue: str) -> dict:
-    """Create a JIRA ticket for the given issue."""
-    url = f"https://{JIRA_DOMAIN}/rest/api/3/issue"
-    auth = (JIRA_EMAIL, JIRA_API_TOKEN)
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
+def route_email(inputs: AgentState, lane: str) -> AgentState:
+    """Match the classification rules once, before the graph runs, and put the email in the
+    urgent lane when a rule tags it urgent or the sender marks it high priority. The graph
+    branches run in parallel, so the nodes cannot wait for the classifier's tag."""
+    inputs["rule_tag"] = match_classification_rule(inputs)
+    inputs["llm_lane"] = "urgent" if inputs["rule_tag"] == "urgent" or is_marked_urgent(inputs) else lane
+    return inputs
 
-    payload = {
+def classify_email(state: AgentState) -> AgentState:
+    rule_tag = match_classification_rule(state)
+    if rule_tag:
+        return {"email_tag": [rule_tag]}
+
+    if classification_batcher:
+        classification = classification_batcher.classify(state['email_body'])
+    else:
+        classification = classify_single_email(build_classification_system_message(), state['email_body'])
+    
+    print(f"📧 Classified email as: {classification}")
+    return {"email_tag": [classification]}
+
+async def aclassify_email(state: AgentState) -> AgentState:
+    # Rules and preferences may need a database read, which must not block the loop
+    rule_tag = await asyncio.to_thread(match_classification_rule, state)
+    if rule_tag:
+        return {"email_tag": [rule_tag]}
+
+    if classification_batcher:
+        classification = await classification_batcher.aclassify(state['email_body'])
+    else:
+        system_message = await asyncio.to_thread(build_classification_system_message)
+        response = await vanilla_model.ainvoke(_classification_messages(system_message, state['email_body']))
+        classification = response.content.strip()
+
+    print(f"📧 Classified email as: {classification}")
+    return {"email_tag": [classification]}
+
+def _classification_messages(system_message: str, email_body: str) -> list[BaseMessage]:
+    return [
+        SystemMessage(content=system_message),
+        HumanMessage(content=f"Classify this email:\n\n{email_body}")
+    ]
+
+def classify_single_email(system_message: str, email_body: str, config: Optional[dict] = None) -> str:
+    response = vanilla_model.invoke(_classification_messages(system_message, email_body), config=config)
+    return response.content.strip()
+
+class PipelineTrace(BaseCallbackHandler):
+    """Callback handler timing one pipeline run.
+
+    Records a span for every graph node, chat model call and tool call, observes
+    the matching Prometheus metrics, and counts tokens and LLM cache hits. Calls
+    made outside the graph (the classification batcher) pass a trace without an
+    email id, which feeds the metrics only.
+    """
+    run_inline = True
+
+    def __init__(self, email_id: Optional[int] = None, queue_wait: Optional[float] = None, node: str = "none"):
+        self.email_id = email_id
+        self.queue_wait = queue_wait
+        self.default_node = node
+        self.mode = None
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._open = {}  # run id -> (kind, name, node, start)
+        self.spans = []
+        self.llm_calls = 0
+        self.cache_hits = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def _start(self, run_id, kind: str, name: str, metadata: Optional[dict]):
+        node = (metadata or {}).get("langgraph_node", self.default_node)
+        with self._lock:
+            self._open[run_id] = (kind, name, node, time.perf_counter())
+
+    def _end(self, run_id, error: Optional[BaseException] = None, **details) -> Optional[tuple]:
+        now = time.perf_counter()
+        with self._lock:
+            opened = self._open.pop(run_id, None)
+            if opened is None:
+                return None
+            kind, name, node, start = opened
+            span = {
+                "kind": kind, "name": name, "node": node,
+                "start_ms": round((start - self._started) * 1000, 1),
+                "duration_ms": round((now - start) * 1000, 1),
+                **details
+            }
+            if error is not None:
+                span["error"] = f"{type(error).__name__}: {error}"[:500]
+            if self.email_id is not None:
+                self.spans.append(span)
+        return kind, name, node, now - start
+
+    def on_chain_start(self, serialized, inputs, *, run_id, tags=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # A node's own run carries the graph:step tag; runnables inside it do not
+        if node and kwargs.get("name") == node and any(tag.startswith("graph:step:") for tag in tags or []):
+            self._start(run_id, "node", node, metadata)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        ended = self._end(run_id)
+        if ended:
+            NODE_LATENCY.labels(ended[1]).observe(ended[3])
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        ended = self._end(run_id, error)
+        if ended:
+            NODE_LATENCY.labels(ended[1]).observe(ended[3])
+            NODE_ERRORS.labels(ended[1]).inc()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, "llm", (metadata or {}).get("ls_model_name") or "chat_model", metadata)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        message = getattr(response.generations[0][0], "message", None) if response.generations and response.generations[0] else None
+        usage = getattr(message, "usage_metadata", None) or {}
+        cached = bool(message is not None and message.response_metadata.get("cache_hit"))
+        input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        ended = self._end(run_id, input_tokens=input_tokens, output_tokens=output_tokens, cached=cached)
+        if not ended:
+            return
+        node = ended[2]
+        with self._lock:
+            self.llm_calls += 1
+            if cached:
+                self.cache_hits += 1
+            else:
+                self.input_tokens += input_tokens
+                self.output_tokens += output_tokens
+        if not cached:
+            LLM_LATENCY.labels(node).observe(ended[3])
+            LLM_TOKENS.labels(node, "input").inc(input_tokens)
+            LLM_TOKENS.labels(node, "output").inc(output_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        ended = self._end(run_id, error)
+        if ended:
+            LLM_ERRORS.labels(ended[2]).inc()
+
+    def on_tool_start(self, serialized, input_str, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, "tool", (serialized or {}).get("name") or kwargs.get("name") or "tool", metadata)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        ended = self._end(run_id)
+        if ended:
+            TOOL_LATENCY.labels(ended[1]).observe(ended[3])
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        ended = self._end(run_id, error)
+        if ended:
+            TOOL_LATENCY.labels(ended[1]).observe(ended[3])
+            TOOL_ERRORS.labels(ended[1]).inc()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def summary(self) -> str:
+        with self._lock:
+            nodes = [span for span in self.spans if span["kind"] == "node"]
+        slowest = max(nodes, key=lambda span: span["duration_ms"], default=None)
+        return (
+            f"{self.elapsed():.2f}s, {self.llm_calls} LLM calls ({self.cache_hits} cached), "
+            f"{self.input_tokens}/{self.output_tokens} tokens"
+            + (f", slowest node {slowest['name']} {slowest['duration_ms'] / 1000:.2f}s" if slowest else "")
+        )
+
+def save_email_trace(trace: PipelineTrace, outcome: str, error: Optional[str] = None):
+    """Store the trace of one processing attempt and observe its end-to-end latency"""
+    elapsed = trace.elapsed()
+    EMAIL_PROCESSING.labels(trace.mode or "none", outcome).observe(elapsed)
+    with trace._lock:
+        spans = sorted(trace.spans, key=lambda span: span["start_ms"])
+    db.session.add(EmailTrace(
+        email_id=trace.email_id,
+        mode=trace.mode,
+        outcome=outcome,
+        started_at=trace.started_at,
+        queue_wait_ms=trace.queue_wait * 1000 if trace.queue_wait is not None else None,
+        duration_ms=elapsed * 1000,
+        llm_calls=trace.llm_calls,
+        cache_hits=trace.cache_hits,
+        input_tokens=trace.input_tokens,
+        output_tokens=trace.output_tokens,
+        error=error,
+        spans=spans
+    ))
+    if next(_trace_writes) % 100 == 0:
+        EmailTrace.query.filter(
+            EmailTrace.started_at < datetime.now(timezone.utc) - dt.timedelta(days=EMAIL_TRACE_RETENTION_DAYS)
+        ).delete(synchronize_session=False)
+    db.session.commit()
+
+_trace_writes = itertools.count(1)
+
+# Batched classification calls run outside the graph: they feed the metrics, not per-email traces
+BATCHER_TRACE_CONFIG = {"callbacks": [PipelineTrace(node="classify_email")]}
+
+class ClassificationBatcher:
+    """Collects concurrent classification requests and sends them as one prompt.
+
+    Requests are grouped by their system prompt, so emails classified against
+    different preferences never share a batch. An email arriving while no other
+    classification is in flight is sent at once, so a lone email never waits. Otherwise
+    a batch is sent when it is full or its window has passed. Emails missing from a
+    malformed or partial response are classified one by one.
+    """
+
+    def __init__(self, window_ms: int, max_size: int):
+        self.window_seconds = window_ms / 1000
+        self.max_size = max(1, max_size)
+        self._cond = threading.Condition()
+        self._batches: Dict[str, list] = {}  # batch system message -> [(body, single system message, future, lane)]
+        self._deadlines: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="classify-batch")
+        self._dispatcher = None
+        self._in_flight = 0
+        self.batches_sent = 0
+        self.emails_batched = 0
+        self.single_calls = 0
+        self.fallbacks = 0
+
+    def classify(self, email_body: str) -> str:
+        return self._submit(email_body).result()
+
+    async def aclassify(self, email_body: str) -> str:
+        future = await asyncio.to_thread(self._submit, email_body)
+        return await asyncio.wrap_future(future)
+
+    def _submit(self, email_body: str) -> Future:
+        single_system_message = build_classification_system_message()
+        system_message = build_classification_system_message(
+            "Several emails are given, each starting with 'Email ID: <id>'. "
+            "Return only a JSON object mapping each email ID to its tag."
+        )
+        future = Future()
+        with self._cond:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_loop, name="classify-batcher", daemon=True)
+                self._dispatcher.start()
+            idle = self._in_flight == 0
+            self._in_flight += 1
+            batch = self._batches.setdefault(system_message, [])
+            batch.append((email_body, single_system_message, future, llm_lane.get()))
+            if len(batch) == 1:
+                self._deadlines[system_message] = time.monotonic() + (0 if idle else self.window_seconds)
+            if len(batch) >= self.max_size:
+                self._deadlines[system_message] = 0
+            self._cond.notify()
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self._cond:
+            self._in_flight -= 1
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while not self._deadlines:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [key for key, deadline in self._deadlines.items() if deadline <= now]
+                if not due:
+                    self._cond.wait(min(self._deadlines.values()) - now)
+                    continue
+                ready = []
+                for key in due:
+                    del self._deadlines[key]
+                    ready.append((key, self._batches.pop(key)))
+            for system_message, batch in ready:
+                self._executor.submit(self._send, system_message, batch)
+
+    def _send(self, system_message: str, batch: list):
+        # The batch is sent in the most urgent lane of its emails
+        token = llm_lane.set(min((item[3] for item in batch), key=LLM_LANES.index))
+        try:
+            self._send_batch(system_message, batch)
+        finally:
+            llm_lane.reset(token)
+
+    def _send_batch(self, system_message: str, batch: list):
+        if len(batch) == 1:
+            self._classify_one(batch[0])
+            return
+        ids = [str(index) for index in range(1, len(batch) + 1)]
+        emails = "\n\n---\n\n".join(
+            f"Email ID: {email_id}\n{item[0]}" for email_id, item in zip(ids, batch)
+        )
+        try:
+            response = vanilla_model.invoke([
+                SystemMessage(content=system_message),
+                HumanMessage(content=f"Classify these emails:\n\n{emails}")
+            ], config=BATCHER_TRACE_CONFIG)
+            tags = parse_json_response(response.content)
+            if not isinstance(tags, dict):
+                raise ValueError("Batch classification did not return a JSON object")
+        except Exception as e:
+            print(f"❌ Batch classification failed, classifying {len(batch)} emails individually: {e}")
+            tags = {}
+        with self._cond:
+            self.batches_sent += 1
+            self.emails_batched += len(batch)
+        for email_id, item in zip(ids, batch):
+            tag = tags.get(email_id)
+            if isinstance(tag, str) and tag.strip() in CLASSIFICATION_TAGS:
+                item[2].set_result(tag.strip())
+            else:
+                with self._cond:
+                    self.fallbacks += 1
+                self._classify_one(item)
+
+    def _classify_one(self, item: tuple):
+        body, system_message, future, lane = item
+        with self._cond:
+            self.single_calls += 1
+        token = llm_lane.set(lane)
+        try:
+            future.set_result(classify_single_email(system_message, body, BATCHER_TRACE_CONFIG))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            llm_lane.reset(token)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "window_ms": int(self.window_seconds * 1000),
+                "max_size": self.max_size,
+                "batches_sent": self.batches_sent,
+                "emails_batched": self.emails_batched,
+                "average_batch_size": self.emails_batched / self.batches_sent if self.batches_sent else 0.0,
+                "single_calls": self.single_calls,
+                "fallbacks": self.fallbacks
+            }
+
+classification_batcher = ClassificationBatcher(CLASSIFY_BATCH_WINDOW_MS, CLASSIFY_BATCH_MAX_SIZE) if CLASSIFY_BATCH_WINDOW_MS > 0 else None
+
+class CalendarClient:
+    """Process-wide Google Calendar client.
+
+    Credentials are loaded once and refreshed by a background thread before they
+    expire. The service object is built once from the discovery document bundled
+    with googleapiclient; since httplib2 connections are not thread-safe, each
+    thread executes requests over its own authorized connection. Concurrent event
+    inserts are grouped into Calendar batch requests.
+    """
+
+    def __init__(self, token_path: str, credentials_path: str, refresh_margin_seconds: int,
+                 batch_window_ms: int, batch_max_size: int, api_base: Optional[str] = None):
+        self.token_path = token_path
+        self.api_base = api_base
+        self.credentials_path = credentials_path
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.batch_window_seconds = batch_window_ms / 1000
+        self.batch_max_size = min(max(1, batch_max_size), 50)  # Calendar allows 50 calls per batch
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._credentials = None
+        self._service = None
+        self._refresher = None
+        self._cond = threading.Condition()
+        self._pending = []  # [(event, future)]
+        self._deadline = None
+        self._dispatcher = None
+        self.refreshes = 0
+        self.events_inserted = 0
+        self.batches_sent = 0
+
+    def _save_credentials(self, creds):
+        tmp_path = f"{self.token_path}.tmp"
+        with open(tmp_path, 'wb') as token:
+            pickle.dump(creds, token)
+        os.replace(tmp_path, self.token_path)
+
+    def _load_credentials(self):
+        if os.path.exists(self.token_path):
+            with open(self.token_path, 'rb') as token:
+                creds = pickle.load(token)
+        else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path, SCOPES)
+            creds = flow.run_local_server(port=0)
+            self._save_credentials(creds)
+        if not creds.valid and creds.refresh_token:
+            self._refresh(creds)
+        return creds
+
+    def _refresh(self, creds):
+        from google.auth.transport.requests import Request as GoogleAuthRequest
+        creds.refresh(GoogleAuthRequest())
+        self._save_credentials(creds)
+        self.refreshes += 1
+        print("🔑 Refreshed Google Calendar credentials")
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                expiry = self._credentials.expiry
+            if expiry is None:
+                return
+            # google-auth stores expiry as naive UTC
+            wait = (expiry - datetime.utcnow()).total_seconds() - self.refresh_margin_seconds
+            time.sleep(max(wait, 5))
+            try:
+                with self._lock:
+                    self._refresh(self._credentials)
+            except Exception as e:
+                print(f"❌ Failed to refresh Google Calendar credentials: {e}")
+                time.sleep(60)
+
+    @property
+    def service(self):
+        with self._lock:
+            if self._service is None:
+                from googleapiclient.discovery import build
+                self._credentials = self._load_credentials()
+                client_options = {"api_endpoint": f"{self.api_base.rstrip('/')}/calendar/v3/"} if self.api_base else None
+                self._service = build('calendar', 'v3', credentials=self._credentials,
+                                      static_discovery=True, cache_discovery=False, client_options=client_options)
+                if self._credentials.refresh_token:
+                    self._refresher = threading.Thread(target=self._refresh_loop, name="calendar-refresh", daemon=True)
+                    self._refresher.start()
+            return self._service
+
+    def warm_up(self):
+        """Build the service ahead of the first event. Skipped without saved credentials,
+        since the interactive OAuth flow must only run on demand."""
+        if os.path.exists(self.token_path):
+            self.service
+
+    def _http(self):
+        """Authorized connection owned by the calling thread"""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import google_auth_httplib2
+            import httplib2
+            http = google_auth_httplib2.AuthorizedHttp(
+                self._credentials, http=httplib2.Http(timeout=INTEGRATION_READ_TIMEOUT)
+            )
+            self._local.http = http
+        return http
+
+    def _insert_request(self, event: dict):
+        return self.service.events().insert(calendarId='primary', body=event, conferenceDataVersion=1)
+
+    def insert_event(self, event: dict) -> dict:
+        if self.batch_window_seconds <= 0:
+            started = time.perf_counter()
+            created_event = self._insert_request(event).execute(http=self._http())
+            INTEGRATION_LATENCY.labels('calendar', 'single').observe(time.perf_counter() - started)
+            with self._lock:
+                self.events_inserted += 1
+            return created_event
+        return self._submit(event).result()
+
+    def insert_events(self, events: List[dict]) -> List:
+        """Insert several events in one batch request; failed inserts are returned as exceptions"""
+        results = [None] * len(events)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = exception if exception is not None else response
+
+        service = self.service
+        if self.api_base:
+            from googleapiclient.http import BatchHttpRequest
+            batch = BatchHttpRequest(callback=callback, batch_uri=f"{self.api_base.rstrip('/')}/batch/calendar/v3")
+        else:
+            batch = service.new_batch_http_request(callback=callback)
+        for index, event in enumerate(events):
+            batch.add(self._insert_request(event), request_id=str(index))
+        started = time.perf_counter()
+        try:
+            batch.execute(http=self._http())
+        except Exception as e:
+            INTEGRATION_LATENCY.labels('calendar', type(e).__name__).observe(time.perf_counter() - started)
+            raise
+        INTEGRATION_LATENCY.labels('calendar', 'batch').observe(time.perf_counter() - started)
+        with self._lock:
+            self.batches_sent += 1
+            self.events_inserted += sum(1 for result in results if isinstance(result, dict))
+        return results
+
+    def _submit(self, event: dict) -> Future:
+        future = Future()
+        with self._cond:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_loop, name="calendar-batcher", daemon=True)
+                self._dispatcher.start()
+            self._pending.append((event, future))
+            if len(self._pending) == 1:
+                self._deadline = time.monotonic() + self.batch_window_seconds
+            if len(self._pending) >= self.batch_max_size:
+                self._deadline = 0
+            self._cond.notify()
+        return future
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while self._deadline is None:
+                    self._cond.wait()
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                pending, self._pending, self._deadline = self._pending, [], None
+            self._send(pending)
+
+    def _send(self, pending: list):
+        try:
+            results = self.insert_events([event for event, _ in pending])
+        except Exception as e:
+            results = [e] * len(pending)
+        for (_, future), result in zip(pending, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "connected": self._service is not None,
+                "credentials_expiry": self._credentials.expiry.isoformat() if self._credentials and self._credentials.expiry else None,
+                "refreshes": self.refreshes,
+                "events_inserted": self.events_inserted,
+                "batches_sent": self.batches_sent,
+                "batch_window_ms": int(self.batch_window_seconds * 1000)
+            }
+
+calendar_client = CalendarClient(
+    GOOGLE_TOKEN_PATH, GOOGLE_CREDENTIALS_PATH, CALENDAR_REFRESH_MARGIN_SECONDS,
+    CALENDAR_BATCH_WINDOW_MS, CALENDAR_BATCH_MAX_SIZE, CALENDAR_API_BASE
+)
+
+
+# Sync only: under ainvoke, LangChain runs the blocking Google client in an executor thread.
+@tool
+def create_calendar_event(
+    meeting: str,
+    time_description: Optional[str] = None,
+    attendees: Optional[List[str]] = None,
+    sender_email: Optional[str] = None,
+) -> dict:
+    """Create a Google Calendar event with optional time and attendees.
+
+    Args:
+        meeting (str): Description of the meeting.
+        time_description (Optional[str]): Time like 'tomorrow at 5pm'.
+        attendees (Optional[List[str]]): Attendee email list.
+        sender_email (Optional[str]): Email of the sender (to be added as an attendee).
+
+    Returns:
+        dict: Summary, event ID, event link, and meet link.
+    """
+    tz = pytz.timezone("Asia/Kolkata")
+
+    key = side_effect_key("create_calendar_event")
+    completed = completed_side_effect(key)
+    if completed:
+        print(f"⏭️ Calendar event was created by an earlier attempt: {completed.get('event_link')}")
+        return completed
+
+    print(f"Creating calendar event for meeting: {meeting}")
+    print(f"Time description: {time_description}")
+    print(f"Attendees: {attendees}")
+    print(f"Sender email: {sender_email}")
+
+    if time_description:
+        import dateparser
+        start_time = dateparser.parse(
+            time_description,
+            settings={
+                "TIMEZONE": "Asia/Kolkata",
+                "RETURN_AS_TIMEZONE_AWARE": True,
+                "TO_TIMEZONE": "Asia/Kolkata",
+                "PREFER_DATES_FROM": "future"
+            }
+        )
+    if not start_time:
+        raise ValueError(f"Invalid time format: {time_description}")
+
+    print(f"Parsed start time: {start_time}")
+
+    end_time = start_time + dt.timedelta(hours=1)
+
+    attendees = set(attendees or [])
+    if sender_email:
+        attendees.add(sender_email)
+
+    event = {
+        'summary': meeting,
+        'start': {
+            'dateTime': start_time.isoformat(),
+        },
+        'end': {
+            'dateTime': end_time.isoformat(),
+        },
+        'attendees': [{'email': email} for email in attendees],
+        'conferenceData': {
+            'createRequest': {
+                # Deterministic per email and call, so a repeated insert reuses the conference
+                'requestId': f"minimalizemail-{current_email_id.get()}-{key}" if key else uuid.uuid4().hex,
+                'conferenceSolutionKey': {
+                    'type': 'hangoutsMeet'
+                },
+            }
+        },
+    }
+
+    created_event = calendar_client.insert_event(event)
+
+    print(f"✅ Created calendar event: {created_event.get('htmlLink')}")
+    print("Start time (ISO):", created_event['start']['dateTime'])
+    print("End time (ISO):", created_event['end']['dateTime'])
+
+
+    result = {
+        "event_summary": meeting,
+        "event_id": created_event.get("id"),
+        "event_link": created_event.get("htmlLink"),
+        "event_attendees": list(attendees),
+        "event_start": created_event['start']['dateTime'],
+        "event_end": created_event['end']['dateTime'],
+        "event_meet_link": created_event.get('conferenceData', {}).get('entryPoints', [{}])[0].get('uri'),
+        "event_calendar_link": created_event.get('htmlLink')
+    }
+    record_side_effect(key, result)
+    return result
+
+# Each ticket carries a label keyed on its email id and the ordinal of the tool call. Before
+# creating a ticket, and after an ambiguous failure, JIRA is searched for the label, so a
+# retried email finds the ticket its earlier attempt opened, in any process. Calls outside
+# the job queue have no email to key on and get a random label.
+def _jira_idempotency_label() -> tuple[str, bool]:
+    """The label of the next ticket, and whether an earlier attempt may have used it"""
+    ordinal = tool_call_ordinal("create_jira_ticket")
+    if ordinal is None:
+        return f"minimalizemail-{uuid.uuid4().hex}", False
+    return f"minimalizemail-email-{current_email_id.get()}-{ordinal}", True
+
+def _jira_payload(issue: str, label: str) -> dict:
+    return {
         "fields": {
             "project": {"key": JIRA_PROJECT_KEY},
             "summary": issue,
@@ -307,356 +2119,2412 @@ def create_jira_ticket(issue: str) -> dict:
                     }
                 ]
             },
-            "issuetype": {"name": "Task"}
+            "issuetype": {"name": "Task"},
+            "labels": [label]
         }
     }
 
-    response = requests.post(url, json=payload, headers=headers, auth=auth)
+def _jira_ticket(issue_key: str) -> dict:
+    ticket_url = f"{JIRA_BASE_URL}/browse/{issue_key}"
+    return {"ticket_id": issue_key, "ticket_url": ticket_url}
 
-    if response.status_code == 201:
-        issue_key = response.json()["key"]
-        print(f"✅ Created JIRA ticket: {issue_key}")
-        ticket_url = f"https://{JIRA_DOMAIN}/browse/{issue_key}"
-        return {"ticket_id": issue_key, "ticket_url": ticket_url}
-    else:
-        return {"error": "Failed to create issue"}
+def _jira_search_params(label: str) -> dict:
+    return {"jql": f'labels = "{label}"', "fields": "key", "maxResults": 1}
+
+def _jira_found(response: httpx.Response) -> Optional[dict]:
+    if response.status_code != 200:
+        return None
+    issues = response.json().get("issues") or []
+    return _jira_ticket(issues[0]["key"]) if issues else None
+
+def _jira_result(response: Optional[httpx.Response], recovered: Optional[dict]) -> dict:
+    if recovered:
+        print(f"✅ Found existing JIRA ticket after retry: {recovered['ticket_id']}")
+        return recovered
+    if response is not None and response.status_code == 201:
+        ticket = _jira_ticket(response.json()["key"])
+        print(f"✅ Created JIRA ticket: {ticket['ticket_id']}")
+        return ticket
+    return {"error": "Failed to create issue"}
+
+def _report_existing_ticket(ticket: dict) -> dict:
+    print(f"✅ Found JIRA ticket of an earlier attempt: {ticket['ticket_id']}")
+    return ticket
+
+def _create_jira_ticket(issue: str) -> dict:
+    """Create a JIRA ticket for the given issue."""
+    label, maybe_exists = _jira_idempotency_label()
+    if maybe_exists:
+        existing = _jira_found(jira_client.request("GET", "/rest/api/3/search", params=_jira_search_params(label)))
+        if existing:
+            return _report_existing_ticket(existing)
+    recovered = {}
+
+    def recover() -> bool:
+        # The create may have succeeded before the failure: look for the labelled ticket
+        found = _jira_found(jira_client.request("GET", "/rest/api/3/search", params=_jira_search_params(label)))
+        recovered.update(found or {})
+        return bool(found)
+
+    response = jira_client.request("POST", "/rest/api/3/issue", json=_jira_payload(issue, label), recover=recover)
+    return _jira_result(response, recovered)
+
+async def _acreate_jira_ticket(issue: str) -> dict:
+    """Create a JIRA ticket for the given issue."""
+    label, maybe_exists = _jira_idempotency_label()
+    if maybe_exists:
+        response = await jira_client.arequest("GET", "/rest/api/3/search", params=_jira_search_params(label))
+        existing = _jira_found(response)
+        if existing:
+            return _report_existing_ticket(existing)
+    recovered = {}
+
+    async def recover() -> bool:
+        response = await jira_client.arequest("GET", "/rest/api/3/search", params=_jira_search_params(label))
+        found = _jira_found(response)
+        recovered.update(found or {})
+        return bool(found)
+
+    response = await jira_client.arequest("POST", "/rest/api/3/issue", json=_jira_payload(issue, label), recover=recover)
+    return _jira_result(response, recovered)
+
+create_jira_ticket = StructuredTool.from_function(
+    func=_create_jira_ticket,
+    coroutine=_acreate_jira_ticket,
+    name="create_jira_ticket"
+)
 
 def store_tool_outputs(state: AgentState) -> AgentState:
+    update: AgentState = {"email_tag": []}
     for msg in reversed(state.get("messages", [])):
         if isinstance(msg, ToolMessage):
             try:
                 content_dict = json.loads(msg.content)
                 if "ticket_id" in content_dict:
-                    state["ticket_id"] = content_dict["ticket_id"]
-                    state["ticket_url"] = content_dict.get("ticket_url", "")
-                    if "email_tag" not in state:
-                        state["email_tag"] = []
-                    state["email_tag"].append("issue")
+                    update["ticket_id"] = content_dict["ticket_id"]
+                    update["ticket_url"] = content_dict.get("ticket_url", "")
+                    update["email_tag"].append("issue")
                 if "event_summary" in content_dict:
-                    state["event_summary"] = content_dict["event_summary"]
+                    update["event_summary"] = content_dict["event_summary"]
                     if state.get("email_from") not in content_dict.get("event_attendees", []):
-                        if state.get("event_attendees") is None:
-                            state["event_attendees"] = []
-                        state["event_attendees"].append(state.get("email_from", ""))
-                    state["event_start"] = content_dict.get("event_start")
-                    state["event_end"] = content_dict.get("event_end")
-                    state["event_meet_link"] = content_dict.get("event_meet_link")
-                    state["event_calendar_link"] = content_dict.get("event_calendar_link")
-                    if "email_tag" not in state:
-                        state["email_tag"] = []
-                    state["email_tag"].append("meeting")
+                        update["event_attendees"] = list(state.get("event_attendees") or []) + [state.get("email_from", "")]
+                    update["event_start"] = content_dict.get("event_start")
+                    update["event_end"] = content_dict.get("event_end")
+                    update["event_meet_link"] = content_dict.get("event_meet_link")
+                    update["event_calendar_link"] = content_dict.get("event_calendar_link")
+                    update["email_tag"].append("meeting")
             except Exception as e:
                 print(f"❌ Failed to parse ToolMessage content: {msg.content} | Error: {e}")
-    return state
+    return update
+
+tools = [create_calendar_event, create_jira_ticket]
+model = LazyResource("tool_model", lambda: chat_model(
+    model="gemini-2.0-flash-001",
+    temperature=0.1
+).bind_tools(tools))
+
+def _tool_call_messages(state: AgentState) -> list[BaseMessage]:
+    return [
+        SystemMessage(
+            content="You are a helpful assistant that calls relevant tools based on the email content. "
+                    "If the email talks about a meeting, create a calendar event. If it mentions an issue, create a JIRA ticket."
+        ),
+        HumanMessage(
+            content=f"Email:\nSubject: {state.get('email_subject', '')}\n\n{state['email_body']}"
+        )
+    ]
+
+def _tool_call_update(response: BaseMessage) -> AgentState:
+    update: AgentState = {"messages": [response]}
+    if isinstance(response, AIMessage) and getattr(response, "tool_calls", None):
+        update["tool_call"] = True
+
+    return update
+
+def model_call(state: AgentState) -> AgentState:
+    return _tool_call_update(model.invoke(_tool_call_messages(state)))
+
+async def amodel_call(state: AgentState) -> AgentState:
+    return _tool_call_update(await model.ainvoke(_tool_call_messages(state)))
+
+def _reply_prompt(state: AgentState) -> str:
+    email_subject = state.get("email_subject", "No subject")
+    email_body = state.get("email_body", "No body")
+
+    ticket_id = state.get("ticket_id")
+    meeting_summary = state.get("event_summary")
+    meeting_time = state.get("event_start")
+    meet_link = state.get("event_meet_link")
+
+    ticket_info = f"A JIRA ticket has been created with ID: *{ticket_id}*." if ticket_id else ""
+    meeting_info = (
+        f"A meeting has been scheduled to discuss this:\n"
+        f"- Topic: *{meeting_summary}*\n"
+        f"- Time: {meeting_time}\n"
+        f"- Link: {meet_link}"
+        if meeting_summary and meeting_time and meet_link
+        else ""
+    )
+
+    context_parts = [part for part in [ticket_info, meeting_info] if part]
+    if not context_parts:
+        context_parts = ["We are reviewing your message and will get back to you shortly."]
+
+    context = "\n\n".join(context_parts)
+
+    return (
+        "You're a helpful assistant drafting a professional reply to an email.\n\n"
+        f"Original email:\nSubject: {email_subject}\nBody: {email_body}\n\n"
+        f"Reply to the sender politely, using the following information:\n{context}\n\n"
+        "Respond only with the reply body."
+    )
+
+def _reply_update(response: BaseMessage) -> AgentState:
+    reply = response.content.strip()
+    print(f"✉️ Generated reply: {reply}")
+    return {"email_reply": reply}
+
+def generate_reply(state: AgentState) -> AgentState:
+    return _reply_update(vanilla_model.invoke(_reply_prompt(state)))
+
+async def agenerate_reply(state: AgentState) -> AgentState:
+    return _reply_update(await vanilla_model.ainvoke(_reply_prompt(state)))
+
+def _summary_prompt(state: AgentState) -> str:
+    email_subject = state.get("email_subject", "No subject")
+    email_body = state.get("email_body", "No body")
+    
+    return (
+        "Generate a concise 1-2 sentence summary of this email:\n\n"
+        f"Subject: {email_subject}\n"
+        f"Body: {email_body}\n\n"
+        f"{attachments_prompt(state)}"
+        "Focus on the main action items or key information."
+    )
+
+def _summary_update(response: BaseMessage) -> AgentState:
+    summary = response.content.strip()
+    print(f"📄 Generated summary: {summary}")
+    return {"ai_summary": summary}
+
+def generate_summary(state: AgentState) -> AgentState:
+    """Generate a concise summary of the email"""
+    return _summary_update(vanilla_model.invoke(_summary_prompt(state)))
+
+async def agenerate_summary(state: AgentState) -> AgentState:
+    # Building the prompt may extract attachment text from disk
+    prompt = await asyncio.to_thread(_summary_prompt, state)
+    return _summary_update(await vanilla_model.ainvoke(prompt))
+
+def _tasks_prompt(state: AgentState) -> str:
+    email_body = state.get("email_body", "")
+    email_subject = state.get("email_subject", "No subject")
+    return (
+        "You are a task extraction assistant. Analyze this email and extract any actionable tasks or to-dos.\n"
+        "Return the tasks as a JSON array. Each task should have:\n"
+        "- title: Brief description of the task\n"
+        "- description: Detailed description if needed\n"
+        "- priority: 'high', 'normal', or 'low'\n"
+        "- due_date: If mentioned in the email (in ISO format), otherwise null\n\n"
+        f"Subject: {email_subject}\n"
+        f"Body: {email_body}\n\n"
+        f"{attachments_prompt(state)}"
+        "Examples of tasks to extract:\n"
+        "- 'Please review the document by Friday'\n"
+        "- 'Schedule a meeting with the team'\n"
+        "- 'Send the report to management'\n"
+        "- 'Follow up on the client request'\n\n"
+        "If no actionable tasks are found, return an empty array [].\n"
+        "Respond only with valid JSON."
+    )
+
+def _tasks_update(response: Optional[BaseMessage], error: Optional[Exception] = None) -> AgentState:
+    try:
+        if error:
+            raise error
+        tasks = parse_json_response(response.content)
+        extracted_tasks = tasks if isinstance(tasks, list) else []
+        print(f"📋 Extracted {len(extracted_tasks)} tasks")
+        
+    except Exception as e:
+        print(f"❌ Error extracting tasks: {e}")
+        extracted_tasks = []
+    
+    return {"extracted_tasks": extracted_tasks}
+
+def extract_tasks(state: AgentState) -> AgentState:
+    """Extract tasks from the email body and create Task objects"""
+    try:
+        return _tasks_update(vanilla_model.invoke(_tasks_prompt(state)))
+    except Exception as e:
+        return _tasks_update(None, e)
+
+async def aextract_tasks(state: AgentState) -> AgentState:
+    try:
+        prompt = await asyncio.to_thread(_tasks_prompt, state)
+        return _tasks_update(await vanilla_model.ainvoke(prompt))
+    except Exception as e:
+        return _tasks_update(None, e)
+
+
+def build_email_processor():
+    """The LangGraph pipeline: one LLM call per step"""
+    from langgraph.graph import StateGraph, START, END
+    from langgraph.prebuilt import ToolNode
+
+    tool_node = ToolNode(tools=tools)
+    graph = StateGraph(AgentState)
+
+    graph.add_node("classify_email", graph_node(classify_email, aclassify_email))
+    graph.add_node("send_notification", graph_node(send_telegram_alert, asend_telegram_alert))
+    graph.add_node("model_call", graph_node(without_llm_cache(model_call), without_llm_cache(amodel_call)))
+    graph.add_node("tools", tool_node)
+    graph.add_node("store_tool_outputs", store_tool_outputs)
+    graph.add_node("generate_reply", graph_node(generate_reply, agenerate_reply))
+    graph.add_node("generate_summary", graph_node(generate_summary, agenerate_summary))
+    graph.add_node("extract_tasks", graph_node(extract_tasks, aextract_tasks))
+
+    # Fan out from START: the summary, task extraction, classification and tool-calling
+    # branches only read the email itself. Only the reply waits for the tool outputs.
+    graph.add_edge(START, "classify_email")
+    graph.add_edge(START, "model_call")
+    graph.add_edge(START, "generate_summary")
+    graph.add_edge(START, "extract_tasks")
+    graph.add_conditional_edges("classify_email", priority_check, {
+        "notify": "send_notification",
+        "skip": END
+    })
+    graph.add_edge("send_notification", END)
+    graph.add_conditional_edges(
+        "model_call",
+        lambda state: "tools" if state.get("tool_call") else "generate_reply"
+    )
+    graph.add_edge("tools", "store_tool_outputs")
+    graph.add_edge("store_tool_outputs", "generate_reply")
+    graph.add_edge("generate_reply", END)
+    graph.add_edge("generate_summary", END)
+    graph.add_edge("extract_tasks", END)
+    return graph.compile()
+
+email_processor = LazyResource("email_processor", build_email_processor)
+
+
+class ExtractedTask(BaseModel):
+    title: str = Field(description="Brief description of the task")
+    description: str = Field(default="", description="Detailed description if needed")
+    priority: Literal["high", "normal", "low"] = "normal"
+    due_date: Optional[str] = Field(default=None, description="Due date in ISO format if mentioned")
+
+class EmailAnalysis(BaseModel):
+    """Complete analysis of an email: classification, summary, reply draft and tasks."""
+    tag: Literal["urgent", "high_priority", "low_priority", "spam", "other"]
+    summary: str = Field(description="Concise 1-2 sentence summary focused on action items or key information")
+    reply: str = Field(description="Professional reply body to the sender")
+    tasks: list[ExtractedTask] = Field(default_factory=list, description="Actionable tasks or to-dos, empty if none")
+    alert_message: str = Field(default="", description="Short high-priority alert message, only for urgent emails")
+    mentions_meeting: bool = Field(description="True if the email asks to schedule a meeting")
+    mentions_issue: bool = Field(description="True if the email reports a technical issue or bug")
+
+analysis_model = LazyResource("analysis_model", lambda: vanilla_model.with_structured_output(EmailAnalysis))
+
+def _fused_messages(state: AgentState) -> list[BaseMessage]:
+    system_message = build_classification_system_message(
+        "Also write a concise 1-2 sentence summary, a polite professional reply to the sender "
+        "(if a meeting or ticket may be needed, say that it is being arranged), and list any actionable tasks. "
+        "Only write an alert message if the email is urgent."
+    )
+    return [
+        SystemMessage(content=system_message),
+        HumanMessage(content=f"Subject: {state.get('email_subject', '')}\n\n{state['email_body']}\n\n{attachments_prompt(state)}".rstrip())
+    ]
+
+def fused_analysis(state: AgentState) -> AgentState:
+    """Classify, summarise, draft a reply and extract tasks in one LLM call"""
+    analysis = analysis_model.invoke(_fused_messages(state))
+    return _fused_update(state, analysis, match_classification_rule(state))
+
+async def afused_analysis(state: AgentState) -> AgentState:
+    messages = await asyncio.to_thread(_fused_messages, state)
+    analysis = await analysis_model.ainvoke(messages)
+    return _fused_update(state, analysis, await asyncio.to_thread(match_classification_rule, state))
+
+def _fused_update(state: AgentState, analysis: Optional[EmailAnalysis], rule_tag: Optional[str]) -> AgentState:
+    if analysis is None:
+        raise ValueError("Fused analysis returned no structured output")
+
+    tag = rule_tag or analysis.tag
+    print(f"🧩 Fused analysis: {tag}, {len(analysis.tasks)} tasks")
+    return {
+        "email_tag": [tag],
+        "ai_summary": analysis.summary,
+        "email_reply": analysis.reply,
+        "extracted_tasks": [task.model_dump() for task in analysis.tasks],
+        "alert_message": analysis.alert_message,
+        "needs_meeting": analysis.mentions_meeting,
+        "needs_ticket": analysis.mentions_issue
+    }
+
+def send_fused_alert(state: AgentState) -> AgentState:
+    key = side_effect_key("telegram_alert")
+    if alert_already_sent(key):
+        return {}
+    text = state.get("alert_message") or state.get("ai_summary", "")
+    if post_telegram_message(text):
+        record_side_effect(key, {"text": text})
+    return {}
+
+async def asend_fused_alert(state: AgentState) -> AgentState:
+    key = side_effect_key("telegram_alert")
+    if await asyncio.to_thread(alert_already_sent, key):
+        return {}
+    text = state.get("alert_message") or state.get("ai_summary", "")
+    if await apost_telegram_message(text):
+        await asyncio.to_thread(record_side_effect, key, {"text": text})
+    return {}
+
+def fused_routes(state: AgentState) -> list[str]:
+    """Alert and tool-calling branches run in parallel after the fused analysis"""
+    routes = []
+    if priority_check(state) == "notify":
+        routes.append("send_notification")
+    if state.get("needs_meeting") or state.get("needs_ticket"):
+        routes.append("model_call")
+    return routes or ["__end__"]  # langgraph's END
+
+def append_action_details(state: AgentState) -> AgentState:
+    """Add ticket and meeting details from the tool calls to the drafted reply"""
+    details = []
+    if state.get("ticket_id"):
+        details.append(f"A JIRA ticket has been created with ID: {state['ticket_id']}.")
+    if state.get("event_summary") and state.get("event_start") and state.get("event_meet_link"):
+        details.append(
+            f"A meeting has been scheduled: {state['event_summary']} at {state['event_start']} "
+            f"({state['event_meet_link']})."
+        )
+    if not details:
+        return {}
+    return {"email_reply": state.get("email_reply", "").rstrip() + "\n\n" + "\n".join(details)}
+
+def build_fused_processor():
+    """One structured analysis call, then only the branches it asks for"""
+    from langgraph.graph import StateGraph, START, END
+    from langgraph.prebuilt import ToolNode
+
+    fused_graph = StateGraph(AgentState)
+    fused_graph.add_node("fused_analysis", graph_node(fused_analysis, afused_analysis))
+    fused_graph.add_node("send_notification", graph_node(send_fused_alert, asend_fused_alert))
+    fused_graph.add_node("model_call", graph_node(without_llm_cache(model_call), without_llm_cache(amodel_call)))
+    fused_graph.add_node("tools", ToolNode(tools=tools))
+    fused_graph.add_node("store_tool_outputs", store_tool_outputs)
+    fused_graph.add_node("append_action_details", append_action_details)
+
+    fused_graph.add_edge(START, "fused_analysis")
+    fused_graph.add_conditional_edges("fused_analysis", fused_routes)
+    fused_graph.add_edge("send_notification", END)
+    fused_graph.add_conditional_edges(
+        "model_call",
+        lambda state: "tools" if state.get("tool_call") else END
+    )
+    fused_graph.add_edge("tools", "store_tool_outputs")
+    fused_graph.add_edge("store_tool_outputs", "append_action_details")
+    fused_graph.add_edge("append_action_details", END)
+    return fused_graph.compile()
+
+fused_processor = LazyResource("fused_processor", build_fused_processor)
+
+class PipelineModeStats:
+    """Running latency and token totals per pipeline mode, for A/B comparison."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict[str, float]] = {}
+
+    def record(self, mode: str, seconds: float, input_tokens: int, output_tokens: int):
+        with self._lock:
+            totals = self._totals.setdefault(mode, {"emails": 0, "seconds": 0.0, "input_tokens": 0, "output_tokens": 0})
+            totals["emails"] += 1
+            totals["seconds"] += seconds
+            totals["input_tokens"] += input_tokens
+            totals["output_tokens"] += output_tokens
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                mode: {
+                    **totals,
+                    "avg_seconds": totals["seconds"] / totals["emails"],
+                    "avg_input_tokens": totals["input_tokens"] / totals["emails"],
+                    "avg_output_tokens": totals["output_tokens"] / totals["emails"]
+                }
+                for mode, totals in self._totals.items()
+            }
+
+pipeline_stats = PipelineModeStats()
+
+# Extra LangChain callback handlers passed to every pipeline run, e.g. the benchmark's node timer
+PIPELINE_CALLBACKS: List = []
+
+def choose_pipeline_mode() -> str:
+    if PIPELINE_FUSED_RATIO and random.random() < PIPELINE_FUSED_RATIO:
+        return "fused"
+    return PIPELINE_MODE
+
+def run_pipeline(inputs: AgentState, mode: str, trace: Optional[PipelineTrace] = None) -> AgentState:
+    """Run the email through the chosen pipeline, recording latency and token usage"""
+    usage = UsageMetadataCallbackHandler()
+    config = {"callbacks": [usage, trace or PipelineTrace(), *PIPELINE_CALLBACKS]}
+    started = time.monotonic()
+    if mode == "fused":
+        try:
+            result = fused_processor.invoke(dict(inputs), config=config)
+        except Exception as e:
+            print(f"❌ Fused analysis failed, falling back to graph mode: {e}")
+            mode = "fused_fallback"
+            result = email_processor.invoke(dict(inputs), config=config)
+    else:
+        result = email_processor.invoke(dict(inputs), config=config)
+    _record_pipeline_run(mode, time.monotonic() - started, usage)
+    if trace:
+        trace.mode = mode
+    return result
+
+async def arun_pipeline(inputs: AgentState, mode: str, trace: Optional[PipelineTrace] = None) -> AgentState:
+    usage = UsageMetadataCallbackHandler()
+    config = {"callbacks": [usage, trace or PipelineTrace(), *PIPELINE_CALLBACKS]}
+    started = time.monotonic()
+    if mode == "fused":
+        try:
+            result = await fused_processor.ainvoke(dict(inputs), config=config)
+        except Exception as e:
+            print(f"❌ Fused analysis failed, falling back to graph mode: {e}")
+            mode = "fused_fallback"
+            result = await email_processor.ainvoke(dict(inputs), config=config)
+    else:
+        result = await email_processor.ainvoke(dict(inputs), config=config)
+    _record_pipeline_run(mode, time.monotonic() - started, usage)
+    if trace:
+        trace.mode = mode
+    return result
+
+def _record_pipeline_run(mode: str, elapsed: float, usage: UsageMetadataCallbackHandler):
+    input_tokens = sum(u.get("input_tokens", 0) for u in usage.usage_metadata.values())
+    output_tokens = sum(u.get("output_tokens", 0) for u in usage.usage_metadata.values())
+    pipeline_stats.record(mode, elapsed, input_tokens, output_tokens)
+    print(f"📊 Pipeline {mode}: {elapsed:.2f}s, {input_tokens} input / {output_tokens} output tokens")
+
+_TAG_RE = re.compile(r'<(script|style)[^>]*>.*?</\1>|<[^>]+>', re.S | re.I)
+# UUIDs, then any token containing a digit: timestamps, counters, hex ids, hosts like web-01
+_VOLATILE_RE = re.compile(r'[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}|\b[\w-]*\d[\w-]*\b', re.I)
+_WORD_RE = re.compile(r'\w+')
+
+def email_features(subject: str, body: str) -> list[str]:
+    """Word 3-shingles of the subject and body with markup, numbers, ids and host names masked"""
+    text = html.unescape(_TAG_RE.sub(' ', f"{subject or ''}\n{body or ''}")).lower()
+    words = _WORD_RE.findall(_VOLATILE_RE.sub(' 0 ', text))
+    if len(words) < 3:
+        return words
+    return [' '.join(words[i:i + 3]) for i in range(len(words) - 2)]
+
+# Quoted history in HTML replies starts at one of these elements (Gmail, Yahoo,
+# Thunderbird, Apple Mail, Outlook); the rest of the document is dropped.
+_HTML_QUOTE_RE = re.compile(
+    r'<(?:div|blockquote)\b[^>]*(?:class="[^"]*\b(?:gmail_quote|yahoo_quoted|moz-cite-prefix)\b'
+    r'|type="cite"|id="(?:divRplyFwdMsg|appendonsend)")', re.I)
+_HTML_DROP_RE = re.compile(r'<(script|style|head|title)\b[^>]*>.*?</\1\s*>|<!--.*?-->', re.S | re.I)
+_HTML_BREAK_RE = re.compile(r'<br\s*/?>|</(?:p|div|h[1-6]|tr|table|ul|ol|blockquote)\s*>', re.I)
+_HTML_ITEM_RE = re.compile(r'<li\b[^>]*>', re.I)
+_SPACES_RE = re.compile(r'[ \t\r\f\v\xa0]+')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+# Start of the quoted message in a plain-text reply: "On <date>, <name> wrote:" (possibly
+# wrapped onto a second line), Outlook's "Original Message" rule or From:/Sent: header block.
+_REPLY_HEADER_RE = re.compile(
+    r'^(?:On\b[^\n]*(?:\n[^\n]*)?\bwrote:[ \t]*$|-{2,}\s*Original Message\s*-{2,}|_{20,}[ \t]*$'
+    r'|From:[^\n]+\n(?:Sent|Date):)', re.M | re.I)
+# Signature delimiter, mobile client footers and legal disclaimers
+_SIGNATURE_RE = re.compile(
+    r'^(?:-- ?$|Sent from my \w+|Get Outlook for \w+|CONFIDENTIAL(?:ITY)?(?: NOTICE)?\b|DISCLAIMER\b'
+    r'|This (?:e-?mail|message)\b[^\n]{0,80}\b(?:confidential|intended (?:solely )?for))', re.M | re.I)
+
+def html_to_text(markup: str) -> str:
+    """Readable text of an HTML body: quoted history, scripts, styles, comments and
+    images dropped, block elements turned into line breaks"""
+    quote = _HTML_QUOTE_RE.search(markup)
+    if quote:
+        markup = markup[:quote.start()]
+    markup = _HTML_DROP_RE.sub(' ', markup)
+    markup = _HTML_BREAK_RE.sub('\n', markup)
+    markup = _HTML_ITEM_RE.sub('\n- ', markup)
+    return html.unescape(_TAG_RE.sub(' ', markup))
+
+def strip_quoted_text(text: str) -> str:
+    """Drop the quoted reply chain, '>' quoted lines and the signature or legal footer"""
+    reply = _REPLY_HEADER_RE.search(text)
+    if reply and text[:reply.start()].strip():
+        text = text[:reply.start()]
+    text = '\n'.join(line for line in text.split('\n') if not line.lstrip().startswith('>'))
+    signature = _SIGNATURE_RE.search(text)
+    if signature and text[:signature.start()].strip():
+        text = text[:signature.start()]
+    return text
+
+def truncate_to_token_budget(text: str, budget: int) -> str:
+    """Cut the text to about `budget` tokens, at a paragraph, line or word boundary"""
+    limit = budget * BODY_CHARS_PER_TOKEN
+    if budget <= 0 or len(text) <= limit:
+        return text
+    cut = text[:limit]
+    for separator in ('\n\n', '\n', ' '):
+        boundary = cut.rfind(separator)
+        if boundary > limit // 2:
+            cut = cut[:boundary]
+            break
+    return cut.rstrip() + '\n[…truncated]'
+
+def clean_email_body(text_body: Optional[str], html_body: Optional[str], budget: int = BODY_TOKEN_BUDGET) -> str:
+    """The text the pipeline reads: TextBody if present, else the HTML as text, without
+    quoted history or signature, whitespace collapsed and cut to the token budget"""
+    # Input far beyond the budget would be cut anyway; bound the regex work on huge bodies
+    raw_limit = budget * BODY_CHARS_PER_TOKEN * 10 if budget > 0 else None
+    if text_body and text_body.strip():
+        text = text_body[:raw_limit]
+    else:
+        text = html_to_text((html_body or '')[:raw_limit])
+    text = text.replace('\r\n', '\n')
+    # An email that is nothing but quoted text keeps it
+    text = strip_quoted_text(text).strip() or text
+    lines = (_SPACES_RE.sub(' ', line).strip() for line in text.split('\n'))
+    text = _BLANK_LINES_RE.sub('\n\n', '\n'.join(lines)).strip()
+    return truncate_to_token_budget(text, budget)
+
+class BlobStore:
+    """Content-addressed files under root/<sha[:2]>/<sha>, so identical attachments
+    are stored once. Extracted text is cached beside the blob as <sha>.txt."""
+
+    INCOMING_PREFIX = '.incoming-'
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def text_path(self, digest: str) -> str:
+        return self.path(digest) + '.txt'
+
+    def writer(self) -> "BlobWriter":
+        os.makedirs(self.root, exist_ok=True)
+        return BlobWriter(self)
+
+    def prune(self, referenced: set, incoming_grace_seconds: int = 3600) -> int:
+        """Delete blobs no attachment row references, and abandoned uploads"""
+        removed = 0
+        cutoff = time.time() - incoming_grace_seconds
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.startswith(self.INCOMING_PREFIX):
+                    stale = os.path.getmtime(path) < cutoff
+                else:
+                    stale = name.removesuffix('.txt') not in referenced
+                if stale:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+class BlobWriter:
+    """Streams bytes to a temporary file in the store while hashing them. commit()
+    moves the file to its content address, or drops it if that blob already exists."""
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.file = tempfile.NamedTemporaryFile(dir=store.root, prefix=store.INCOMING_PREFIX, delete=False)
+
+    def write(self, data: bytes):
+        self.hash.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def commit(self) -> str:
+        self.file.close()
+        digest = self.hash.hexdigest()
+        target = self.store.path(digest)
+        if os.path.exists(target):
+            os.remove(self.file.name)
+            ATTACHMENT_BYTES.labels('deduplicated').inc(self.size)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(self.file.name, target)
+            ATTACHMENT_BYTES.labels('stored').inc(self.size)
+        return digest
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+blob_store = BlobStore(ATTACHMENT_STORE_PATH)
+
+class Base64StreamDecoder:
+    """Decodes base64 fed in arbitrary chunks (as raw JSON string bytes, so JSON-escaped
+    line breaks and slashes are accepted) and writes the bytes to `out`"""
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = b''
+        self.escape = b''
+
+    def write(self, chunk: bytes):
+        # Hold back a backslash that ends the chunk until the rest of its escape arrives
+        chunk, self.escape = self.escape + chunk, b''
+        if chunk.endswith(b'\\'):
+            chunk, self.escape = chunk[:-1], b'\\'
+        chunk = chunk.replace(b'\\/', b'/').replace(b'\\r', b'').replace(b'\\n', b'')
+        data = self.pending + chunk.translate(None, b' \t\r\n')
+        usable = len(data) - len(data) % 4
+        if usable:
+            self.out.write(base64.b64decode(data[:usable], validate=True))
+        self.pending = data[usable:]
+
+    def close(self):
+        if self.escape:
+            raise ValueError("Incomplete escape at the end of base64 content")
+        if self.pending:
+            self.out.write(base64.b64decode(self.pending + b'=' * (-len(self.pending) % 4), validate=True))
+            self.pending = b''
+
+_JSON_SPACE_RE = re.compile(rb'[ \t\r\n]*')
+# The longest run of string content made of plain bytes and complete escapes
+_JSON_STRING_RUN_RE = re.compile(rb'(?:[^"\\]++|\\(?:u[0-9a-fA-F]{4}|["\\/bfnrt]))*+')
+_JSON_LITERAL_RE = re.compile(rb'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null')
+
+class StreamingJsonParser:
+    """Minimal JSON parser reading a binary stream in chunks. A string value whose path
+    (tuple of keys and list indexes) is claimed by `stream_string(path)` is written raw
+    to the returned sink chunk by chunk, then the sink is closed and the value parses
+    as None. Everything else is parsed normally."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, stream_string=lambda path: None):
+        self.stream = stream
+        self.stream_string = stream_string
+        self.buffer = b''
+        self.pos = 0
+
+    def parse(self):
+        value = self._value(())
+        if self._peek(required=False) is not None:
+            raise ValueError("Unexpected data after the JSON value")
+        return value
+
+    def _fill(self) -> bool:
+        chunk = self.stream.read(self.CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _need(self, count: int):
+        while len(self.buffer) - self.pos < count:
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON")
+
+    def _peek(self, required: bool = True) -> Optional[int]:
+        while True:
+            self.pos = _JSON_SPACE_RE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                if required:
+                    raise ValueError("Unexpected end of JSON")
+                return None
+
+    def _expect(self, char: bytes):
+        if self._peek() != char[0]:
+            raise ValueError(f"Expected {char.decode()!r} at byte {self.pos} of the buffer")
+        self.pos += 1
+
+    def _value(self, path: tuple):
+        char = self._peek()
+        if char == ord('{'):
+            self.pos += 1
+            obj = {}
+            if self._peek() == ord('}'):
+                self.pos += 1
+                return obj
+            while True:
+                key = self._string_value()
+                self._expect(b':')
+                obj[key] = self._value(path + (key,))
+                if self._peek() == ord('}'):
+                    self.pos += 1
+                    return obj
+                self._expect(b',')
+        if char == ord('['):
+            self.pos += 1
+            items = []
+            if self._peek() == ord(']'):
+                self.pos += 1
+                return items
+            while True:
+                items.append(self._value(path + (len(items),)))
+                if self._peek() == ord(']'):
+                    self.pos += 1
+                    return items
+                self._expect(b',')
+        if char == ord('"'):
+            sink = self.stream_string(path)
+            if sink is None:
+                return self._string_value()
+            self._string(sink.write)
+            sink.close()
+            return None
+        # Literals are short; make sure one is not split across reads
+        while len(self.buffer) - self.pos < 32 and self._fill():
+            pass
+        match = _JSON_LITERAL_RE.match(self.buffer, self.pos)
+        # except for a long number
+        while match and match.end() == len(self.buffer) and self._fill():
+            match = _JSON_LITERAL_RE.match(self.buffer, self.pos)
+        if not match:
+            raise ValueError(f"Invalid JSON value at byte {self.pos} of the buffer")
+        self.pos = match.end()
+        return json.loads(match.group())
+
+    def _string_value(self) -> str:
+        if self._peek() != ord('"'):
+            raise ValueError("Expected a JSON string")
+        parts = []
+        self._string(parts.append)
+        return json.loads(b'"' + b''.join(parts) + b'"')
+
+    def _string(self, write):
+        """Write the raw (still escaped) bytes of the string at pos, never splitting an escape"""
+        self.pos += 1
+        while True:
+            end = _JSON_STRING_RUN_RE.match(self.buffer, self.pos).end()
+            write(self.buffer[self.pos:end])
+            self.pos = end
+            if end < len(self.buffer):
+                if self.buffer[end] == ord('"'):
+                    self.pos += 1
+                    return
+                # A backslash: an escape cut off by the end of the buffer, or an invalid one
+                if len(self.buffer) - end >= 6:
+                    raise ValueError(f"Invalid escape in JSON string at byte {end} of the buffer")
+            if not self._fill():
+                raise ValueError("Unterminated JSON string")
+
+def read_inbound_payload(stream) -> tuple[Dict, Dict[int, tuple[str, int]]]:
+    """Parse a Postmark inbound payload from a stream, decoding each attachment's base64
+    Content straight into the blob store. Returns the payload (Content values None) and
+    {attachment index: (sha256, size)}."""
+    writers: Dict[int, BlobWriter] = {}
+
+    def stream_string(path: tuple):
+        if len(path) == 3 and path[0] == 'Attachments' and path[2] == 'Content':
+            writer = writers[path[1]] = blob_store.writer()
+            return Base64StreamDecoder(writer)
+        return None
+
+    try:
+        data = StreamingJsonParser(stream, stream_string).parse()
+        if not isinstance(data, dict):
+            raise ValueError("Expected a Postmark inbound JSON object")
+        return data, {index: (writer.commit(), writer.size) for index, writer in writers.items()}
+    finally:
+        for writer in writers.values():
+            if not writer.file.closed:
+                writer.discard()
+
+def postmark_attachments(data: Dict, blobs: Dict[int, tuple[str, int]]) -> list[Attachment]:
+    """Attachment rows for the attachments of a payload stored by read_inbound_payload"""
+    attachments = []
+    for index, item in enumerate(data.get('Attachments') or []):
+        if index not in blobs or not isinstance(item, dict):
+            continue
+        digest, size = blobs[index]
+        attachments.append(Attachment(
+            name=item.get('Name') or f"attachment-{index + 1}",
+            content_type=item.get('ContentType') or None,
+            content_id=item.get('ContentID') or None,
+            size=size,
+            sha256=digest
+        ))
+    return attachments
+
+ATTACHMENT_TEXT_TYPES = ('application/json', 'application/xml', 'application/csv')
+
+def extract_attachment_text(path: str, content_type: str, name: str, limit: int) -> str:
+    """Up to about `limit` characters of text from a stored attachment; '' for types
+    without text (images, archives, ...)"""
+    if not content_type or content_type == 'application/octet-stream':
+        content_type = mimetypes.guess_type(name)[0] or ''
+    if content_type == 'application/pdf':
+        from pypdf import PdfReader
+        pages = []
+        length = 0
+        for page in PdfReader(path).pages:
+            text = page.extract_text() or ''
+            pages.append(text)
+            length += len(text)
+            if length >= limit:
+                break
+        return '\n\n'.join(pages)
+    if content_type.startswith('text/') or content_type in ATTACHMENT_TEXT_TYPES:
+        with open(path, 'rb') as f:
+            text = f.read(limit * 4).decode('utf-8', errors='replace')
+        return html_to_text(text) if content_type == 'text/html' else text
+    return ''
+
+def attachment_text(digest: str, content_type: Optional[str], name: str) -> str:
+    """Cleaned text of a stored attachment, extracted once per blob and cached as <sha>.txt"""
+    cached = blob_store.text_path(digest)
+    try:
+        with open(cached, encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    limit = ATTACHMENT_TOKEN_BUDGET * BODY_CHARS_PER_TOKEN
+    try:
+        text = extract_attachment_text(blob_store.path(digest), content_type, name, limit)
+        lines = (_SPACES_RE.sub(' ', line).strip() for line in text.replace('\r\n', '\n').split('\n'))
+        text = truncate_to_token_budget(_BLANK_LINES_RE.sub('\n\n', '\n'.join(lines)).strip(), ATTACHMENT_TOKEN_BUDGET)
+    except Exception as e:
+        print(f"⚠️ Could not extract text from attachment {name}: {e}")
+        text = ''
+    partial = f"{cached}.{threading.get_ident()}"
+    with open(partial, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(partial, cached)
+    return text
+
+class AttachmentTexts(Sequence[str]):
+    """email_attachments for the pipeline: a "name:\\ntext" entry per attachment with text.
+    Nothing is read from the blob store until a node first uses the sequence."""
+
+    def __init__(self, attachments: list[tuple[str, Optional[str], str]]):
+        self.attachments = attachments  # (name, content_type, sha256)
+        self._texts: Optional[list[str]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> list[str]:
+        with self._lock:
+            if self._texts is None:
+                texts = []
+                budget = ATTACHMENT_TOKEN_BUDGET
+                for name, content_type, digest in self.attachments:
+                    if budget <= 0:
+                        break
+                    text = truncate_to_token_budget(attachment_text(digest, content_type, name), budget)
+                    if text:
+                        texts.append(f"{name}:\n{text}")
+                        budget -= len(text) // BODY_CHARS_PER_TOKEN
+                self._texts = texts
+            return self._texts
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __repr__(self) -> str:
+        return f"AttachmentTexts({[name for name, _, _ in self.attachments]!r})"
+
+def attachments_prompt(state: AgentState) -> str:
+    """Prompt section with the email's attachment texts, or '' without any"""
+    texts = state.get("email_attachments") or []
+    return "Attachments:\n" + "\n\n".join(texts) + "\n\n" if texts else ""
+
+def simhash(features: list[str]) -> int:
+    weights = [0] * 64
+    for feature in features:
+        h = xxhash.xxh64_intdigest(feature)
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def to_signed64(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def to_unsigned64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+class NearDuplicateIndex:
+    """Sliding window of SimHash fingerprints of recently processed emails.
+
+    Emails are registered when their processing starts, so a near-duplicate that
+    arrives while the original is still in the graph waits for its result instead
+    of running the pipeline a second time.
+    """
+
+    def __init__(self, threshold: float, window_minutes: int, wait_seconds: int):
+        self.max_distance = int((1 - threshold) * 64)
+        self.window_seconds = window_minutes * 60
+        self.wait_seconds = wait_seconds
+        self._lock = threading.Lock()
+        self._entries = deque()  # (email_id, fingerprint, received timestamp), oldest first
+        self._pending: Dict[int, threading.Event] = {}
+        self._async_waiters: Dict[int, list] = {}  # original id -> [(loop, future)]
+        self._loaded = False
+        self.duplicates_found = 0
+
+    def _load(self):
+        """Seed the window from the database after a restart"""
+        since = datetime.now(timezone.utc) - dt.timedelta(seconds=self.window_seconds)
+        rows = db.session.query(Email.id, Email.fingerprint, Email.received_at).filter(
+            Email.received_at >= since,
+            Email.fingerprint.isnot(None),
+            Email.duplicate_of_id.is_(None),
+            Email.is_processed.is_(True),
+            Email.processing_error.is_(None)
+        ).order_by(Email.received_at).all()
+        for email_id, fingerprint, received_at in rows:
+            self._entries.append((email_id, to_unsigned64(fingerprint), _timestamp(received_at)))
+        self._loaded = True
+
+    def find_or_register(self, email_id: int, fingerprint: int, received: float) -> Optional[int]:
+        """Return the id of a near-duplicate original, or register this email as one"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            cutoff = time.time() - self.window_seconds
+            while self._entries and self._entries[0][2] < cutoff:
+                self._entries.popleft()
+            best_id, best_distance = None, self.max_distance + 1
+            for other_id, other_fingerprint, other_received in self._entries:
+                distance = (fingerprint ^ other_fingerprint).bit_count()
+                if distance < best_distance and other_id != email_id and other_received <= received:
+                    best_id, best_distance = other_id, distance
+            if best_id is not None:
+                self.duplicates_found += 1
+                return best_id
+            self._entries.append((email_id, fingerprint, received))
+            self._pending[email_id] = threading.Event()
+            return None
+
+    def wait_for(self, email_id: int):
+        with self._lock:
+            event = self._pending.get(email_id)
+        if event:
+            event.wait(self.wait_seconds)
+
+    async def await_for(self, email_id: int):
+        """wait_for on the event loop, without holding one of its executor threads"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if email_id not in self._pending:
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._async_waiters.setdefault(email_id, []).append(waiter)
+        try:
+            await asyncio.wait_for(future, self.wait_seconds)
+        except asyncio.TimeoutError:
+            with self._lock:
+                waiters = self._async_waiters.get(email_id)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+
+    def release(self, email_id: int, succeeded: bool):
+        """Mark an original as finished; failed originals are dropped from the window"""
+        with self._lock:
+            event = self._pending.pop(email_id, None)
+            waiters = self._async_waiters.pop(email_id, [])
+            if event and not succeeded:
+                self._entries = deque(entry for entry in self._entries if entry[0] != email_id)
+        if event:
+            event.set()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve_waiter, future)
+            except RuntimeError:
+                pass  # the waiter's loop has been closed
+
+def _resolve_waiter(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+def _timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+duplicate_index = NearDuplicateIndex(DUPLICATE_SIMILARITY_THRESHOLD, DUPLICATE_WINDOW_MINUTES, DUPLICATE_WAIT_SECONDS)
+
+def find_near_duplicate(email: Email) -> Optional[int]:
+    """Fingerprint the email and return the id of a recent near-identical original, if any.
+    The caller waits for the original to finish, then calls link_near_duplicate."""
+    fingerprint = simhash(email_features(email.subject, email.text_body or email.body))
+    email.fingerprint = to_signed64(fingerprint)
+    # Commit before waiting so this session holds no SQLite write lock meanwhile
+    db.session.commit()
+    return duplicate_index.find_or_register(email.id, fingerprint, _timestamp(email.received_at))
+
+def link_near_duplicate(email: Email, original_id: int) -> bool:
+    """Reuse the analysis of a finished original. Returns True if the email was linked."""
+    original = db.session.get(Email, original_id, populate_existing=True)
+    if not original or not original.is_processed or original.processing_error:
+        return False
+    root_id = original.duplicate_of_id or original.id
+    before = email_stats_counts(email)
+    email.duplicate_of_id = root_id
+    email.ai_summary = original.ai_summary
+    email.ai_reply = original.ai_reply
+    email.tags = original.tags
+    email.priority = original.priority
+    email.jira_ticket_id = original.jira_ticket_id
+    email.is_processed = True
+    email.processed_at = datetime.now(timezone.utc)
+    sync_email_tags(email)
+    index_email_for_search(email)
+    delta = stats_delta(before, email_stats_counts(email))
+    apply_stats_delta(delta)
+    db.session.commit()
+    publish_email_processed(email, delta)
+    print(f"🔁 Email {email.id} is a near-duplicate of email {root_id}, reused its analysis")
+    return True
+
+def prepare_email_inputs(email_id: int) -> Optional[AgentState]:
+    """Load the email and build the graph inputs, or None if there is nothing to run"""
+    email = load_email_for_processing(email_id)
+    if not email:
+        return None
+    if DUPLICATE_DETECTION_ENABLED:
+        original_id = find_near_duplicate(email)
+        if original_id is not None:
+            duplicate_index.wait_for(original_id)
+            if link_near_duplicate(email, original_id):
+                return None
+    return build_email_inputs(email)
+
+async def aprepare_email_inputs(email_id: int) -> Optional[AgentState]:
+    """prepare_email_inputs for the event loop. Database work runs in the loop's executor,
+    but a near-duplicate waits for its original on the loop: waiting in the small executor
+    could take every thread and leave none for the original to store its result."""
+    email = await asyncio.to_thread(load_email_for_processing, email_id)
+    if not email:
+        return None
+    if DUPLICATE_DETECTION_ENABLED:
+        original_id = await asyncio.to_thread(find_near_duplicate, email)
+        if original_id is not None:
+            await duplicate_index.await_for(original_id)
+            if await asyncio.to_thread(link_near_duplicate, email, original_id):
+                return None
+    return await asyncio.to_thread(build_email_inputs, email)
+
+def load_email_for_processing(email_id: int) -> Optional[Email]:
+    """Load the email with its content, cleaning its body on the first attempt"""
+    email = db.session.get(Email, email_id, options=[db.undefer_group('content')])
+    if email and email.clean_body is None:
+        email.clean_body = clean_email_body(email.text_body, email.html_body or email.body)
+        BODY_CHARS.labels('raw').inc(len(email.body or email.text_body or ''))
+        BODY_CHARS.labels('clean').inc(len(email.clean_body))
+        db.session.commit()
+    return email
+
+def build_email_inputs(email: Email) -> AgentState:
+    inputs = {
+        "email_body": email.clean_body,
+        "email_subject": email.subject,
+        "email_from": email.from_address,
+        "email_to": email.to_address,
+        "email_headers": email.headers or {}
+    }
+    attachments = db.session.execute(
+        db.select(Attachment.name, Attachment.content_type, Attachment.sha256)
+        .where(Attachment.email_id == email.id).order_by(Attachment.id)
+    ).all()
+    if attachments:
+        inputs["email_attachments"] = AttachmentTexts([tuple(row) for row in attachments])
+    return inputs
+
+class EventBroker:
+    """Change feed of /api/events, persisted in the change_event table.
+
+    Events are published after the change is committed, by whichever process made it:
+    the web server, `flask run-workers` or a CLI command. A stream reads the events after
+    the last one it sent, polling every `poll_seconds`, and is woken at once by events
+    published in its own process. Only the latest `buffer_size` events are kept; a client
+    resuming from an older id gets a single "reset" event telling it to reload.
+    """
+
+    def __init__(self, buffer_size: int, poll_seconds: float, max_subscribers: int):
+        self.buffer_size = buffer_size
+        self.poll_seconds = poll_seconds
+        self.max_subscribers = max_subscribers
+        self._cond = threading.Condition()
+        self._published = 0
+        self._subscribers = 0
+
+    # The feed is read and written on its own connections: publishers may run on worker
+    # threads, and streams run after their request context has ended.
+    def publish(self, event_type: str, data: Dict) -> int:
+        with db.engine.begin() as conn:
+            event_id = conn.execute(db.insert(ChangeEvent).values(
+                type=event_type, data=data, created_at=datetime.now(timezone.utc)
+            )).inserted_primary_key[0]
+            if event_id % 100 == 0:
+                conn.execute(db.delete(ChangeEvent).where(ChangeEvent.id <= event_id - self.buffer_size))
+        with self._cond:
+            self._published += 1
+            self._cond.notify_all()
+        return event_id
+
+    def latest_id(self, engine=None) -> int:
+        with (engine or db.engine).connect() as conn:
+            return conn.execute(db.select(db.func.max(ChangeEvent.id))).scalar() or 0
+
+    def events_after(self, last_id: int, engine=None, limit: int = 500) -> list[tuple[int, str, Dict]]:
+        """Events after `last_id`, or a single reset if some of them were already pruned"""
+        with (engine or db.engine).connect() as conn:
+            rows = conn.execute(
+                db.select(ChangeEvent.id, ChangeEvent.type, ChangeEvent.data)
+                .where(ChangeEvent.id > last_id).order_by(ChangeEvent.id).limit(limit)
+            ).all()
+            if rows and rows[0][0] > last_id + 1:
+                latest = conn.execute(db.select(db.func.max(ChangeEvent.id))).scalar()
+                return [(latest, "reset", {})]
+        return [tuple(row) for row in rows]
+
+    def acquire(self) -> bool:
+        """Take a stream slot; False when max_subscribers streams are open"""
+        with self._cond:
+            if self._subscribers >= self.max_subscribers:
+                return False
+            self._subscribers += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def stream(self, last_event_id: Optional[int], heartbeat_seconds: float):
+        """SSE chunks of the events after `last_event_id`, or after the latest one"""
+        engine = db.engine
+        last_id = self.latest_id(engine) if last_event_id is None else last_event_id
+        yield "retry: 3000\n\n"
+        sent = time.monotonic()
+        while True:
+            with self._cond:
+                published = self._published
+            events = self.events_after(last_id, engine)
+            for event_id, event_type, data in events:
+                yield f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+                last_id = event_id
+            if events:
+                sent = time.monotonic()
+                continue
+            if time.monotonic() - sent >= heartbeat_seconds:
+                yield ": keep-alive\n\n"
+                sent = time.monotonic()
+            with self._cond:
+                if self._published == published:
+                    self._cond.wait(self.poll_seconds)
+
+    def subscriber_count(self) -> int:
+        with self._cond:
+            return self._subscribers
+
+event_broker = EventBroker(EVENT_BUFFER_SIZE, EVENT_POLL_SECONDS, EVENT_MAX_SUBSCRIBERS)
+
+EMAIL_STATS = ("total_emails", "processed_emails", "urgent_emails", "tickets_created", "meetings_scheduled")
+# Overdue tasks change with the clock rather than with a write, so they are not a counter:
+# /api/tasks/stats counts them per request (ix_task_status_due).
+TASK_STATS = ("total_tasks", "pending_tasks", "completed_tasks", "high_priority_tasks")
+
+def email_stats_counts(email: Optional[Email]) -> Dict[str, int]:
+    """The email's contribution to each /api/stats counter"""
+    if email is None:
+        return dict.fromkeys(EMAIL_STATS, 0)
+    return {
+        "total_emails": 1,
+        "processed_emails": int(bool(email.is_processed)),
+        "urgent_emails": int("urgent" in email_tag_labels(email)),
+        "tickets_created": int(bool(email.jira_ticket_id)),
+        "meetings_scheduled": int(bool(email.calendar_event_id))
+    }
+
+def task_stats_counts(task: Optional[Task]) -> Dict[str, int]:
+    """The task's contribution to each /api/tasks/stats counter"""
+    if task is None:
+        return dict.fromkeys(TASK_STATS, 0)
+    return {
+        "total_tasks": 1,
+        "pending_tasks": int(task.status == 'pending'),
+        "completed_tasks": int(task.status == 'completed'),
+        "high_priority_tasks": int(task.priority == 'high' and task.status == 'pending')
+    }
+
+def count_overdue_tasks() -> int:
+    return count_rows(Task.id, Task.status == 'pending', Task.due_date < datetime.now(timezone.utc))
+
+def stats_delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+    return {name: after[name] - before.get(name, 0) for name in after if after[name] != before.get(name, 0)}
+
+def apply_stats_delta(delta: Dict[str, int]):
+    """Add the delta to the counters row in the current transaction (caller commits)"""
+    if delta:
+        db.session.execute(
+            db.update(StatsCounters).where(StatsCounters.id == 1)
+            .values({name: getattr(StatsCounters, name) + change for name, change in delta.items()})
+        )
+
+def publish_email_processed(email: Email, delta: Dict[str, int]):
+    event_broker.publish("email_processed", {"email": format_email_for_api(email, EMAIL_LIST_FIELDS)})
+    if delta:
+        event_broker.publish("stats_delta", {"emails": delta})
+
+def publish_task_changed(action: str, task_data: Dict, delta: Dict[str, int]):
+    event_broker.publish("task_changed", {"action": action, "task": task_data})
+    if delta:
+        event_broker.publish("stats_delta", {"tasks": delta})
+
+def count_rows(column, *criteria) -> int:
+    """Count rows selecting only the given column, so it also runs while a migration
+    has not yet added the model's later columns"""
+    return db.session.scalar(db.select(db.func.count(column)).where(*criteria))
+
+class StatsReconciler:
+    """Recomputes the counters row from the tables every interval.
+
+    The update of the row is issued first, so SQLite holds the write lock while
+    counting and no concurrent delta can slip in between the counts and the write.
+    """
+
+    def __init__(self, interval_seconds: int):
+        self.interval_seconds = interval_seconds
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.interval_seconds > 0:
+                self._thread = threading.Thread(target=self._run, name="stats-reconciler", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                with app.app_context():
+                    self.reconcile()
+            except Exception as e:
+                print(f"❌ Stats reconciliation failed: {e}")
+
+    def reconcile(self) -> StatsCounters:
+        now = datetime.now(timezone.utc)
+        updated = db.session.execute(
+            db.update(StatsCounters).where(StatsCounters.id == 1).values(reconciled_at=now)
+        ).rowcount
+        counters = db.session.get(StatsCounters, 1, populate_existing=True) if updated else None
+        if counters is None:
+            counters = StatsCounters(id=1, reconciled_at=now)
+            db.session.add(counters)
+        actual = {
+            "total_emails": count_rows(Email.id),
+            "processed_emails": count_rows(Email.id, Email.is_processed.is_(True)),
+            "urgent_emails": count_rows(EmailTag.email_id, EmailTag.tag == 'urgent'),
+            "tickets_created": count_rows(Email.id, Email.jira_ticket_id.isnot(None)),
+            "meetings_scheduled": count_rows(Email.id, Email.calendar_event_id.isnot(None)),
+            "total_tasks": count_rows(Task.id),
+            "pending_tasks": count_rows(Task.id, Task.status == 'pending'),
+            "completed_tasks": count_rows(Task.id, Task.status == 'completed'),
+            "high_priority_tasks": count_rows(Task.id, Task.priority == 'high', Task.status == 'pending')
+        }
+        drift = stats_delta({name: getattr(counters, name) or 0 for name in actual}, actual)
+        for name, value in actual.items():
+            setattr(counters, name, value)
+        db.session.commit()
+        if drift:
+            if updated:
+                print(f"📊 Corrected stats drift: {drift}")
+            event_broker.publish("stats_delta", {
+                "emails": {name: change for name, change in drift.items() if name in EMAIL_STATS},
+                "tasks": {name: change for name, change in drift.items() if name in TASK_STATS}
+            })
+        return counters
+
+    def counters(self) -> StatsCounters:
+        counters = db.session.get(StatsCounters, 1)
+        return counters if counters is not None else self.reconcile()
+
+stats_reconciler = StatsReconciler(STATS_RECONCILE_SECONDS)
+
+def normalize_tag(tag: str) -> str:
+    return tag.strip().lower().replace('-', '_')
+
+def email_tag_labels(email: Email) -> set[str]:
+    """The email's normalized labels, as stored in EmailTag and counted by the stats"""
+    labels = {normalize_tag(tag) for tag in email.tags or [] if isinstance(tag, str) and tag.strip()}
+    if email.calendar_event_id:
+        labels.add('meeting')
+    if email.jira_ticket_id:
+        labels.add('issue')
+    return labels
+
+def sync_email_tags(email: Email):
+    """Rewrite the email's EmailTag rows from its tags, event and ticket (caller commits)"""
+    labels = email_tag_labels(email)
+    EmailTag.query.filter_by(email_id=email.id).delete()
+    db.session.add_all(EmailTag(email_id=email.id, tag=label, received_at=email.received_at) for label in labels)
+
+# Full-text index of processed emails, rowid = email.id. Kept in sync explicitly wherever
+# an email is marked processed. Column weights for bm25 follow the column order.
+SEARCH_COLUMN_WEIGHTS = (5.0, 3.0, 1.0, 2.0)  # subject, sender, body, ai_summary
+
+EMAIL_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS email_fts USING fts5("
+    "subject, sender, body, ai_summary, tokenize='unicode61 remove_diacritics 2')"
+)
+event.listen(Email.__table__, 'after_create', db.DDL(EMAIL_FTS_DDL))
+
+def search_body_text(email: Email) -> str:
+    return email.text_body or html.unescape(_TAG_RE.sub(' ', email.body or ''))
+
+def index_email_for_search(email: Email):
+    """Replace the email's row in email_fts (caller commits)"""
+    db.session.execute(db.text("DELETE FROM email_fts WHERE rowid = :id"), {"id": email.id})
+    db.session.execute(
+        db.text("INSERT INTO email_fts (rowid, subject, sender, body, ai_summary) "
+                "VALUES (:id, :subject, :sender, :body, :ai_summary)"),
+        {
+            "id": email.id,
+            "subject": email.subject or "",
+            "sender": email.from_address or "",
+            "body": search_body_text(email),
+            "ai_summary": email.ai_summary or ""
+        }
+    )
+
+def fts_query(text: str) -> str:
+    """Quote each term so user input cannot inject FTS5 syntax; a trailing * keeps prefix search"""
+    terms = []
+    for term in text.split():
+        prefix = term.endswith('*')
+        term = term.rstrip('*').replace('"', '""')
+        if term:
+            terms.append(f'"{term}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+def store_pipeline_result(email_id: int, result: AgentState):
+    email = db.session.get(Email, email_id)
+    before = email_stats_counts(email)
+    email.ai_summary = result.get("ai_summary", "")
+    email.ai_reply = result.get("email_reply", "")
+    email.tags = result.get("email_tag", [])
+    email.priority = "urgent" if "urgent" in result.get("email_tag", []) else "normal"
+    email.jira_ticket_id = result.get("ticket_id")
+    email.calendar_event_id = result.get("event_summary")
+    email.calendar_event_link = result.get("event_calendar_link") if "event_calendar_link" in result else None
+    email.meet_link = result.get("event_meet_link")
+    if result.get("event_start"):
+        try:
+            email.event_start_time = datetime.fromisoformat(result["event_start"].replace('Z', '+00:00'))
+        except:
+            pass
+    if result.get("event_end"):
+        try:
+            email.event_end_time = datetime.fromisoformat(result["event_end"].replace('Z', '+00:00'))
+        except:
+            pass
+    email.event_attendees = result.get("event_attendees", [])
+    extracted_tasks = result.get("extracted_tasks", [])
+    tasks = []
+    for task_data in extracted_tasks:
+        task = Task(
+            email_id=email.id,
+            title=task_data.get("title", ""),
+            description=task_data.get("description", ""),
+            priority=task_data.get("priority", "normal"),
+            due_date=datetime.fromisoformat(task_data["due_date"]) if task_data.get("due_date") else None
+        )
+        db.session.add(task)
+        tasks.append(task)
+    email.is_processed = True
+    email.processed_at = datetime.now(timezone.utc)
+    sync_email_tags(email)
+    index_email_for_search(email)
+    db.session.flush()  # Populates column defaults such as Task.status
+    email_delta = stats_delta(before, email_stats_counts(email))
+    task_deltas = [stats_delta(task_stats_counts(None), task_stats_counts(task)) for task in tasks]
+    apply_stats_delta(email_delta)
+    for task_delta in task_deltas:
+        apply_stats_delta(task_delta)
+    db.session.commit()
+    publish_email_processed(email, email_delta)
+    for task, task_delta in zip(tasks, task_deltas):
+        publish_task_changed("created", format_task_for_api(task), task_delta)
+
+def record_processing_error(email_id: int, error):
+    """Mark the email as failed for good, updating counters, tags, search index and the live feed"""
+    with app.app_context():
+        email = db.session.get(Email, email_id)
+        if email and not email.is_processed:
+            before = email_stats_counts(email)
+            email.processing_error = str(error)
+            email.is_processed = True
+            email.processed_at = datetime.now(timezone.utc)
+            sync_email_tags(email)
+            index_email_for_search(email)
+            delta = stats_delta(before, email_stats_counts(email))
+            apply_stats_delta(delta)
+            db.session.commit()
+            publish_email_processed(email, delta)
+    print(f"❌ Email {email_id} marked as failed: {error}")
+
+def record_email_trace(trace: PipelineTrace, outcome: str, error: Optional[str] = None):
+    """Store the trace without letting a tracing failure affect processing"""
+    try:
+        with app.app_context():
+            save_email_trace(trace, outcome, error)
+    except Exception as e:
+        print(f"❌ Failed to store trace of email {trace.email_id}: {e}")
+
+def process_email_async(email_id: int, queue_wait: Optional[float] = None, lane: str = "live"):
+    """Run the pipeline for one queued email. Failures are traced and re-raised, so the
+    job queue can retry the email or give up on it."""
+    succeeded = False
+    current_email_id.set(email_id)
+    tool_call_counts.set({})
+    llm_lane.set(lane)
+    trace = None
+    try:
+        with app.app_context():
+            inputs = prepare_email_inputs(email_id)
+            if inputs is None:
+                return
+            route_email(inputs, lane)
+            print(f"📧 Processing email {email_id} with LangGraph...")
+            trace = PipelineTrace(email_id, queue_wait)
+            result = run_pipeline(inputs, choose_pipeline_mode(), trace)
+            print(f"⏱️ Email {email_id}: {trace.summary()}")
+            store_pipeline_result(email_id, result)
+            succeeded = True
+            print(f"✅ Email {email_id} processed successfully")
+        record_email_trace(trace, "ok")
+    except Exception as e:
+        print(f"❌ Error processing email {email_id}: {e}")
+        if trace:
+            record_email_trace(trace, "error", str(e))
+        raise
+    finally:
+        duplicate_index.release(email_id, succeeded)
+
+async def aprocess_email(email_id: int, queue_wait: Optional[float] = None, lane: str = "live"):
+    """Asyncio counterpart of process_email_async: database work runs in the loop's
+    executor, the graph itself runs with ainvoke on the event loop."""
+    succeeded = False
+    current_email_id.set(email_id)
+    tool_call_counts.set({})
+    llm_lane.set(lane)
+    trace = None
+    try:
+        with app.app_context():
+            inputs = await aprepare_email_inputs(email_id)
+            if inputs is None:
+                return
+            await asyncio.to_thread(route_email, inputs, lane)
+            print(f"📧 Processing email {email_id} with LangGraph...")
+            trace = PipelineTrace(email_id, queue_wait)
+            result = await arun_pipeline(inputs, choose_pipeline_mode(), trace)
+            print(f"⏱️ Email {email_id}: {trace.summary()}")
+            await asyncio.to_thread(store_pipeline_result, email_id, result)
+            succeeded = True
+            print(f"✅ Email {email_id} processed successfully")
+        await asyncio.to_thread(record_email_trace, trace, "ok")
+    except Exception as e:
+        print(f"❌ Error processing email {email_id}: {e}")
+        if trace:
+            await asyncio.to_thread(record_email_trace, trace, "error", str(e))
+        raise
+    finally:
+        duplicate_index.release(email_id, succeeded)
+
+class EmailJobQueue:
+    """Durable processing queue backed by the ProcessingJob table.
+
+    A fixed pool of worker threads (or, in asyncio mode, a bounded number of
+    coroutines on one event loop) claims jobs by taking a time-limited lease.
+    Leases are renewed while a job runs, so a job whose lease expires belonged
+    to a worker (or process) that died and is handed out again.
+    """
+
+    def __init__(self, concurrency: int, lease_seconds: int, max_attempts: int, poll_seconds: float,
+                 mode: str = "thread", async_db_threads: int = 4, retry_backoff_seconds: float = 30):
+        self.concurrency = max(1, concurrency)
+        self.mode = mode
+        self.async_db_threads = async_db_threads
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+        self._started_at = None
+        self._active: Dict[int, str] = {}  # job id -> worker id
+        self._busy_seconds = 0.0
+        self._jobs_completed = 0
+        self._jobs_failed = 0
+        self._jobs_retried = 0
+
+    def enqueue(self, email_id: int) -> ProcessingJob:
+        """Add a job to the current session. It becomes visible on commit."""
+        job = ProcessingJob(email_id=email_id, status='queued')
+        db.session.add(job)
+        self._wakeup.set()
+        return job
+
+    def enqueue_many(self, email_ids: List[int], available_at: Optional[List[Optional[datetime]]] = None,
+                     lane: str = "live"):
+        """Bulk-insert queued jobs into the current transaction. A job with an
+        available_at time is not claimed before then."""
+        if not email_ids:
+            return
+        release = available_at or [None] * len(email_ids)
+        db.session.execute(db.insert(ProcessingJob), [
+            {"email_id": email_id, "status": "queued", "available_at": at, "lane": lane}
+            for email_id, at in zip(email_ids, release)
+        ])
+        self._wakeup.set()
+
+    def release_times(self, count: int, rate_per_minute: float) -> List[Optional[datetime]]:
+        """Spread `count` jobs at `rate_per_minute`, after those already scheduled, or
+        release them all now if the rate is 0"""
+        if rate_per_minute <= 0:
+            return [None] * count
+        start = datetime.now(timezone.utc)
+        interval = dt.timedelta(seconds=60 / rate_per_minute)
+        latest = db.session.query(db.func.max(ProcessingJob.available_at)).filter(
+            ProcessingJob.status == 'queued'
+        ).scalar()
+        if latest is not None:
+            start = max(start, latest.replace(tzinfo=timezone.utc) + interval)
+        return [start + interval * index for index in range(count)]
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._started_at = time.monotonic()
+        self._recover_orphaned_emails()
+        if self.mode == "asyncio":
+            threading.Thread(target=self._run_event_loop, name="email-event-loop", daemon=True).start()
+        else:
+            for index in range(self.concurrency):
+                threading.Thread(
+                    target=self._worker_loop,
+                    args=(f"{os.getpid()}-{index}",),
+                    name=f"email-worker-{index}",
+                    daemon=True
+                ).start()
+        threading.Thread(target=self._lease_keeper_loop, name="email-lease-keeper", daemon=True).start()
+        print(f"🧵 Started {self.concurrency} email workers ({self.mode})")
+
+    def _recover_orphaned_emails(self):
+        """Queue emails that were received before the queue existed and never processed."""
+        with app.app_context():
+            queued_ids = db.session.query(ProcessingJob.email_id)
+            orphans = Email.query.filter(
+                Email.is_processed.is_(False),
+                Email.id.notin_(queued_ids)
+            ).all()
+            for email in orphans:
+                self.enqueue(email.id)
+            if orphans:
+                db.session.commit()
+                print(f"♻️ Re-queued {len(orphans)} unprocessed emails")
+
+    def _claimable(self, now: datetime):
+        return db.or_(
+            db.and_(
+                ProcessingJob.status == 'queued',
+                db.or_(ProcessingJob.available_at.is_(None), ProcessingJob.available_at <= now)
+            ),
+            db.and_(ProcessingJob.status == 'running', ProcessingJob.lease_expires_at < now)
+        )
+
+    def _claim(self, worker_id: str) -> Optional[ProcessingJob]:
+        now = datetime.now(timezone.utc)
+        candidate = ProcessingJob.query.filter(self._claimable(now)).order_by(ProcessingJob.id).first()
+        if not candidate:
+            return None
+        # Optimistic claim: only one worker's UPDATE can match the claimable row.
+        claimed = ProcessingJob.query.filter(
+            ProcessingJob.id == candidate.id,
+            self._claimable(now)
+        ).update({
+            "status": "running",
+            "worker_id": worker_id,
+            "attempts": ProcessingJob.attempts + 1,
+            "started_at": now,
+            "lease_expires_at": now + dt.timedelta(seconds=self.lease_seconds)
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed != 1:
+            return None
+        return db.session.get(ProcessingJob, candidate.id, populate_existing=True)
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None):
+        job = db.session.get(ProcessingJob, job_id, populate_existing=True)
+        job.status = status
+        job.finished_at = datetime.now(timezone.utc)
+        job.lease_expires_at = None
+        job.last_error = error
+        db.session.commit()
+
+    def _next_job(self, worker_id: str) -> Optional[tuple[int, int, Optional[float], str]]:
+        """Claim the next runnable job as (job id, email id, queue wait in seconds on its
+        first attempt, LLM lane), giving up on exhausted ones"""
+        with app.app_context():
+            while True:
+                job = self._claim(worker_id)
+                if not job:
+                    return None
+                job_id, email_id, attempts = job.id, job.email_id, job.attempts
+                if attempts > self.max_attempts:
+                    self._give_up(job_id, email_id)
+                    continue
+                queue_wait = None
+                if attempts == 1 and job.created_at:
+                    ready_at = max(job.created_at, job.available_at or job.created_at)
+                    queue_wait = max(0.0, (job.started_at - ready_at).total_seconds())
+                    QUEUE_WAIT.observe(queue_wait)
+                # Jobs queued by bulk ingestion yield the model to live mail
+                lane = job.lane or "live"
+                with self._lock:
+                    self._active[job_id] = worker_id
+                return job_id, email_id, queue_wait, lane
+
+    def _wait_for_work(self):
+        self._wakeup.wait(self.poll_seconds)
+        self._wakeup.clear()
+
+    def _job_done(self, job_id: int, email_id: int, started: float, error: Optional[str]):
+        with self._lock:
+            self._active.pop(job_id, None)
+            self._busy_seconds += time.monotonic() - started
+            if not error:
+                self._jobs_completed += 1
+        with app.app_context():
+            if error:
+                self._retry_or_give_up(job_id, email_id, error)
+            else:
+                self._finish(job_id, 'done')
+
+    def _retry_or_give_up(self, job_id: int, email_id: int, error: str):
+        """Queue a failed job again after an exponential backoff, or give up once it has
+        used all its attempts"""
+        job = db.session.get(ProcessingJob, job_id, populate_existing=True)
+        if job.attempts >= self.max_attempts:
+            self._give_up(job_id, email_id, error)
+            return
+        delay = self.retry_backoff_seconds * 2 ** (job.attempts - 1)
+        job.status = 'queued'
+        job.worker_id = None
+        job.lease_expires_at = None
+        job.available_at = datetime.now(timezone.utc) + dt.timedelta(seconds=delay)
+        job.last_error = error
+        db.session.commit()
+        with self._lock:
+            self._jobs_retried += 1
+        print(f"🔁 Job {job_id} for email {email_id} failed (attempt {job.attempts}), retrying in {delay:.0f}s")
+
+    def _worker_loop(self, worker_id: str):
+        while True:
+            try:
+                claimed = self._next_job(worker_id)
+                if not claimed:
+                    self._wait_for_work()
+                    continue
+                job_id, email_id, queue_wait, lane = claimed
+                started = time.monotonic()
+                error = None
+                try:
+                    process_email_async(email_id, queue_wait, lane)
+                except Exception as e:
+                    error = str(e)
+                self._job_done(job_id, email_id, started, error)
+            except Exception as e:
+                print(f"❌ Email worker {worker_id} error: {e}")
+                time.sleep(self.poll_seconds)
+
+    def _run_event_loop(self):
+        loop = asyncio.new_event_loop()
+        # Database calls made with asyncio.to_thread share this small pool
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.async_db_threads, thread_name_prefix="email-db"))
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self._async_dispatch_loop())
+
+    async def _async_dispatch_loop(self):
+        """Claim jobs while fewer than `concurrency` pipelines are in flight"""
+        worker_id = f"{os.getpid()}-async"
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+        while True:
+            await slots.acquire()
+            try:
+                claimed = await asyncio.to_thread(self._next_job, worker_id)
+            except Exception as e:
+                print(f"❌ Email worker {worker_id} error: {e}")
+                claimed = None
+            if not claimed:
+                slots.release()
+                await asyncio.to_thread(self._wait_for_work)
+                continue
+            task = asyncio.create_task(self._run_async_job(*claimed, slots))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    async def _run_async_job(self, job_id: int, email_id: int, queue_wait: Optional[float], lane: str,
+                             slots: asyncio.Semaphore):
+        started = time.monotonic()
+        error = None
+        try:
+            await aprocess_email(email_id, queue_wait, lane)
+        except Exception as e:
+            error = str(e)
+        finally:
+            slots.release()
+        try:
+            await asyncio.to_thread(self._job_done, job_id, email_id, started, error)
+        except Exception as e:
+            print(f"❌ Failed to finish job {job_id}: {e}")
+
+    def _give_up(self, job_id: int, email_id: int, error: Optional[str] = None):
+        error = error or f"Gave up after {self.max_attempts} attempts"
+        self._finish(job_id, 'failed', error)
+        record_processing_error(email_id, error)
+        with self._lock:
+            self._jobs_failed += 1
+        print(f"❌ Job {job_id} for email {email_id}: gave up after {self.max_attempts} attempts")
+
+    def _lease_keeper_loop(self):
+        """Extend leases of jobs still running in this process."""
+        interval = max(1.0, self.lease_seconds / 3)
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                job_ids = list(self._active)
+            if not job_ids:
+                continue
+            try:
+                with app.app_context():
+                    ProcessingJob.query.filter(
+                        ProcessingJob.id.in_(job_ids),
+                        ProcessingJob.status == 'running'
+                    ).update({
+                        "lease_expires_at": datetime.now(timezone.utc) + dt.timedelta(seconds=self.lease_seconds)
+                    }, synchronize_session=False)
+                    db.session.commit()
+            except Exception as e:
+                print(f"❌ Failed to renew job leases: {e}")
+
+    def stats(self) -> Dict:
+        now = datetime.now(timezone.utc)
+        queued = ProcessingJob.query.filter_by(status='queued').count()
+        running = ProcessingJob.query.filter_by(status='running').count()
+        expired = ProcessingJob.query.filter(
+            ProcessingJob.status == 'running',
+            ProcessingJob.lease_expires_at < now
+        ).count()
+        scheduled = ProcessingJob.query.filter(
+            ProcessingJob.status == 'queued',
+            ProcessingJob.available_at > now
+        ).count()
+        failed = ProcessingJob.query.filter_by(status='failed').count()
+        with self._lock:
+            busy = len(self._active)
+            busy_seconds = self._busy_seconds + 0.0
+            completed, failed_here, retried = self._jobs_completed, self._jobs_failed, self._jobs_retried
+            uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "queue_depth": queued - scheduled + expired,
+            "queued": queued,
+            "scheduled": scheduled,
+            "running": running,
+            "expired_leases": expired,
+            "failed": failed,
+            "workers": self.concurrency if self._started else 0,
+            "busy_workers": busy,
+            "utilization": busy / self.concurrency if self._started else 0.0,
+            "average_utilization": busy_seconds / (self.concurrency * uptime) if uptime else 0.0,
+            "jobs_completed": completed,
+            "jobs_failed": failed_here,
+            "jobs_retried": retried
+        }
+
+job_queue = EmailJobQueue(
+    concurrency=EMAIL_WORKER_CONCURRENCY,
+    lease_seconds=EMAIL_JOB_LEASE_SECONDS,
+    max_attempts=EMAIL_JOB_MAX_ATTEMPTS,
+    poll_seconds=EMAIL_JOB_POLL_SECONDS,
+    mode=EMAIL_WORKER_MODE,
+    async_db_threads=EMAIL_ASYNC_DB_THREADS,
+    retry_backoff_seconds=EMAIL_JOB_RETRY_BACKOFF_SECONDS
+)
+
+class Startup:
+    """Startup timings and the background warm-up of the lazy resources.
+
+    The first request starts the warm-up, which builds every LazyResource, imports
+    dateparser and builds the Calendar service so the first email does not pay for
+    them. /health reports the timings and whether the warm-up has finished."""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.import_seconds: Optional[float] = None
+        self.first_request_started: Optional[float] = None
+        self.first_request_seconds: Optional[float] = None
+        self.to_first_response_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.warmup_errors: Dict[str, str] = {}
+
+    def imported(self):
+        self.import_seconds = time.perf_counter() - IMPORT_STARTED
+        STARTUP_SECONDS.labels('import').set(self.import_seconds)
+
+    def request_started(self):
+        if self.first_request_started is not None:
+            return
+        with self._lock:
+            if self.first_request_started is not None:
+                return
+            self.first_request_started = time.perf_counter()
+            if self.enabled:
+                self._thread = threading.Thread(target=self._warm_up, name="startup-warmup", daemon=True)
+                self._thread.start()
+
+    def response_sent(self):
+        if self.first_request_seconds is None and self.first_request_started is not None:
+            now = time.perf_counter()
+            self.first_request_seconds = now - self.first_request_started
+            self.to_first_response_seconds = now - IMPORT_STARTED
+            STARTUP_SECONDS.labels('first_request').set(self.first_request_seconds)
+            STARTUP_SECONDS.labels('to_first_response').set(self.to_first_response_seconds)
+
+    def _warm_up(self):
+        started = time.perf_counter()
+        steps = [(resource.name, resource.get) for resource in LazyResource.registry]
+        steps += [("dateparser", lambda: importlib.import_module("dateparser")),
+                  ("calendar_service", calendar_client.warm_up)]
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                self.warmup_errors[name] = str(e)
+                print(f"❌ Warm-up of {name} failed: {e}")
+        self.warmup_seconds = time.perf_counter() - started
+        STARTUP_SECONDS.labels('warmup').set(self.warmup_seconds)
+        print(f"🔥 Warm-up finished in {self.warmup_seconds * 1000:.0f} ms")
 
-tools = [create_calendar_event, create_jira_ticket]
-model = ChatGoogleGenerativeAI(
-    model="gemini-2.0-flash-001",
-    temperature=0.1
-).bind_tools(tools)
+    @property
+    def ready(self) -> bool:
+        """Everything is built, or will be built on demand when the warm-up is off"""
+        return not self.enabled or self.warmup_seconds is not None
 
-def model_call(state: AgentState) -> AgentState:
-    message_history = state.get("messages", [])
-    new_messages = [
-        SystemMessage(
-            content="You are a helpful assistant that calls relevant tools based on the email content. "
-                    "If the email talks about a meeting, create a calendar event. If it mentions an issue, create a JIRA ticket."
-        ),
-        HumanMessage(
-            content=f"Email:\nSubject: {state.get('email_subject', '')}\n\n{state['email_body']}"
-        )
-    ]
+    def snapshot(self) -> Dict:
+        return {
+            "import_seconds": self.import_seconds,
+            "first_request_seconds": self.first_request_seconds,
+            "to_first_response_seconds": self.to_first_response_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "warmup_errors": self.warmup_errors,
+            "resources": {
+                resource.name: {"ready": resource.ready, "init_seconds": resource.init_seconds}
+                for resource in LazyResource.registry
+            }
+        }
 
-    response = model.invoke(new_messages)
-    state["messages"] = add_messages(message_history, [response])
+startup = Startup(STARTUP_WARMUP)
 
-    if isinstance(response, AIMessage) and getattr(response, "tool_calls", None):
-        state["tool_call"] = True
+@app.before_request
+def start_job_queue():
+    startup.request_started()
+    if EMAIL_WORKERS_IN_WEB:
+        job_queue.start()
+    stats_reconciler.start()
 
-    return state
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-def generate_reply(state: AgentState) -> AgentState:
-    email_subject = state.get("email_subject", "No subject")
-    email_body = state.get("email_body", "No body")
+@app.after_request
+def observe_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_LATENCY.labels(request.method, route, str(response.status_code)).observe(time.perf_counter() - started)
+    startup.response_sent()
+    return response
 
-    ticket_id = state.get("ticket_id")
-    meeting_summary = state.get("event_summary")
-    meeting_time = state.get("event_start")
-    meet_link = state.get("event_meet_link")
+def encode_cursor(sort_value, row_id: int, direction: str) -> str:
+    value = sort_value.isoformat() if isinstance(sort_value, datetime) else sort_value
+    raw = json.dumps([value, row_id, direction]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
 
-    ticket_info = f"A JIRA ticket has been created with ID: *{ticket_id}*." if ticket_id else ""
-    meeting_info = (
-        f"A meeting has been scheduled to discuss this:\n"
-        f"- Topic: *{meeting_summary}*\n"
-        f"- Time: {meeting_time}\n"
-        f"- Link: {meet_link}"
-        if meeting_summary and meeting_time and meet_link
-        else ""
-    )
+def decode_cursor(cursor: str, parse=datetime.fromisoformat) -> tuple:
+    try:
+        sort_value, row_id, direction = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return parse(sort_value), int(row_id), direction
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
 
-    context_parts = [part for part in [ticket_info, meeting_info] if part]
-    if not context_parts:
-        context_parts = ["We are reviewing your message and will get back to you shortly."]
+def page_size() -> int:
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Invalid limit")
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
 
-    context = "\n\n".join(context_parts)
+def paginate(query, sort_column, id_column, sort_attr: str, cursor: Optional[str], limit: int) -> tuple[list, Optional[str], Optional[str]]:
+    """Keyset pagination, newest first, on (sort_column, id_column).
 
-    prompt = (
-        "You're a helpful assistant drafting a professional reply to an email.\n\n"
-        f"Original email:\nSubject: {email_subject}\nBody: {email_body}\n\n"
-        f"Reply to the sender politely, using the following information:\n{context}\n\n"
-        "Respond only with the reply body."
-    )
+    Returns the page and the cursors for the next (older) and previous (newer) pages.
+    Every page is an index range scan from the cursor position, so deep pages cost
+    the same as the first one.
+    """
+    key = tuple_(sort_column, id_column)
+    direction = 'next'
+    if cursor:
+        sort_value, row_id, direction = decode_cursor(cursor)
+        query = query.filter(key < (sort_value, row_id) if direction == 'next' else key > (sort_value, row_id))
+    if direction == 'next':
+        rows = query.order_by(sort_column.desc(), id_column.desc()).limit(limit + 1).all()
+    else:
+        rows = query.order_by(sort_column.asc(), id_column.asc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+    if not rows:
+        return rows, None, None
 
-    response = vanilla_model.invoke(prompt)
-    reply = response.content.strip()
-    print(f"✉️ Generated reply: {reply}")
-    state["email_reply"] = reply
-    return state
+    def row_cursor(row, row_direction: str) -> str:
+        return encode_cursor(getattr(row, sort_attr), row.id, row_direction)
 
-def generate_summary(state: AgentState) -> AgentState:
-    """Generate a concise summary of the email"""
-    email_subject = state.get("email_subject", "No subject")
-    email_body = state.get("email_body", "No body")
-    
-    prompt = (
-        "Generate a concise 1-2 sentence summary of this email:\n\n"
-        f"Subject: {email_subject}\n"
-        f"Body: {email_body}\n\n"
-        "Focus on the main action items or key information."
-    )
-    
-    response = vanilla_model.invoke(prompt)
-    summary = response.content.strip()
-    state["ai_summary"] = summary
-    print(f"📄 Generated summary: {summary}")
-    return state
+    more_older = has_more if direction == 'next' else True
+    more_newer = bool(cursor) if direction == 'next' else has_more
+    next_cursor = row_cursor(rows[-1], 'next') if more_older else None
+    prev_cursor = row_cursor(rows[0], 'prev') if more_newer else None
+    return rows, next_cursor, prev_cursor
 
-def extract_tasks(state: AgentState) -> AgentState:
-    """Extract tasks from the email body and create Task objects"""
-    email_body = state.get("email_body", "")
-    email_subject = state.get("email_subject", "No subject")
-    prompt = (
-        "You are a task extraction assistant. Analyze this email and extract any actionable tasks or to-dos.\n"
-        "Return the tasks as a JSON array. Each task should have:\n"
-        "- title: Brief description of the task\n"
-        "- description: Detailed description if needed\n"
-        "- priority: 'high', 'normal', or 'low'\n"
-        "- due_date: If mentioned in the email (in ISO format), otherwise null\n\n"
-        f"Subject: {email_subject}\n"
-        f"Body: {email_body}\n\n"
-        "Examples of tasks to extract:\n"
-        "- 'Please review the document by Friday'\n"
-        "- 'Schedule a meeting with the team'\n"
-        "- 'Send the report to management'\n"
-        "- 'Follow up on the client request'\n\n"
-        "If no actionable tasks are found, return an empty array [].\n"
-        "Respond only with valid JSON."
-    )
-    try:
-        response = vanilla_model.invoke(prompt)
-        tasks_json = response.content.strip()
-        
-        # Clean up the response to ensure it's valid JSON
-        if tasks_json.startswith('```json'):
-            tasks_json = tasks_json[7:-3].strip()
-        elif tasks_json.startswith('```'):
-            tasks_json = tasks_json[3:-3].strip()
-        
-        tasks = json.loads(tasks_json)
-        state["extracted_tasks"] = tasks if isinstance(tasks, list) else []
-        print(f"📋 Extracted {len(state['extracted_tasks'])} tasks")
-        
-    except Exception as e:
-        print(f"❌ Error extracting tasks: {e}")
-        state["extracted_tasks"] = []
-    
-    return state
-
-
-# Build the LangGraph
-tool_node = ToolNode(tools=tools)
-graph = StateGraph(AgentState)
-
-graph.add_node("classify_email", classify_email)
-graph.add_node("send_notification", send_telegram_alert)
-graph.add_node("model_call", model_call)
-graph.add_node("tools", tool_node)
-graph.add_node("store_tool_outputs", store_tool_outputs)
-graph.add_node("generate_reply", generate_reply)
-graph.add_node("generate_summary", generate_summary)
-graph.add_node("extract_tasks", extract_tasks)
-
-graph.add_edge(START, "classify_email")
-graph.add_conditional_edges("classify_email", priority_check, {
-    "notify": "send_notification",
-    "skip": "model_call"
-})
-graph.add_edge("send_notification", "model_call")
-graph.add_conditional_edges(
-    "model_call",
-    lambda state: "tools" if state.get("tool_call") else "generate_summary"
-)
-graph.add_edge("tools", "store_tool_outputs")
-graph.add_edge("store_tool_outputs", "generate_summary")
-graph.add_edge("generate_summary", "generate_reply")
-graph.add_edge("generate_reply", "extract_tasks")
-graph.add_edge("extract_tasks", END)
-email_processor = graph.compile()
+def page_response(key: str, items: list, next_cursor: Optional[str], prev_cursor: Optional[str]) -> Response:
+    """`{key: items, next_cursor, prev_cursor}` when the request has a `cursor` parameter
+    (empty for the first page). Otherwise the bare list that older clients expect, with a
+    Link header to the next page."""
+    if 'cursor' in request.args:
+        return jsonify({key: items, "next_cursor": next_cursor, "prev_cursor": prev_cursor})
+    response = jsonify(items)
+    if next_cursor:
+        args = {**request.args.to_dict(), "cursor": next_cursor}
+        response.headers['Link'] = f'<{url_for(request.endpoint, **args)}>; rel="next"'
+    return response
+
+EMAIL_API_FIELDS = {
+    "id": lambda email: email.id,
+    "from": lambda email: email.from_address,
+    "to": lambda email: email.to_address,
+    "subject": lambda email: email.subject,
+    "body": lambda email: email.body or email.text_body,
+    "html_body": lambda email: email.html_body,
+    "received_at": lambda email: email.received_at.isoformat(),
+    "processed_at": lambda email: email.processed_at.isoformat() if email.processed_at else None,
+    "ai_summary": lambda email: email.ai_summary,
+    "ai_reply": lambda email: email.ai_reply,
+    "tags": lambda email: email.tags or [],
+    "priority": lambda email: email.priority,
+    "jira_ticket": lambda email: {
+        "ticket_id": email.jira_ticket_id,
+        "url": f"{JIRA_BASE_URL}/browse/{email.jira_ticket_id}",
+        "status": "Open"
+    } if email.jira_ticket_id else None,
+    "calendar_event": lambda email: {
+        "title": email.calendar_event_id,
+        "start_time": email.event_start_time.isoformat() if email.event_start_time else None,
+        "end_time": email.event_end_time.isoformat() if email.event_end_time else None,
+        "attendees": email.event_attendees or [],
+        "meet_link": email.meet_link,
+        "calendar_link": email.calendar_event_link
+    } if email.calendar_event_id else None,
+    "is_processed": lambda email: email.is_processed,
+    "processing_error": lambda email: email.processing_error,
+    "duplicate_of": lambda email: email.duplicate_of_id
+}
+# Fields read from the deferred 'content' group are only served by /api/emails/<id>
+EMAIL_CONTENT_FIELDS = ("body", "html_body", "ai_reply")
+EMAIL_LIST_FIELDS = tuple(name for name in EMAIL_API_FIELDS if name not in EMAIL_CONTENT_FIELDS)
 
-def process_email_async(email_id: int):
+def requested_fields(allowed: Sequence[str]) -> Sequence[str]:
+    """Fields named in the fields= query parameter, or all allowed fields"""
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+def format_email_for_api(email: Email, fields: Sequence[str] = tuple(EMAIL_API_FIELDS)) -> Dict:
+    return {name: EMAIL_API_FIELDS[name](email) for name in fields}
+
+def postmark_email_fields(data: Dict, received_at: Optional[datetime] = None) -> Dict:
+    """Email column values for a Postmark inbound payload"""
+    headers = {h.get('Name', '').lower(): h.get('Value', '') for h in data.get('Headers') or []}
+    return {
+        "from_address": data.get('From', ''),
+        "to_address": data.get('To', ''),
+        "subject": data.get('Subject', ''),
+        "body": data.get('HtmlBody', ''),
+        "text_body": data.get('TextBody', ''),
+        "html_body": data.get('HtmlBody', ''),
+        "headers": headers,
+        "message_id": headers.get('message-id') or data.get('MessageID') or None,
+        "received_at": received_at or datetime.now(timezone.utc)
+    }
+
+def payload_date(data: Dict) -> Optional[datetime]:
+    """The payload's Date in UTC, for archived mail keeping its original order"""
     try:
-        with app.app_context():
-            email = Email.query.get(email_id)
-            if not email:
-                return
-            inputs = {
-                "email_body": email.body or email.text_body,
-                "email_subject": email.subject,
-                "email_from": email.from_address,
-                "email_to": email.to_address
-            }
-            result = email_processor.invoke(inputs)
-            print(f"📧 Processing email {email_id} with LangGraph...")
-            print(f"Result: {result}")
-            email.ai_summary = result.get("ai_summary", "")
-            email.ai_reply = result.get("email_reply", "")
-            email.tags = result.get("email_tag", [])
-            email.priority = "urgent" if "urgent" in result.get("email_tag", []) else "normal"
-            email.jira_ticket_id = result.get("ticket_id")
-            email.calendar_event_id = result.get("event_summary")
-            email.calendar_event_link = result.get("event_calendar_link") if "event_calendar_link" in result else None
-            email.meet_link = result.get("event_meet_link")
-            if result.get("event_start"):
-                try:
-                    email.event_start_time = datetime.fromisoformat(result["event_start"].replace('Z', '+00:00'))
-                except:
-                    pass
-            if result.get("event_end"):
+        sent = parsedate_to_datetime(data.get('Date') or '')
+    except (TypeError, ValueError):
+        return None
+    return sent.astimezone(timezone.utc) if sent.tzinfo else sent.replace(tzinfo=timezone.utc)
+
+def decoded_header(value) -> str:
+    return str(make_header(decode_header(str(value)))) if value is not None else ''
+
+def postmark_payload_from_message(message: mailbox.mboxMessage) -> Dict:
+    """Convert an mbox message to the Postmark inbound shape"""
+    bodies = {}
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_disposition() == 'attachment':
+            continue
+        content_type = part.get_content_type()
+        payload = part.get_payload(decode=True)
+        if content_type in ('text/plain', 'text/html') and payload is not None and content_type not in bodies:
+            bodies[content_type] = payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    return {
+        "From": decoded_header(message.get('From')),
+        "To": decoded_header(message.get('To')),
+        "Subject": decoded_header(message.get('Subject')),
+        "Date": message.get('Date', ''),
+        "TextBody": bodies.get('text/plain', ''),
+        "HtmlBody": bodies.get('text/html', ''),
+        "Headers": [{"Name": name, "Value": decoded_header(value)} for name, value in message.items()]
+    }
+
+def read_ingest_records(path: str, fmt: str = "auto", skip: int = 0):
+    """Yield Postmark payloads from a JSONL, mbox or Postmark export (JSON) file, after
+    the first `skip` records. Unparseable JSONL lines yield None so record positions
+    stay stable for resume."""
+    if fmt == "auto":
+        extension = os.path.splitext(path)[1].lower()
+        fmt = {".jsonl": "jsonl", ".ndjson": "jsonl", ".mbox": "mbox"}.get(extension, "postmark")
+    if fmt == "jsonl":
+        with open(path, encoding='utf-8') as f:
+            lines = ((number, line) for number, line in enumerate(f, 1) if line.strip())
+            for line_number, line in itertools.islice(lines, skip, None):
                 try:
-                    email.event_end_time = datetime.fromisoformat(result["event_end"].replace('Z', '+00:00'))
-                except:
-                    pass
-            email.event_attendees = result.get("event_attendees", [])
-            extracted_tasks = result.get("extracted_tasks", [])
-            for task_data in extracted_tasks:
-                task = Task(
-                    email_id=email.id,
-                    title=task_data.get("title", ""),
-                    description=task_data.get("description", ""),
-                    priority=task_data.get("priority", "normal"),
-                    due_date=datetime.fromisoformat(task_data["due_date"]) if task_data.get("due_date") else None
-                )
-                db.session.add(task)
-            email.is_processed = True
-            email.processed_at = datetime.now(timezone.utc)
-            db.session.commit()
-            print(f"✅ Email {email_id} processed successfully")
-    except Exception as e:
-        with app.app_context():
-            email = Email.query.get(email_id)
-            if email:
-                email.processing_error = str(e)
-                email.is_processed = True
-                email.processed_at = datetime.now(timezone.utc)
-                db.session.commit()
-        print(f"❌ Error processing email {email_id}: {e}")
+                    yield json.loads(line)
+                except ValueError:
+                    print(f"⚠️ Skipping malformed JSON on line {line_number}")
+                    yield None
+    elif fmt == "mbox":
+        messages = itertools.islice(mailbox.mbox(path, create=False), skip, None)
+        yield from (postmark_payload_from_message(message) for message in messages)
+    else:
+        with open(path, encoding='utf-8') as f:
+            yield from postmark_export_messages(json.load(f))[skip:]
 
-def format_email_for_api(email: Email) -> Dict:
+def postmark_export_messages(data) -> list:
+    """Messages of a Postmark export: a list, or the InboundMessages/Messages of a response"""
+    if isinstance(data, dict):
+        data = data.get('InboundMessages', data.get('Messages'))
+    if not isinstance(data, list):
+        raise ValueError("Expected a list of Postmark messages")
+    return data
+
+def ingest_email_chunk(payloads: List[Optional[Dict]], rate_per_minute: float) -> Dict:
+    """Insert a chunk of payloads and their processing jobs in one transaction.
+    Emails whose Message-ID is already stored are skipped."""
+    rows = [postmark_email_fields(p, payload_date(p)) for p in payloads if isinstance(p, dict)]
+    message_ids = {row["message_id"] for row in rows if row["message_id"]}
+    seen = set(db.session.scalars(
+        db.select(Email.message_id).where(Email.message_id.in_(message_ids))
+    )) if message_ids else set()
+    fresh = []
+    for row in rows:
+        if row["message_id"]:
+            if row["message_id"] in seen:
+                continue
+            seen.add(row["message_id"])
+        fresh.append(row)
+    email_ids = []
+    delta = {}
+    if fresh:
+        email_ids = list(db.session.scalars(
+            db.insert(Email).returning(Email.id, sort_by_parameter_order=True), fresh
+        ))
+        job_queue.enqueue_many(email_ids, job_queue.release_times(len(email_ids), rate_per_minute), lane="backfill")
+        delta = {"total_emails": len(email_ids)}
+        apply_stats_delta(delta)
+    db.session.commit()
+    if delta:
+        event_broker.publish("stats_delta", {"emails": delta})
     return {
-        "id": email.id,
-        "from": email.from_address,
-        "to": email.to_address,
-        "subject": email.subject,
-        "body": email.body or email.text_body,
-        "html_body": email.html_body,
-        "received_at": email.received_at.isoformat(),
-        "processed_at": email.processed_at.isoformat() if email.processed_at else None,
-        "ai_summary": email.ai_summary,
-        "ai_reply": email.ai_reply,
-        "tags": email.tags or [],
-        "priority": email.priority,
-        "jira_ticket": {
-            "ticket_id": email.jira_ticket_id,
-            "url": f"https://{JIRA_DOMAIN}/browse/{email.jira_ticket_id}" if email.jira_ticket_id else None,
-            "status": "Open"
-        } if email.jira_ticket_id else None,
-        "calendar_event": {
-            "title": email.calendar_event_id,
-            "start_time": email.event_start_time.isoformat() if email.event_start_time else None,
-            "end_time": email.event_end_time.isoformat() if email.event_end_time else None,
-            "attendees": email.event_attendees or [],
-            "meet_link": email.meet_link,
-            "calendar_link": email.calendar_event_link
-        } if email.calendar_event_id else None,
-        "is_processed": email.is_processed,
-        "processing_error": email.processing_error
+        "email_ids": email_ids,
+        "inserted": len(email_ids),
+        "duplicates": len(rows) - len(fresh),
+        "invalid": len(payloads) - len(rows)
     }
 
+def ingest_emails(payloads, chunk_size: int = INGEST_CHUNK_SIZE, rate_per_minute: float = INGEST_RATE_PER_MINUTE,
+                  on_chunk=None) -> Dict:
+    """Ingest an iterable of payloads chunk by chunk. on_chunk(totals) runs after each commit."""
+    totals = {"records": 0, "inserted": 0, "duplicates": 0, "invalid": 0, "email_ids": []}
+    records = iter(payloads)
+    while True:
+        chunk = list(itertools.islice(records, max(1, chunk_size)))
+        if not chunk:
+            return totals
+        result = ingest_email_chunk(chunk, rate_per_minute)
+        totals["records"] += len(chunk)
+        for key in ("inserted", "duplicates", "invalid"):
+            totals[key] += result[key]
+        totals["email_ids"].extend(result["email_ids"])
+        if on_chunk:
+            on_chunk(totals)
+
 @app.route('/inbound', methods=['POST'])
 def handle_inbound_email():
     try:
-        data = request.json
-        email = Email(
-            from_address=data.get('From', ''),
-            to_address=data.get('To', ''),
-            subject=data.get('Subject', ''),
-            body=data.get('HtmlBody', ''),
-            text_body=data.get('TextBody', ''),
-            html_body=data.get('HtmlBody', ''),
-            received_at=datetime.now(timezone.utc)
-        )
+        # Parsed from the stream so attachments never sit in memory as base64
+        data, blobs = read_inbound_payload(request.stream)
+        email = Email(**postmark_email_fields(data))
+        email.attachments = postmark_attachments(data, blobs)
         db.session.add(email)
+        db.session.flush()
+        job_queue.enqueue(email.id)
+        delta = stats_delta(email_stats_counts(None), email_stats_counts(email))
+        apply_stats_delta(delta)
         db.session.commit()
-        threading.Thread(
-            target=process_email_async,
-            args=(email.id,),
-            daemon=True
-        ).start()
-        print(f"✅ Email received and queued for processing: {email.subject}")
+        event_broker.publish("email_received", {"email": format_email_for_api(email, ("id", "from", "subject", "received_at"))})
+        event_broker.publish("stats_delta", {"emails": delta})
+        print(f"✅ Email received and queued for processing: {email.subject}"
+              + (f" ({len(email.attachments)} attachments)" if email.attachments else ""))
         return jsonify({"status": "received", "email_id": email.id}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"❌ Error handling inbound email: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/inbound/batch', methods=['POST'])
+def handle_inbound_batch():
+    """Ingest many Postmark payloads: a JSON list, a Postmark export object or JSONL."""
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            payloads = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        else:
+            payloads = postmark_export_messages(request.get_json(force=True))
+        if len(payloads) > INGEST_BATCH_MAX_SIZE:
+            return jsonify({"error": f"At most {INGEST_BATCH_MAX_SIZE} emails per batch"}), 413
+        rate = float(request.args.get('rate', INGEST_RATE_PER_MINUTE))
+        totals = ingest_emails(payloads, rate_per_minute=rate)
+        print(f"📥 Batch ingested: {totals['inserted']} new, {totals['duplicates']} duplicates, {totals['invalid']} invalid")
+        return jsonify({"status": "received", **totals}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error handling inbound batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/emails', methods=['GET'])
 def get_emails():
     try:
         filter_type = request.args.get('filter', 'all')
         if filter_type == 'all':
-            emails = Email.query.filter_by(is_processed=True).order_by(Email.received_at.desc()).limit(50).all()
+            query = Email.query.filter_by(is_processed=True)
+            sort_column, id_column = Email.received_at, Email.id
         else:
-            all_emails = Email.query.filter_by(is_processed=True).order_by(Email.received_at.desc()).all()
-            filtered_emails = []
-            for email in all_emails:
-                tags = email.tags or []
-                if filter_type == 'urgent':
-                    if 'urgent' in tags or email.priority == 'urgent':
-                        filtered_emails.append(email)
-                elif filter_type == 'high-priority':
-                    if 'high_priority' in tags or 'high-priority' in tags:
-                        filtered_emails.append(email)
-                elif filter_type == 'low-priority':
-                    if 'low_priority' in tags or 'low-priority' in tags:
-                        filtered_emails.append(email)
-                elif filter_type == 'meeting':
-                    if 'meeting' in tags or email.calendar_event_id:
-                        filtered_emails.append(email)
-                elif filter_type == 'issue':
-                    if 'issue' in tags or email.jira_ticket_id:
-                        filtered_emails.append(email)
-                elif filter_type in tags:
-                    filtered_emails.append(email)
-            emails = filtered_emails[:50]
-        return jsonify([format_email_for_api(email) for email in emails])
+            # Filters such as "high-priority" or "meeting" map onto one normalised label
+            query = (
+                Email.query.join(EmailTag, EmailTag.email_id == Email.id)
+                .filter(EmailTag.tag == normalize_tag(filter_type), Email.is_processed.is_(True))
+            )
+            sort_column, id_column = EmailTag.received_at, EmailTag.email_id
+        fields = requested_fields(EMAIL_LIST_FIELDS)
+        emails, next_cursor, prev_cursor = paginate(
+            query, sort_column, id_column, 'received_at', request.args.get('cursor'), page_size()
+        )
+        return page_response("emails", [format_email_for_api(email, fields) for email in emails], next_cursor, prev_cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error in get_emails: {e}")
         return jsonify({"error": str(e)}), 500
 
+def naive_utc(value: str) -> datetime:
+    """An ISO date or datetime parameter as naive UTC, the way received_at is stored"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@app.route('/api/search', methods=['GET'])
+def search_emails():
+    """Full-text search over subject, sender, body and AI summary, best matches first"""
+    try:
+        query = fts_query(request.args.get('q', ''))
+        if not query:
+            return jsonify({"error": "Query parameter q is required"}), 400
+        fields = requested_fields(EMAIL_LIST_FIELDS)
+        limit = page_size()
+        score = "bm25(email_fts, {})".format(", ".join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS))
+        joins, conditions, bounds = [], ["email_fts MATCH :query"], []
+        params = {"query": query, "limit": limit + 1}
+        if request.args.get('tag'):
+            joins.append("JOIN email_tag ON email_tag.email_id = email_fts.rowid AND email_tag.tag = :tag")
+            params["tag"] = normalize_tag(request.args['tag'])
+        if request.args.get('since') or request.args.get('until'):
+            joins.append("JOIN email ON email.id = email_fts.rowid")
+            # Bound as DateTime so they are formatted the way received_at is stored
+            if request.args.get('since'):
+                conditions.append("email.received_at >= :since")
+                params["since"] = naive_utc(request.args['since'])
+                bounds.append(db.bindparam("since", type_=db.DateTime))
+            if request.args.get('until'):
+                conditions.append("email.received_at < :until")
+                params["until"] = naive_utc(request.args['until'])
+                bounds.append(db.bindparam("until", type_=db.DateTime))
+        if request.args.get('cursor'):
+            params["score"], params["after_id"], _ = decode_cursor(request.args['cursor'], parse=float)
+            conditions.append(f"({score} > :score OR ({score} = :score AND email_fts.rowid > :after_id))")
+        rows = db.session.execute(db.text(
+            f"SELECT email_fts.rowid, {score} AS score, "
+            "snippet(email_fts, -1, '<mark>', '</mark>', '…', 16) AS snippet "
+            f"FROM email_fts {' '.join(joins)} WHERE {' AND '.join(conditions)} "
+            "ORDER BY score, email_fts.rowid LIMIT :limit"
+        ).bindparams(*bounds), params).all()
+        next_cursor = encode_cursor(rows[limit - 1].score, rows[limit - 1].rowid, 'next') if len(rows) > limit else None
+        rows = rows[:limit]
+        emails = {email.id: email for email in Email.query.filter(Email.id.in_([row.rowid for row in rows]))}
+        results = [
+            {**format_email_for_api(emails[row.rowid], fields), "snippet": row.snippet, "score": row.score}
+            for row in rows if row.rowid in emails
+        ]
+        return jsonify({"results": results, "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/emails/<int:email_id>', methods=['GET'])
 def get_email_details(email_id):
     try:
-        email = Email.query.get_or_404(email_id)
-        return jsonify(format_email_for_api(email))
+        fields = requested_fields(tuple(EMAIL_API_FIELDS))
+        email = db.get_or_404(Email, email_id, options=[db.undefer_group('content')])
+        return jsonify(format_email_for_api(email, fields))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def format_attachment_for_api(attachment: Attachment) -> Dict:
+    return {
+        "id": attachment.id,
+        "email_id": attachment.email_id,
+        "name": attachment.name,
+        "content_type": attachment.content_type,
+        "content_id": attachment.content_id,
+        "size": attachment.size,
+        "sha256": attachment.sha256
+    }
+
+@app.route('/api/emails/<int:email_id>/attachments', methods=['GET'])
+def get_email_attachments(email_id):
+    try:
+        attachments = Attachment.query.filter_by(email_id=email_id).order_by(Attachment.id).all()
+        return jsonify({"attachments": [format_attachment_for_api(attachment) for attachment in attachments]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/attachments/<int:attachment_id>', methods=['GET'])
+def download_attachment(attachment_id):
+    """The attachment's content, streamed from the blob store"""
+    try:
+        attachment = db.get_or_404(Attachment, attachment_id)
+        path = blob_store.path(attachment.sha256)
+        if not os.path.exists(path):
+            return jsonify({"error": "Attachment content is missing from the store"}), 404
+        return send_file(
+            os.path.abspath(path),
+            mimetype=attachment.content_type or 'application/octet-stream',
+            as_attachment=True,
+            download_name=attachment.name,
+            etag=attachment.sha256
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def format_trace_for_api(trace: EmailTrace, include_spans: bool = False) -> Dict:
+    data = {
+        "id": trace.id,
+        "email_id": trace.email_id,
+        "mode": trace.mode,
+        "outcome": trace.outcome,
+        "started_at": trace.started_at.isoformat(),
+        "queue_wait_ms": trace.queue_wait_ms,
+        "duration_ms": trace.duration_ms,
+        "llm_calls": trace.llm_calls,
+        "cache_hits": trace.cache_hits,
+        "input_tokens": trace.input_tokens,
+        "output_tokens": trace.output_tokens,
+        "error": trace.error
+    }
+    if include_spans:
+        data["spans"] = trace.spans or []
+    return data
+
+@app.route('/api/emails/<int:email_id>/traces', methods=['GET'])
+def get_email_traces(email_id):
+    """Processing attempts of one email with their node, LLM and tool spans"""
+    try:
+        traces = (
+            EmailTrace.query.options(db.undefer(EmailTrace.spans))
+            .filter_by(email_id=email_id)
+            .order_by(EmailTrace.started_at.desc())
+            .all()
+        )
+        return jsonify({"traces": [format_trace_for_api(trace, include_spans=True) for trace in traces]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/traces', methods=['GET'])
+def get_slowest_traces():
+    """Slowest processing attempts since `since` (default: the last 24 hours)"""
+    try:
+        since = request.args.get('since')
+        since = datetime.fromisoformat(since) if since else datetime.now(timezone.utc) - dt.timedelta(days=1)
+        query = EmailTrace.query.filter(EmailTrace.started_at >= since)
+        if request.args.get('outcome'):
+            query = query.filter(EmailTrace.outcome == request.args['outcome'])
+        traces = query.order_by(EmailTrace.duration_ms.desc()).limit(page_size()).all()
+        return jsonify({"traces": [format_trace_for_api(trace) for trace in traces]})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -703,10 +4571,12 @@ def save_user_preferences():
         prefs.work_summary = data.get('workSummary', '')
         prefs.urgent_criteria = data.get('urgentEmails', '')
         prefs.high_priority_criteria = data.get('highPriorityEmails', '')
+        prefs.version = (prefs.version or 0) + 1
         prefs.updated_at = datetime.now(timezone.utc)
         
         db.session.add(prefs)
         db.session.commit()
+        preferences_cache.invalidate(user_id, prefs.version)
         
         return jsonify({"status": "saved", "message": "Preferences saved successfully"})
         
@@ -726,33 +4596,120 @@ def get_user_preferences():
         return jsonify({
             "workSummary": prefs.work_summary,
             "urgentEmails": prefs.urgent_criteria,
-            "highPriorityEmails": prefs.high_priority_criteria
+            "highPriorityEmails": prefs.high_priority_criteria,
+            "version": prefs.version
         })
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def format_rule_for_api(rule: ClassificationRule) -> Dict:
+    return {
+        "id": rule.id,
+        "field": rule.field,
+        "pattern": rule.pattern,
+        "tag": rule.tag,
+        "confidence": rule.confidence,
+        "position": rule.position,
+        "enabled": rule.enabled,
+        "hits": rule_engine.rule_hits.get(rule.id, 0)
+    }
+
+@app.route('/api/rules', methods=['GET'])
+def get_classification_rules():
+    """Get the user's classification rules"""
+    try:
+        rules = ClassificationRule.query.filter_by(user_id="default_user").order_by(
+            ClassificationRule.position, ClassificationRule.id
+        ).all()
+        return jsonify([format_rule_for_api(rule) for rule in rules])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rules', methods=['POST'])
+def create_classification_rule():
+    """Create a rule that tags matching emails without an LLM call"""
+    try:
+        data = request.json
+        field = (data.get('field') or '').lower()
+        pattern = data.get('pattern') or ''
+        tag = data.get('tag')
+        if not tag:
+            return jsonify({"error": "Tag is required"}), 400
+        try:
+            RuleEngine.validate(field, pattern)
+        except (ValueError, re.error) as e:
+            return jsonify({"error": str(e)}), 400
+
+        rule = ClassificationRule(
+            user_id="default_user",
+            field=field,
+            pattern=pattern,
+            tag=tag,
+            confidence=float(data.get('confidence', 1.0)),
+            position=int(data.get('position', 0)),
+            enabled=bool(data.get('enabled', True))
+        )
+        db.session.add(rule)
+        db.session.commit()
+        rule_engine.invalidate("default_user")
+        return jsonify(format_rule_for_api(rule))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rules/<int:rule_id>', methods=['DELETE'])
+def delete_classification_rule(rule_id):
+    """Delete a classification rule"""
+    try:
+        rule = ClassificationRule.query.get_or_404(rule_id)
+        db.session.delete(rule)
+        db.session.commit()
+        rule_engine.invalidate("default_user")
+        return jsonify({"message": "Rule deleted successfully"})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/classification/batches', methods=['GET'])
+def get_classification_batch_stats():
+    """Get micro-batching counters for LLM classification"""
+    try:
+        return jsonify(classification_batcher.stats() if classification_batcher else {"enabled": False})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rules/stats', methods=['GET'])
+def get_rule_stats():
+    """Get rule hit rates and the number of LLM classifications they saved"""
+    try:
+        return jsonify(rule_engine.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/stats', methods=['GET'])
 def get_email_stats():
     """Get email statistics for dashboard"""
     try:
-        total_emails = Email.query.count()
-        processed_emails = Email.query.filter_by(is_processed=True).count()
-        urgent_emails = Email.query.filter(Email.tags.contains(['urgent'])).count()
-        tickets_created = Email.query.filter(Email.jira_ticket_id.isnot(None)).count()
-        meetings_scheduled = Email.query.filter(Email.calendar_event_id.isnot(None)).count()
-        
-        return jsonify({
-            "total_emails": total_emails,
-            "processed_emails": processed_emails,
-            "urgent_emails": urgent_emails,
-            "tickets_created": tickets_created,
-            "meetings_scheduled": meetings_scheduled
-        })
+        counters = stats_reconciler.counters()
+        return jsonify({name: getattr(counters, name) for name in EMAIL_STATS})
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def format_task_for_api(task: Task) -> Dict:
+    return {
+        "id": task.id,
+        "email_id": task.email_id,
+        "title": task.title,
+        "description": task.description,
+        "priority": task.priority,
+        "status": task.status,
+        "due_date": task.due_date.isoformat() if task.due_date else None,
+        "created_at": task.created_at.isoformat(),
+        "completed_at": task.completed_at.isoformat() if task.completed_at else None,
+        "email_subject": task.email.subject if task.email else None,
+        "email_from": task.email.from_address if task.email else None
+    }
+
 @app.route('/api/tasks', methods=['GET'])
 def get_tasks():
     """Get all tasks with optional filtering"""
@@ -768,26 +4725,17 @@ def get_tasks():
         if priority != 'all':
             query = query.filter_by(priority=priority)
         
-        tasks = query.order_by(Task.created_at.desc()).all()
-        
-        task_list = []
-        for task in tasks:
-            task_list.append({
-                "id": task.id,
-                "email_id": task.email_id,
-                "title": task.title,
-                "description": task.description,
-                "priority": task.priority,
-                "status": task.status,
-                "due_date": task.due_date.isoformat() if task.due_date else None,
-                "created_at": task.created_at.isoformat(),
-                "completed_at": task.completed_at.isoformat() if task.completed_at else None,
-                "email_subject": task.email.subject if task.email else None,
-                "email_from": task.email.from_address if task.email else None
-            })
+        query = query.options(joinedload(Task.email).load_only(Email.subject, Email.from_address))
+        tasks, next_cursor, prev_cursor = paginate(
+            query, Task.created_at, Task.id, 'created_at', request.args.get('cursor'), page_size()
+        )
+        
+        task_list = [format_task_for_api(task) for task in tasks]
         
-        return jsonify(task_list)
+        return page_response("tasks", task_list, next_cursor, prev_cursor)
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -796,6 +4744,7 @@ def toggle_task_status(task_id):
     """Toggle task completion status"""
     try:
         task = Task.query.get_or_404(task_id)
+        before = task_stats_counts(task)
         
         if task.status == 'completed':
             task.status = 'pending'
@@ -804,7 +4753,10 @@ def toggle_task_status(task_id):
             task.status = 'completed'
             task.completed_at = datetime.now(timezone.utc)
         
+        delta = stats_delta(before, task_stats_counts(task))
+        apply_stats_delta(delta)
         db.session.commit()
+        publish_task_changed("updated", format_task_for_api(task), delta)
         
         return jsonify({
             "id": task.id,
@@ -830,7 +4782,11 @@ def create_task():
         )
         
         db.session.add(task)
+        db.session.flush()
+        delta = stats_delta(task_stats_counts(None), task_stats_counts(task))
+        apply_stats_delta(delta)
         db.session.commit()
+        publish_task_changed("created", format_task_for_api(task), delta)
         
         return jsonify({
             "id": task.id,
@@ -846,8 +4802,12 @@ def delete_task(task_id):
     """Delete a task"""
     try:
         task = Task.query.get_or_404(task_id)
+        task_data = format_task_for_api(task)
+        delta = stats_delta(task_stats_counts(task), task_stats_counts(None))
         db.session.delete(task)
+        apply_stats_delta(delta)
         db.session.commit()
+        publish_task_changed("deleted", task_data, delta)
         
         return jsonify({"message": "Task deleted successfully"})
         
@@ -858,47 +4818,352 @@ def delete_task(task_id):
 def get_task_stats():
     """Get task statistics"""
     try:
-        total_tasks = Task.query.count()
-        pending_tasks = Task.query.filter_by(status='pending').count()
-        completed_tasks = Task.query.filter_by(status='completed').count()
-        high_priority_tasks = Task.query.filter_by(priority='high', status='pending').count()
-        
-        # Tasks due today or overdue
-        today = datetime.now(timezone.utc).date()
-        overdue_tasks = Task.query.filter(
-            Task.due_date < datetime.now(timezone.utc),
-            Task.status == 'pending'
-        ).count()
-        
-        return jsonify({
-            "total_tasks": total_tasks,
-            "pending_tasks": pending_tasks,
-            "completed_tasks": completed_tasks,
-            "high_priority_tasks": high_priority_tasks,
-            "overdue_tasks": overdue_tasks
-        })
+        counters = stats_reconciler.counters()
+        stats = {name: getattr(counters, name) for name in TASK_STATS}
+        stats["overdue_tasks"] = count_overdue_tasks()
+        return jsonify(stats)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@app.route('/api/pipeline/stats', methods=['GET'])
+def get_pipeline_stats():
+    """Get latency and token usage per pipeline mode"""
+    try:
+        return jsonify(pipeline_stats.snapshot())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/llm-cache/stats', methods=['GET'])
+def get_llm_cache_stats():
+    """Get LLM response cache hit/miss counters"""
+    try:
+        return jsonify(llm_cache.stats() if llm_cache else {"enabled": False})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/llm-limiter/stats', methods=['GET'])
+def get_llm_limiter_stats():
+    """Get the LLM rate limiter's quotas, concurrency limit and per-lane counters"""
+    try:
+        return jsonify(llm_limiter.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/integrations/stats', methods=['GET'])
+def get_integration_stats():
+    """Get request, retry and failure counts for JIRA and Telegram"""
+    try:
+        return jsonify({"jira": jira_client.stats(), "telegram": telegram_client.stats()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/calendar/stats', methods=['GET'])
+def get_calendar_stats():
+    """Get Google Calendar client state and batching counters"""
+    try:
+        return jsonify(calendar_client.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/queue/stats', methods=['GET'])
+def get_queue_stats():
+    """Get processing queue depth and worker utilisation"""
+    try:
+        return jsonify(job_queue.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
     
     
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """Server-Sent Events feed of email, task and stats changes"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+    if not event_broker.acquire():
+        return jsonify({"error": "Too many open event streams"}), 503, {"Retry-After": "30"}
+    try:
+        stream = event_broker.stream(last_event_id, EVENT_HEARTBEAT_SECONDS)
+    except Exception:
+        event_broker.release()
+        raise
+    response = Response(stream, mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # Also runs when the client goes away before the stream started
+    response.call_on_close(event_broker.release)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text exposition of the pipeline, LLM, tool, integration and route metrics"""
+    try:
+        QUEUE_DEPTH.set(job_queue.stats()["queue_depth"])
+    except Exception as e:
+        print(f"❌ Failed to read queue depth: {e}")
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()})
+    """Liveness, plus readiness: "starting" until the warm-up has finished. With ?ready=1
+    the status code is 503 until then, for load balancer readiness checks."""
+    ready = startup.ready
+    body = {
+        "status": "healthy" if ready else "starting",
+        "ready": ready,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "startup": startup.snapshot()
+    }
+    return jsonify(body), 503 if request.args.get('ready') and not ready else 200
 
 
+# The backfills select only the columns they read, so migrations 5 and 7 still run on a
+# database that later migrations have not yet brought up to the current Email model.
+def processed_email_rows(columns, last_id: int):
+    return db.session.execute(
+        db.select(Email.id, *columns)
+        .where(Email.is_processed.is_(True), Email.id > last_id)
+        .order_by(Email.id).limit(500)
+    ).all()
+
+def backfill_email_tags():
+    """Rebuild the email_tag rows of all processed emails, in chunks"""
+    last_id, count = 0, 0
+    while True:
+        emails = processed_email_rows(
+            (Email.tags, Email.calendar_event_id, Email.jira_ticket_id, Email.received_at), last_id
+        )
+        if not emails:
+            break
+        last_id = emails[-1].id
+        for email in emails:
+            sync_email_tags(email)
+        db.session.commit()
+        count += len(emails)
+        print(f"🏷️ Backfilled tags for {count} emails")
+
+def rebuild_search_index():
+    """Create email_fts if needed and index every processed email, in chunks"""
+    db.session.execute(db.text(EMAIL_FTS_DDL))
+    db.session.execute(db.text("DELETE FROM email_fts"))
+    last_id, count = 0, 0
+    while True:
+        emails = processed_email_rows(
+            (Email.subject, Email.from_address, Email.text_body, Email.body, Email.ai_summary), last_id
+        )
+        if not emails:
+            break
+        last_id = emails[-1].id
+        for email in emails:
+            index_email_for_search(email)
+        db.session.commit()
+        count += len(emails)
+        print(f"🔎 Indexed {count} emails for search")
+    db.session.execute(db.text("INSERT INTO email_fts (email_fts) VALUES ('optimize')"))
+    db.session.commit()
+
+def add_column_if_missing(table: str, column: str, ddl: str):
+    columns = {row[1] for row in db.session.execute(db.text(f"PRAGMA table_info({table})"))}
+    if column not in columns:
+        db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        print(f"➕ Added {table}.{column}")
+
+def drop_column_if_present(table: str, column: str):
+    columns = {row[1] for row in db.session.execute(db.text(f"PRAGMA table_info({table})"))}
+    if column in columns:
+        db.session.execute(db.text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        print(f"➖ Dropped {table}.{column}")
+
+def create_index(name: str, table: str, *columns: str):
+    db.session.execute(db.text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+# Indexes created by migration 4, as the schema stood then. Later migrations create the
+# indexes of the columns they add, so no step depends on columns added after it.
+QUERY_INDEXES = (
+    ("ix_email_processed_received", "email", "is_processed", "received_at", "id"),
+    ("ix_email_jira_ticket", "email", "jira_ticket_id"),
+    ("ix_email_calendar_event", "email", "calendar_event_id"),
+    ("ix_email_tag_tag_received", "email_tag", "tag", "received_at", "email_id"),
+    ("ix_task_created", "task", "created_at", "id"),
+    ("ix_task_status_created", "task", "status", "created_at", "id"),
+    ("ix_task_priority_created", "task", "priority", "created_at", "id"),
+    ("ix_task_status_due", "task", "status", "due_date"),
+    ("ix_task_email", "task", "email_id"),
+    ("ix_processing_job_status_lease", "processing_job", "status", "lease_expires_at"),
+    ("ix_processing_job_email", "processing_job", "email_id"),
+)
+
+def backfill_missing_email_tags():
+    if db.session.scalar(db.select(EmailTag.email_id).limit(1)) is None:
+        backfill_email_tags()
+
+# Schema migrations, applied in order and recorded in schema_migrations. Each step is
+# idempotent, so a database created by create_all can be migrated safely. Steps read
+# through raw SQL or column selects, never whole model rows, since the model already has
+# the columns of later steps.
+MIGRATIONS = [
+    (1, "create missing tables", lambda: db.create_all()),
+    (2, "add email headers and near-duplicate columns", lambda: (
+        add_column_if_missing("email", "headers", "JSON"),
+        add_column_if_missing("email", "fingerprint", "BIGINT"),
+        add_column_if_missing("email", "duplicate_of_id", "INTEGER REFERENCES email(id)")
+    )),
+    (3, "add user preferences version", lambda: add_column_if_missing(
+        "user_preferences", "version", "INTEGER NOT NULL DEFAULT 1"
+    )),
+    (4, "create indexes", lambda: [create_index(*index) for index in QUERY_INDEXES]),
+    (5, "backfill email tags", backfill_missing_email_tags),
+    (6, "reconcile stats counters", lambda: stats_reconciler.reconcile()),
+    (7, "create and fill the full-text search index", rebuild_search_index),
+    (8, "add bulk ingestion columns", lambda: (
+        add_column_if_missing("email", "message_id", "VARCHAR(500)"),
+        add_column_if_missing("processing_job", "available_at", "DATETIME"),
+        create_index("ix_email_message_id", "email", "message_id")
+    )),
+    (9, "create email traces table", lambda: db.create_all()),
+    (10, "add cleaned email body", lambda: add_column_if_missing("email", "clean_body", "TEXT")),
+    (11, "create attachments table", lambda: db.create_all()),
+    # Jobs queued before the upgrade have no record of their origin (available_at is also set
+    # by retries), so they all run as live mail
+    (12, "add processing job lane", lambda: add_column_if_missing(
+        "processing_job", "lane", "VARCHAR(20) DEFAULT 'live'"
+    )),
+    (13, "create side effects table", lambda: db.create_all()),
+    (14, "drop overdue tasks counter", lambda: drop_column_if_present("stats_counters", "overdue_tasks")),
+    (15, "create change event feed", lambda: db.create_all()),
+]
+
+def migrate_database() -> list[str]:
+    """Apply pending migrations, returning the names of those applied"""
+    db.session.execute(db.text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations "
+        "(version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at DATETIME NOT NULL)"
+    ))
+    db.session.commit()
+    applied_versions = {row[0] for row in db.session.execute(db.text("SELECT version FROM schema_migrations"))}
+    applied = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied_versions:
+            continue
+        print(f"🛠️ Applying migration {version}: {name}")
+        migrate()
+        db.session.execute(
+            db.text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+            {"version": version, "name": name, "applied_at": datetime.now(timezone.utc)}
+        )
+        db.session.commit()
+        applied.append(name)
+    return applied
+
 @app.cli.command("init-db")
 def init_db_command():
-    """Clear existing data and create new tables."""
-    db.create_all()
+    """Create new tables and apply pending migrations."""
+    migrate_database()
     print("✅ Initialized the database.")
 
+@app.cli.command("migrate-db")
+def migrate_db_command():
+    """Upgrade an existing database in place."""
+    applied = migrate_database()
+    print(f"✅ Applied {len(applied)} migrations." if applied else "✅ Database is up to date.")
+
+@app.cli.command("ingest-emails")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["auto", "jsonl", "mbox", "postmark"]), default="auto",
+              help="Input format; auto picks by extension (.jsonl/.ndjson, .mbox, else Postmark JSON).")
+@click.option("--chunk-size", default=INGEST_CHUNK_SIZE, show_default=True, help="Emails per transaction.")
+@click.option("--rate", default=INGEST_RATE_PER_MINUTE, show_default=True,
+              help="Processing jobs released per minute, 0 for no limit.")
+@click.option("--checkpoint", type=click.Path(dir_okay=False), help="Progress file, default PATH.checkpoint.")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint and read from the start.")
+def ingest_emails_command(path, fmt, chunk_size, rate, checkpoint, restart):
+    """Ingest a JSONL, mbox or Postmark export file, resuming after an interruption."""
+    migrate_database()
+    checkpoint = checkpoint or f"{path}.checkpoint"
+    done = 0
+    if not restart and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            done = json.load(f).get("records", 0)
+        print(f"⏩ Resuming after {done} records")
+    started = time.monotonic()
+
+    def report(totals):
+        records = done + totals["records"]
+        tmp_path = f"{checkpoint}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"path": os.path.abspath(path), "records": records}, f)
+        os.replace(tmp_path, checkpoint)
+        elapsed = time.monotonic() - started
+        print(f"📥 {records} records read, {totals['inserted']} inserted, {totals['duplicates']} duplicates, "
+              f"{totals['invalid']} invalid ({totals['records'] / elapsed:.0f}/s)")
+
+    totals = ingest_emails(read_ingest_records(path, fmt, skip=done), chunk_size, rate, on_chunk=report)
+    last_release = db.session.query(db.func.max(ProcessingJob.available_at)).filter(
+        ProcessingJob.status == 'queued'
+    ).scalar()
+    print(f"✅ Ingested {totals['inserted']} emails from {path}.")
+    if totals["inserted"]:
+        print("👷 Their jobs are processed by the web server's workers, or by `flask run-workers`.")
+    if totals["inserted"] and last_release and rate > 0:
+        print(f"⏳ Processing jobs are released until {last_release.isoformat()} UTC.")
+
+@app.cli.command("reconcile-stats")
+def reconcile_stats_command():
+    """Recompute the dashboard counters from the email and task tables."""
+    db.create_all()
+    counters = stats_reconciler.reconcile()
+    print(f"✅ Stats reconciled: {counters.total_emails} emails, {counters.total_tasks} tasks.")
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Rebuild the full-text search index from processed emails."""
+    db.create_all()
+    rebuild_search_index()
+    print("✅ Search index rebuilt.")
+
+@app.cli.command("backfill-email-tags")
+def backfill_email_tags_command():
+    """Rebuild the email_tag table from processed emails."""
+    db.create_all()
+    backfill_email_tags()
+    print("✅ Email tags backfilled.")
+
+@app.cli.command("run-workers")
+def run_workers_command():
+    """Process queued emails until interrupted, without serving HTTP."""
+    migrate_database()
+    job_queue.start()
+    stats_reconciler.start()
+    print("👷 Processing queued emails. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print("👋 Workers stopped. Jobs they were running are handed out again when their leases expire.")
+
+@app.cli.command("prune-attachments")
+def prune_attachments_command():
+    """Delete stored attachment blobs no email references any more."""
+    referenced = set(db.session.scalars(db.select(Attachment.sha256).distinct()))
+    removed = blob_store.prune(referenced)
+    print(f"✅ Removed {removed} unreferenced attachment files.")
+
+startup.imported()
 
 if __name__ == '__main__':
     
     print("🚀 MinimalizEmail backend starting...")
     print("📧 Postmark webhook endpoint: http://localhost:5000/inbound")
     print("🌐 API base URL: http://localhost:5000/api")
+
+    # The debug reloader also imports the app in a watcher process; only the serving
+    # child runs the workers, which start now rather than on the first request.
+    if EMAIL_WORKERS_IN_WEB and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        job_queue.start()
     
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
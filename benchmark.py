@@ -0,0 +1,656 @@
+"""Offline end-to-end benchmark for MinimalizEmail.
+
+Runs the real Flask app and LangGraph pipelines against deterministic fake Gemini
+models and local stub servers for JIRA, Telegram and Google Calendar, drives
+synthetic Postmark traffic at a fixed rate, and reports throughput plus
+p50/p95/p99 latencies per graph node, per LLM call and per API endpoint, plus the
+cold start (import, first request and warm-up) of fresh app processes.
+
+    python benchmark.py --emails 200 --rate 20 --mailbox 5000 --llm-latency-ms 400
+
+Results are written to benchmark_results/ and compared with the previous run.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import pickle
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar, Dict, List, Optional
+
+import httpx
+import xxhash
+from google.api_core.exceptions import ResourceExhausted
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Synthetic mail: each scenario has the words the fake model keys its answers on.
+SCENARIOS = {
+    "incident": ("URGENT: production outage on {service}", "There is an outage: the {service} service is down since {time}. Customers see errors on login. This bug blocks checkout, please investigate."),
+    "meeting": ("Meeting request: {topic} review", "Can we schedule a meeting tomorrow at 3pm to review {topic}? Please send an invite to the team."),
+    "invoice": ("Invoice {number} due Friday", "Please find invoice {number} attached. Payment is due by Friday, please review and approve."),
+    "newsletter": ("Weekly digest: {topic}", "Here is your weekly newsletter about {topic}. Unsubscribe at any time."),
+    "spam": ("You are a winner!", "Congratulations winner, claim your prize of ${number} now by clicking this link."),
+}
+SCENARIO_WEIGHTS = {"incident": 2, "meeting": 2, "invoice": 2, "newsletter": 3, "spam": 1}
+FILLER = ("project roadmap customer deploy latency budget quarter report database migration "
+          "launch campaign feedback release notes onboarding security audit dashboard").split()
+SCENARIO_TAGS = {"outage": "urgent", "invoice": "high_priority", "newsletter": "low_priority", "winner": "spam"}
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+
+    return {"count": len(ordered), "p50": rank(50), "p95": rank(95), "p99": rank(99), "max": round(ordered[-1], 2)}
+
+class LatencyRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[float]] = defaultdict(list)
+
+    def record(self, name: str, milliseconds: float):
+        with self._lock:
+            self._samples[name].append(milliseconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: percentiles(samples) for name, samples in sorted(self._samples.items())}
+
+# ---------------------------------------------------------------------------
+# Fake Gemini
+# ---------------------------------------------------------------------------
+
+def classify_text(text: str) -> str:
+    lowered = text.lower()
+    for word, tag in SCENARIO_TAGS.items():
+        if word in lowered:
+            return tag
+    return "other"
+
+class FakeGeminiModel(BaseChatModel):
+    """Deterministic stand-in for ChatGoogleGenerativeAI.
+
+    Answers are derived from keywords in the prompt, latency is latency_ms plus a
+    jitter seeded by the prompt (so reruns see the same latencies), and usage
+    metadata reports about one input token per four characters. With quota_rpm set,
+    calls beyond that many in the last minute are rejected with a 429 like Gemini's.
+    """
+    latency_ms: float = 300.0
+    jitter_ms: float = 100.0
+    output_tokens: int = 60
+    quota_rpm: int = 0
+    calls: ClassVar[deque] = deque()
+    quota_lock: ClassVar[threading.Lock] = threading.Lock()
+    rejected: ClassVar[int] = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        from langchain_core.utils.function_calling import convert_to_openai_tool
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], tool_choice=tool_choice, **kwargs)
+
+    def with_structured_output(self, schema, **kwargs):
+        from langchain_core.output_parsers.openai_tools import PydanticToolsParser
+        return self.bind_tools([schema], tool_choice=schema.__name__) | PydanticToolsParser(tools=[schema], first_tool_only=True)
+
+    def _delay(self, text: str) -> float:
+        rng = random.Random(xxhash.xxh3_64_intdigest(text))
+        return max(0.0, self.latency_ms + rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def _check_quota(self):
+        if not self.quota_rpm:
+            return
+        now = time.monotonic()
+        with self.quota_lock:
+            while self.calls and self.calls[0] <= now - 60:
+                self.calls.popleft()
+            if len(self.calls) >= self.quota_rpm:
+                FakeGeminiModel.rejected += 1
+                raise ResourceExhausted(f"Quota exceeded: {self.quota_rpm} requests per minute")
+            self.calls.append(now)
+
+    def _answer(self, text: str, tools: Optional[list], tool_choice: Optional[str]) -> AIMessage:
+        lowered = text.lower()
+        if tool_choice == "EmailAnalysis":
+            tag = classify_text(text)
+            args = {
+                "tag": tag, "summary": "Synthetic summary.", "reply": "Thanks, we are on it.",
+                "tasks": [{"title": "Follow up", "description": "", "priority": "high" if tag == "urgent" else "normal"}],
+                "alert_message": "Production outage" if tag == "urgent" else "",
+                "mentions_meeting": "meeting" in lowered, "mentions_issue": "bug" in lowered,
+            }
+            return AIMessage(content="", tool_calls=[{"name": "EmailAnalysis", "args": args, "id": uuid.uuid4().hex}])
+        if tools:
+            if "email:" not in lowered:
+                return AIMessage(content="Done.")
+            lowered = lowered.split("email:", 1)[1]
+            calls = []
+            if "bug" in lowered:
+                calls.append({"name": "create_jira_ticket", "args": {"issue": "Production outage"}, "id": uuid.uuid4().hex})
+            if "meeting" in lowered:
+                calls.append({"name": "create_calendar_event", "id": uuid.uuid4().hex, "args": {
+                    "meeting": "Review", "time_description": "tomorrow at 3pm", "attendees": ["team@example.com"]}})
+            return AIMessage(content="" if calls else "No action needed.", tool_calls=calls)
+        if "classify these emails" in lowered:
+            sections = re.split(r"Email ID: (\d+)\n", text)[1:]
+            return AIMessage(content=json.dumps({sections[i]: classify_text(sections[i + 1]) for i in range(0, len(sections), 2)}))
+        if "classify this email" in lowered:
+            return AIMessage(content=classify_text(text.split("Classify this email", 1)[1]))
+        if "task extraction" in lowered:
+            # The same task as the fused analysis gives, so both modes store the same
+            priority = "high" if classify_text(text) == "urgent" else "normal"
+            return AIMessage(content=json.dumps([{"title": "Follow up", "description": "", "priority": priority, "due_date": None}]))
+        if "summary" in lowered:
+            return AIMessage(content="Synthetic summary of the email.")
+        if "alert" in lowered:
+            return AIMessage(content="Production outage reported")
+        return AIMessage(content="Thanks for your email, we will get back to you shortly.")
+
+    def _result(self, messages, tools, tool_choice) -> ChatResult:
+        text = "\n".join(m.content if isinstance(m.content, str) else str(m.content) for m in messages)
+        message = self._answer(text, tools, tool_choice)
+        input_tokens = len(text) // 4
+        message.response_metadata = {"model_name": "fake-gemini"}
+        message.usage_metadata = {"input_tokens": input_tokens, "output_tokens": self.output_tokens,
+                                  "total_tokens": input_tokens + self.output_tokens}
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, tools=None, tool_choice=None, **kwargs):
+        self._check_quota()
+        time.sleep(self._delay(str(messages)))
+        return self._result(messages, tools, tool_choice)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, tools=None, tool_choice=None, **kwargs):
+        self._check_quota()
+        await asyncio.sleep(self._delay(str(messages)))
+        return self._result(messages, tools, tool_choice)
+
+class NodeTimer(BaseCallbackHandler):
+    """Times each LangGraph node run and each chat model call."""
+
+    def __init__(self, recorder: LatencyRecorder):
+        self.recorder = recorder
+        self._started: Dict[uuid.UUID, tuple] = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # The node's own run carries the graph:step tag, runnables inside it do not
+        if node and kwargs.get("name") == node and any(tag.startswith("graph:step:") for tag in kwargs.get("tags") or []):
+            self._started[run_id] = (f"node:{node}", time.perf_counter())
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = ("llm", time.perf_counter())
+
+    def _finish(self, run_id):
+        started = self._started.pop(run_id, None)
+        if started:
+            self.recorder.record(started[0], (time.perf_counter() - started[1]) * 1000)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+# ---------------------------------------------------------------------------
+# Stub JIRA / Telegram / Calendar
+# ---------------------------------------------------------------------------
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    counts = defaultdict(int)
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, name: str) -> int:
+        with self.lock:
+            self.counts[name] += 1
+            return self.counts[name]
+
+    def _send(self, status: int, body, content_type: str = "application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path.startswith("/rest/api/3/search"):
+            self._count("jira_search")
+            return self._send(200, {"issues": [], "total": 0})
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._body()
+        time.sleep(self.latency)
+        if self.path.startswith("/rest/api/3/issue"):
+            number = self._count("jira_issue")
+            return self._send(201, {"id": str(number), "key": f"BENCH-{number}"})
+        if self.path.endswith("/sendMessage"):
+            return self._send(200, {"ok": True, "result": {"message_id": self._count("telegram")}})
+        if self.path.startswith("/batch/calendar/v3"):
+            return self._calendar_batch(body)
+        if "/calendar/v3/calendars/" in self.path:
+            return self._send(200, self._calendar_event(json.loads(body)))
+        self._send(404, {"error": "not found"})
+
+    def _calendar_event(self, event: dict) -> dict:
+        number = self._count("calendar_event")
+        return {**event, "id": f"bench{number}", "htmlLink": f"https://calendar.example/event/{number}",
+                "hangoutLink": f"https://meet.example/bench-{number}"}
+
+    def _calendar_batch(self, body: bytes):
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers["Content-Type"]).group(1)
+        parts = []
+        for part in body.decode().split(f"--{boundary}")[1:-1]:
+            content_id = re.search(r"Content-ID: <([^>]+)>", part).group(1)
+            event = self._calendar_event(json.loads(part[part.index("{"):part.rindex("}") + 1]))
+            payload = json.dumps(event)
+            parts.append(
+                f"--reply\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{payload}\r\n"
+            )
+        self._count("calendar_batch")
+        self._send(200, ("".join(parts) + "--reply--").encode(), 'multipart/mixed; boundary="reply"')
+
+def start_stub_server(latency_ms: float) -> ThreadingHTTPServer:
+    StubHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, name="benchmark-stubs", daemon=True).start()
+    return server
+
+# ---------------------------------------------------------------------------
+# Traffic
+# ---------------------------------------------------------------------------
+
+def synthetic_email(rng: random.Random, index: int, received_at: Optional[datetime] = None) -> Dict:
+    scenario = rng.choices(list(SCENARIO_WEIGHTS), weights=SCENARIO_WEIGHTS.values())[0]
+    subject, body = SCENARIOS[scenario]
+    values = {"service": rng.choice(["billing", "auth", "search", "api"]), "time": f"{rng.randint(0, 23):02d}:00",
+              "topic": rng.choice(FILLER), "number": rng.randint(1000, 99999)}
+    filler = " ".join(rng.choices(FILLER, k=rng.randint(20, 80)))
+    text = f"{body.format(**values)}\n\n{filler}\n\nRef {index}-{rng.getrandbits(32):x}"
+    payload = {
+        "From": f"user{rng.randint(1, 500)}@example.com", "To": "inbox@example.com",
+        "Subject": subject.format(**values), "TextBody": text, "HtmlBody": f"<p>{text}</p>",
+        "Headers": [{"Name": "Message-ID", "Value": f"<bench-{index}@example.com>"}],
+    }
+    if received_at:
+        payload["Date"] = received_at.strftime("%a, %d %b %Y %H:%M:%S +0000")
+    return payload
+
+def seed_mailbox(app, size: int, rng: random.Random):
+    """Insert `size` already-processed emails so list and search endpoints see a realistic table"""
+    if not size:
+        return
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    with app.app.app_context():
+        for offset in range(0, size, 1000):
+            rows = []
+            for index in range(offset, min(size, offset + 1000)):
+                payload = synthetic_email(rng, -index - 1)
+                row = app.postmark_email_fields(payload, now - timedelta(minutes=size - index))
+                row.update(is_processed=True, processed_at=row["received_at"], ai_summary="Synthetic summary.",
+                           tags=[classify_text(payload["TextBody"])], priority="normal")
+                rows.append(row)
+            app.db.session.execute(app.db.insert(app.Email), rows)
+            app.db.session.commit()
+        app.backfill_email_tags()
+        app.rebuild_search_index()
+        app.stats_reconciler.reconcile()
+    print(f"📦 Seeded {size} emails in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+API_PROBES = [
+    ("GET /api/emails", "/api/emails?fields=id,subject,from,received_at,tags,priority,ai_summary"),
+    ("GET /api/emails?filter", "/api/emails?filter=urgent"),
+    ("GET /api/tasks", "/api/tasks"),
+    ("GET /api/stats", "/api/stats"),
+    ("GET /api/tasks/stats", "/api/tasks/stats"),
+    ("GET /api/search", "/api/search?q=outage"),
+]
+
+def probe_api(client: httpx.Client, recorder: LatencyRecorder, rate: float, stop: threading.Event):
+    """Round-robin GETs over the dashboard endpoints while the load runs"""
+    for index in range(sys.maxsize):
+        if stop.wait(1 / rate):
+            return
+        name, path = API_PROBES[index % len(API_PROBES)]
+        started = time.perf_counter()
+        response = client.get(path)
+        recorder.record(name if response.status_code == 200 else f"{name} (error)", (time.perf_counter() - started) * 1000)
+
+def send_inbound(client: httpx.Client, recorder: LatencyRecorder, payload: Dict) -> Optional[int]:
+    started = time.perf_counter()
+    response = client.post("/inbound", json=payload)
+    recorder.record("POST /inbound", (time.perf_counter() - started) * 1000)
+    return response.json().get("email_id") if response.status_code == 200 else None
+
+# ---------------------------------------------------------------------------
+# Run
+# ---------------------------------------------------------------------------
+
+def configure_environment(args, workdir: str, stub_url: str):
+    from google.oauth2.credentials import Credentials
+    token_path = os.path.join(workdir, "token.pkl")
+    with open(token_path, "wb") as token:
+        pickle.dump(Credentials(token="benchmark", expiry=datetime.utcnow() + timedelta(days=1)), token)
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'benchmark.db')}",
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.db"),
+        "PREFERENCES_VERSION_PATH": os.path.join(workdir, "preferences.version"),
+        "GOOGLE_API_KEY": "benchmark",
+        "GOOGLE_TOKEN_PATH": token_path,
+        "CALENDAR_API_BASE": stub_url,
+        "JIRA_BASE_URL": stub_url,
+        "JIRA_EMAIL": "benchmark@example.com",
+        "JIRA_API_TOKEN": "benchmark",
+        "JIRA_PROJECT_KEY": "BENCH",
+        "TELEGRAM_API_BASE": stub_url,
+        "TELEGRAM_BOT_TOKEN": "benchmark",
+        "TELEGRAM_CHAT_ID": "1",
+        "STATS_RECONCILE_SECONDS": "3600",
+    })
+    if args.workers:
+        os.environ["EMAIL_WORKER_CONCURRENCY"] = str(args.workers)
+    if args.worker_mode:
+        os.environ["EMAIL_WORKER_MODE"] = args.worker_mode
+    if args.pipeline_mode:
+        os.environ["PIPELINE_MODE"] = args.pipeline_mode
+    if args.llm_rate_limit_rpm is not None:
+        os.environ["LLM_RATE_LIMIT_RPM"] = str(args.llm_rate_limit_rpm)
+
+# Run in a fresh interpreter: import the app, send the first request, wait for the
+# warm-up and print the app's own startup timings.
+COLD_START_SCRIPT = """
+import json, sys, time
+import app
+client = app.app.test_client()
+client.get("/health")
+deadline = time.monotonic() + 120
+while not client.get("/health").get_json()["ready"] and time.monotonic() < deadline:
+    time.sleep(0.01)
+with open(sys.argv[1], "w") as f:
+    json.dump(client.get("/health").get_json()["startup"], f)
+"""
+
+def measure_cold_start(runs: int) -> Dict[str, Dict[str, float]]:
+    """Startup phases of `runs` fresh processes, in ms. "process" is the wall time of the
+    whole subprocess, interpreter start and exit included."""
+    samples = defaultdict(list)
+    with tempfile.TemporaryDirectory() as directory:
+        timings_path = os.path.join(directory, "startup.json")
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", COLD_START_SCRIPT, timings_path], capture_output=True, check=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+            samples["process"].append((time.perf_counter() - started) * 1000)
+            with open(timings_path) as f:
+                timings = json.load(f)
+            for phase in ("import", "first_request", "to_first_response", "warmup"):
+                if timings.get(f"{phase}_seconds") is not None:
+                    samples[phase].append(timings[f"{phase}_seconds"] * 1000)
+    return {phase: percentiles(values) for phase, values in samples.items()}
+
+def install_fakes(app, args) -> FakeGeminiModel:
+    # Through the app's rate limiter, like the real Gemini models
+    fake = app.rate_limited(FakeGeminiModel)(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms,
+                                             output_tokens=args.output_tokens, quota_rpm=args.llm_quota_rpm)
+    app.vanilla_model = fake
+    app.model = fake.bind_tools(app.tools)
+    app.analysis_model = fake.with_structured_output(app.EmailAnalysis)
+    return fake
+
+def git_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def wait_for_completion(app, email_ids: List[int], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    with app.app.app_context():
+        while time.monotonic() < deadline:
+            pending = app.Email.query.filter(
+                app.Email.id.in_(email_ids),
+                app.Email.is_processed.is_(False),
+                app.Email.processing_error.is_(None)
+            ).count()
+            app.db.session.rollback()
+            if not pending:
+                return True
+            time.sleep(0.2)
+    return False
+
+def end_to_end_latencies(app, email_ids: List[int]) -> tuple[List[float], int, Optional[datetime]]:
+    with app.app.app_context():
+        rows = app.db.session.execute(
+            app.db.select(app.Email.received_at, app.Email.processed_at, app.Email.processing_error)
+            .where(app.Email.id.in_(email_ids))
+        ).all()
+    latencies = [(processed - received).total_seconds() * 1000 for received, processed, error in rows if processed and not error]
+    errors = sum(1 for _, _, error in rows if error)
+    last = max((processed for _, processed, _ in rows if processed), default=None)
+    return latencies, errors, last
+
+def run(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="minimalizemail-bench-")
+    stubs = start_stub_server(args.integration_latency_ms)
+    configure_environment(args, workdir, f"http://127.0.0.1:{stubs.server_port}")
+    import app
+    from werkzeug.serving import make_server
+
+    install_fakes(app, args)
+    recorder = LatencyRecorder()
+    app.PIPELINE_CALLBACKS.append(NodeTimer(recorder))
+    with app.app.app_context():
+        app.migrate_database()
+    # Before seeding, so the fresh processes find no work to pick up
+    cold_start = measure_cold_start(args.cold_starts)
+    rng = random.Random(args.seed)
+    seed_mailbox(app, args.mailbox, rng)
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="benchmark-http", daemon=True).start()
+    client = httpx.Client(base_url=f"http://127.0.0.1:{server.server_port}", timeout=60,
+                          limits=httpx.Limits(max_connections=64))
+    client.get("/health")  # starts the job queue and the warm-up
+    while not client.get("/health").json()["ready"]:
+        time.sleep(0.05)
+
+    stop = threading.Event()
+    prober = threading.Thread(target=probe_api, args=(client, recorder, args.api_rate, stop), daemon=True)
+    if args.api_rate > 0:
+        prober.start()
+    payloads = [synthetic_email(rng, index) for index in range(args.emails)]
+    print(f"🏁 Sending {args.emails} emails at {args.rate}/s "
+          f"(LLM {args.llm_latency_ms:.0f}±{args.llm_jitter_ms:.0f}ms, integrations {args.integration_latency_ms:.0f}ms)",
+          file=sys.stderr)
+    started_at = datetime.now(timezone.utc)
+    started = time.monotonic()
+    futures = []
+    with ThreadPoolExecutor(max_workers=16) as senders:
+        for index, payload in enumerate(payloads):
+            delay = started + index / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(senders.submit(send_inbound, client, recorder, payload))
+    email_ids = [future.result() for future in futures if future.result()]
+    completed = wait_for_completion(app, email_ids, args.timeout)
+    elapsed = time.monotonic() - started
+    stop.set()
+
+    latencies, errors, last_processed = end_to_end_latencies(app, email_ids)
+    if last_processed:
+        elapsed = (last_processed.replace(tzinfo=timezone.utc) - started_at).total_seconds()
+    with app.app.app_context():
+        queue = app.job_queue.stats()
+    limiter = app.llm_limiter.stats()
+    summary = recorder.summary()
+    return {
+        "version": git_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output_dir", "baseline", "verbose")},
+        "settings": {
+            "worker_mode": app.EMAIL_WORKER_MODE, "workers": app.EMAIL_WORKER_CONCURRENCY,
+            "pipeline_mode": app.PIPELINE_MODE, "llm_cache": app.LLM_CACHE_ENABLED,
+            "duplicate_detection": app.DUPLICATE_DETECTION_ENABLED,
+            "llm_rate_limit_rpm": app.LLM_RATE_LIMIT_RPM, "llm_max_concurrency": app.LLM_MAX_CONCURRENCY,
+        },
+        "completed": completed,
+        "throughput": {
+            "emails": len(email_ids), "processed": len(latencies), "errors": errors,
+            "elapsed_seconds": round(elapsed, 2),
+            "emails_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        },
+        "end_to_end_ms": percentiles(latencies),
+        "cold_start_ms": cold_start,
+        "nodes": {name[len("node:"):]: stats for name, stats in summary.items() if name.startswith("node:")},
+        "llm_ms": summary.get("llm", {"count": 0}),
+        "endpoints": {name: stats for name, stats in summary.items() if name.startswith(("GET", "POST"))},
+        "pipeline": app.pipeline_stats.snapshot(),
+        "integrations": dict(StubHandler.counts),
+        "queue": {key: queue[key] for key in ("jobs_completed", "jobs_failed", "average_utilization")},
+        "llm_limiter": {key: limiter[key] for key in ("concurrency_limit", "decreases", "throttled", "retried", "admitted")},
+        "llm_quota_rejections": FakeGeminiModel.rejected,
+    }
+
+# ---------------------------------------------------------------------------
+# Reporting
+# ---------------------------------------------------------------------------
+
+def latest_result(directory: str) -> Optional[str]:
+    if not os.path.isdir(directory):
+        return None
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    return os.path.join(directory, files[-1]) if files else None
+
+def headline_metrics(result: Dict) -> Dict[str, float]:
+    metrics = {"emails/sec": result["throughput"]["emails_per_second"]}
+    for percentile in ("p50", "p95", "p99"):
+        metrics[f"end-to-end {percentile} ms"] = result["end_to_end_ms"].get(percentile)
+    for group in ("nodes", "endpoints"):
+        for name, stats in result[group].items():
+            metrics[f"{name} p95 ms"] = stats.get("p95")
+    for phase, stats in result.get("cold_start_ms", {}).items():
+        metrics[f"cold start {phase} p50 ms"] = stats.get("p50")
+    return metrics
+
+def print_report(result: Dict, baseline: Optional[Dict]):
+    throughput = result["throughput"]
+    print(f"\n📊 {throughput['processed']}/{throughput['emails']} emails in {throughput['elapsed_seconds']}s "
+          f"= {throughput['emails_per_second']} emails/sec ({throughput['errors']} errors)")
+
+    def table(title: str, rows: Dict[str, Dict]):
+        print(f"\n{title:<28}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for name, stats in rows.items():
+            print(f"{name:<28}{stats.get('count', 0):>7}" + "".join(f"{stats.get(key, '-'):>10}" for key in ("p50", "p95", "p99", "max")))
+
+    table("End to end (ms)", {"email": result["end_to_end_ms"]})
+    table("Graph node (ms)", result["nodes"])
+    table("LLM call (ms)", {"llm": result["llm_ms"]})
+    table("Endpoint (ms)", result["endpoints"])
+    if result["cold_start_ms"]:
+        table("Cold start (ms)", result["cold_start_ms"])
+    limiter = result.get("llm_limiter")
+    if limiter:
+        print(f"\n🚦 LLM limiter: {limiter['throttled']} calls throttled ({result['llm_quota_rejections']} by the fake quota), "
+              f"{limiter['retried']} retried, {limiter['decreases']} concurrency decreases, limit now {limiter['concurrency_limit']}")
+    if not baseline:
+        return
+    print(f"\n🔍 Compared with {baseline['version']} ({baseline['timestamp']})")
+    changed = sorted(key for key in {**result["config"], **result["settings"]}
+                     if {**baseline["config"], **baseline["settings"]}.get(key) != {**result["config"], **result["settings"]}[key])
+    if changed:
+        print(f"⚠️ Settings differ from the baseline: {', '.join(changed)}")
+    previous = headline_metrics(baseline)
+    for name, value in headline_metrics(result).items():
+        before = previous.get(name)
+        if value is None or not before:
+            continue
+        change = (value - before) / before * 100
+        worse = change < 0 if name == "emails/sec" else change > 0
+        flag = "⚠️" if worse and abs(change) >= 10 else "  "
+        print(f"{flag} {name:<40}{before:>10} → {value:<10}({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--emails", type=int, default=100, help="Inbound emails to send")
+    parser.add_argument("--rate", type=float, default=10, help="Inbound emails per second")
+    parser.add_argument("--mailbox", type=int, default=1000, help="Processed emails to seed before the run")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--output-tokens", type=int, default=60, help="Output tokens reported per LLM call")
+    parser.add_argument("--llm-quota-rpm", type=int, default=0, help="Reject LLM calls beyond this many per minute with a 429")
+    parser.add_argument("--llm-rate-limit-rpm", type=int, help="LLM_RATE_LIMIT_RPM for this run")
+    parser.add_argument("--integration-latency-ms", type=float, default=50, help="JIRA/Telegram/Calendar stub latency")
+    parser.add_argument("--api-rate", type=float, default=5, help="Dashboard API requests per second during the run")
+    parser.add_argument("--workers", type=int, help="EMAIL_WORKER_CONCURRENCY for this run")
+    parser.add_argument("--worker-mode", choices=["thread", "asyncio"], help="EMAIL_WORKER_MODE for this run")
+    parser.add_argument("--pipeline-mode", choices=["graph", "fused"], help="PIPELINE_MODE for this run")
+    parser.add_argument("--cold-starts", type=int, default=3,
+                        help="Fresh processes to time import, first request and warm-up (0 to skip)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for processing to finish")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own output")
+    parser.add_argument("--output-dir", default="benchmark_results")
+    parser.add_argument("--baseline", help="Result file to compare with (default: the latest in --output-dir)")
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or latest_result(args.output_dir)
+    if args.verbose:
+        result = run(args)
+    else:
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run(args)
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{result['version']}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\n💾 Saved {path}")
+    sys.exit(0 if result["completed"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,26 @@ const API_BASE_URL = 'http://localhost:5000/api';
 let currentEmails = [];
 let currentFilter = 'all';
 let userPreferences = null;
+let emailNextCursor = null;
+let loadingMoreEmails = false;
+let emailListGeneration = 0; // Bumped whenever the list is reloaded from the first page
+
+// Load the next page when the user scrolls within this many pixels of the bottom
+const SCROLL_LOAD_THRESHOLD = 300;
+// Fields shown on email cards; the full email is fetched when a card is opened
+const EMAIL_CARD_FIELDS = 'id,from,subject,received_at,ai_summary,tags';
 
 // API Functions
-async function fetchEmails(filter = 'all') {
+async function fetchEmails(filter = 'all', cursor = null) {
     try {
-        const response = await fetch(`${API_BASE_URL}/emails?filter=${filter}`);
+        // An empty cursor asks for the first page as a page object rather than a bare list
+        const cursorParam = `&cursor=${encodeURIComponent(cursor || '')}`;
+        const response = await fetch(`${API_BASE_URL}/emails?filter=${filter}&fields=${EMAIL_CARD_FIELDS}${cursorParam}`);
         if (!response.ok) throw new Error('Failed to fetch emails');
         return await response.json();
     } catch (error) {
         console.error('Error fetching emails:', error);
-        return [];
+        return { emails: [], next_cursor: null, prev_cursor: null };
     }
 }
 
@@ -251,9 +261,12 @@ async function loadEmails(filter) {
     showLoading(gridId);
     
     try {
-        // Fetch emails from backend
-        const emails = await fetchEmails(filter);
+        // Fetch the first page of emails from backend
+        emailListGeneration++;
+        const page = await fetchEmails(filter);
+        const emails = page.emails;
         currentEmails = emails;
+        emailNextCursor = page.next_cursor;
         
         // Generate email cards
         if (emails.length === 0) {
@@ -261,28 +274,52 @@ async function loadEmails(filter) {
             return;
         }
 
-        grid.innerHTML = emails.map(email => {
-            const frontendTags = mapBackendTagsToFrontend(email.tags || []);
-            return `
-                <div class="email-card" onclick="openEmailDetail(${email.id})">
-                    <div class="email-header">
-                        <div class="email-from">${email.from}</div>
-                        <div class="email-date">${formatDate(email.received_at)}</div>
-                    </div>
-                    <div class="email-subject">${email.subject}</div>
-                    <div class="email-summary">${email.ai_summary || 'Processing...'}</div>
-                    <div class="email-tags">
-                        ${frontendTags.map(tag => `<span class="tag ${tag}">${tag.replace('-', ' ')}</span>`).join('')}
-                    </div>
-                </div>
-            `;
-        }).join('');
+        grid.innerHTML = emails.map(renderEmailCard).join('');
     } catch (error) {
         showError(gridId, 'Failed to load emails. Please try again.');
         console.error('Error loading emails:', error);
     }
 }
 
+async function loadMoreEmails() {
+    if (!emailNextCursor || loadingMoreEmails) return;
+    const filter = currentFilter;
+    const generation = emailListGeneration;
+    const grid = document.getElementById(`${filter}-emails-grid`);
+    if (!grid) return;
+
+    loadingMoreEmails = true;
+    try {
+        const page = await fetchEmails(filter, emailNextCursor);
+        // Ignore the page if the list was reloaded while it was loading
+        if (generation !== emailListGeneration) return;
+        currentEmails = currentEmails.concat(page.emails);
+        emailNextCursor = page.next_cursor;
+        grid.insertAdjacentHTML('beforeend', page.emails.map(renderEmailCard).join(''));
+    } catch (error) {
+        console.error('Error loading more emails:', error);
+    } finally {
+        loadingMoreEmails = false;
+    }
+}
+
+function renderEmailCard(email) {
+    const frontendTags = mapBackendTagsToFrontend(email.tags || []);
+    return `
+        <div class="email-card" data-email-id="${email.id}" onclick="openEmailDetail(${email.id})">
+            <div class="email-header">
+                <div class="email-from">${email.from}</div>
+                <div class="email-date">${formatDate(email.received_at)}</div>
+            </div>
+            <div class="email-subject">${email.subject}</div>
+            <div class="email-summary">${email.ai_summary || 'Processing...'}</div>
+            <div class="email-tags">
+                ${frontendTags.map(tag => `<span class="tag ${tag}">${tag.replace('-', ' ')}</span>`).join('')}
+            </div>
+        </div>
+    `;
+}
+
 async function openEmailDetail(emailId) {
     try {
         // Show loading in modal
@@ -422,31 +459,113 @@ async function sendReply() {
     }
 }
 
-// Auto-refresh emails every 30 seconds
-let refreshInterval;
+// Live updates pushed by the server over Server-Sent Events
+let eventSource = null;
 
-// Update auto-refresh to include tasks
-function startAutoRefresh() {
-    refreshInterval = setInterval(() => {
-        if (currentFilter && document.querySelector('.email-section.active')) {
-            loadEmails(currentFilter);
-        } else if (document.getElementById('tasks-section')?.classList.contains('active')) {
-            loadTasks(taskFilter);
-        }
-    }, 30000); // 30 seconds
+const TASK_STAT_ELEMENTS = {
+    pending_tasks: 'pending-tasks-count',
+    completed_tasks: 'completed-tasks-count',
+    high_priority_tasks: 'high-priority-tasks-count'
+};
+
+function startLiveUpdates() {
+    if (eventSource) return;
+    eventSource = new EventSource(`${API_BASE_URL}/events`);
+    eventSource.addEventListener('email_processed', e => applyEmailUpdate(JSON.parse(e.data).email));
+    eventSource.addEventListener('task_changed', e => {
+        const { action, task } = JSON.parse(e.data);
+        applyTaskUpdate(action, task);
+        // Overdue tasks are counted by the server on each read, not sent as deltas
+        if (task.due_date) updateTaskStats();
+    });
+    eventSource.addEventListener('stats_delta', e => applyStatsDelta(JSON.parse(e.data)));
+    // The server dropped events for this tab: reload what is on screen
+    eventSource.addEventListener('reset', () => refreshCurrentView());
+}
+
+function stopLiveUpdates() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
 }
 
+function liveUpdatesConnected() {
+    return eventSource && eventSource.readyState === EventSource.OPEN;
+}
 
-function stopAutoRefresh() {
-    if (refreshInterval) {
-        clearInterval(refreshInterval);
+function refreshCurrentView() {
+    if (document.getElementById('tasks-section')?.classList.contains('active')) {
+        loadTasks(taskFilter);
+    } else if (currentFilter && document.querySelector('.email-section.active')) {
+        loadEmails(currentFilter);
+    }
+}
+
+function emailMatchesFilter(email, filter) {
+    if (filter === 'all') return true;
+    if (filter === 'meeting' && email.calendar_event) return true;
+    if (filter === 'issue' && email.jira_ticket) return true;
+    return mapBackendTagsToFrontend(email.tags || []).includes(filter);
+}
+
+function applyEmailUpdate(email) {
+    const section = document.getElementById(`${currentFilter}-emails`);
+    const grid = document.getElementById(`${currentFilter}-emails-grid`);
+    if (!section?.classList.contains('active') || !grid) return;
+
+    const existing = grid.querySelector(`.email-card[data-email-id="${email.id}"]`);
+    if (!emailMatchesFilter(email, currentFilter)) {
+        existing?.remove();
+        return;
+    }
+    if (existing) {
+        existing.outerHTML = renderEmailCard(email);
+        return;
     }
+    grid.querySelector(':scope > .loading')?.remove();
+    grid.insertAdjacentHTML('afterbegin', renderEmailCard(email));
+    currentEmails.unshift(email);
+}
+
+function taskMatchesFilter(task, filter) {
+    if (filter === 'pending' || filter === 'completed') return task.status === filter;
+    if (filter === 'high-priority') return task.priority === 'high';
+    return true;
+}
+
+function applyTaskUpdate(action, task) {
+    const container = document.getElementById('tasks-container');
+    if (!document.getElementById('tasks-section')?.classList.contains('active') || !container) return;
+
+    const existing = container.querySelector(`.task-item[data-task-id="${task.id}"]`);
+    if (action === 'deleted' || !taskMatchesFilter(task, taskFilter)) {
+        existing?.remove();
+        currentTasks = currentTasks.filter(t => t.id !== task.id);
+        return;
+    }
+    if (existing) {
+        existing.outerHTML = generateTasksHTML([task]);
+        currentTasks = currentTasks.map(t => t.id === task.id ? task : t);
+        return;
+    }
+    container.querySelector(':scope > .loading')?.remove();
+    container.insertAdjacentHTML('afterbegin', generateTasksHTML([task]));
+    currentTasks.unshift(task);
+}
+
+// The dashboard only shows task counters; email counters are read from /api/stats
+function applyStatsDelta(delta) {
+    Object.entries(delta.tasks || {}).forEach(([name, change]) => {
+        const element = document.getElementById(TASK_STAT_ELEMENTS[name]);
+        if (element) element.textContent = (parseInt(element.textContent, 10) || 0) + change;
+    });
 }
 
 document.addEventListener('DOMContentLoaded', function() {
     // Existing initialization
     showHome();
-    startAutoRefresh();
+    startLiveUpdates();
 
     // Task modal event listeners
     const addTaskModal = document.getElementById('addTaskModal');
@@ -481,28 +600,46 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
-// Handle page visibility change to pause/resume auto-refresh
+// Fetch the next page of emails or tasks as the user nears the bottom of the list
+window.addEventListener('scroll', function() {
+    if (window.innerHeight + window.scrollY < document.body.offsetHeight - SCROLL_LOAD_THRESHOLD) {
+        return;
+    }
+    if (document.getElementById('tasks-section')?.classList.contains('active')) {
+        loadMoreTasks();
+    } else if (document.querySelector('.email-section.active')) {
+        loadMoreEmails();
+    }
+});
+
+// Disconnect hidden tabs; on return, reload what is on screen to pick up missed changes
 document.addEventListener('visibilitychange', function() {
     if (document.hidden) {
-        stopAutoRefresh();
+        stopLiveUpdates();
     } else {
-        startAutoRefresh();
+        refreshCurrentView();
+        startLiveUpdates();
     }
 });
 
 // Global task state
 let currentTasks = [];
 let taskFilter = 'all';
+let taskNextCursor = null;
+let loadingMoreTasks = false;
+let taskListGeneration = 0;
 
 // Task API Functions
-async function fetchTasks(status = 'all', priority = 'all') {
+async function fetchTasks(status = 'all', priority = 'all', cursor = null) {
     try {
-        const response = await fetch(`${API_BASE_URL}/tasks?status=${status}&priority=${priority}`);
+        // An empty cursor asks for the first page as a page object rather than a bare list
+        const cursorParam = `&cursor=${encodeURIComponent(cursor || '')}`;
+        const response = await fetch(`${API_BASE_URL}/tasks?status=${status}&priority=${priority}${cursorParam}`);
         if (!response.ok) throw new Error('Failed to fetch tasks');
         return await response.json();
     } catch (error) {
         console.error('Error fetching tasks:', error);
-        return [];
+        return { tasks: [], next_cursor: null, prev_cursor: null };
     }
 }
 
@@ -606,17 +743,14 @@ async function loadTasks(filter = 'all') {
     container.innerHTML = '<div class="loading">Loading tasks...</div>';
     
     try {
-        // Determine status and priority filters
-        let status = 'all';
-        let priority = 'all';
-        
-        if (filter === 'pending') status = 'pending';
-        else if (filter === 'completed') status = 'completed';
-        else if (filter === 'high-priority') priority = 'high';
+        const { status, priority } = taskQuery(filter);
         
-        // Fetch tasks from backend
-        const tasks = await fetchTasks(status, priority);
+        // Fetch the first page of tasks from backend
+        taskListGeneration++;
+        const page = await fetchTasks(status, priority);
+        const tasks = page.tasks;
         currentTasks = tasks;
+        taskNextCursor = page.next_cursor;
         
         // Update task statistics
         await updateTaskStats();
@@ -634,6 +768,39 @@ async function loadTasks(filter = 'all') {
     }
 }
 
+function taskQuery(filter) {
+    // Determine status and priority filters
+    let status = 'all';
+    let priority = 'all';
+    
+    if (filter === 'pending') status = 'pending';
+    else if (filter === 'completed') status = 'completed';
+    else if (filter === 'high-priority') priority = 'high';
+    
+    return { status, priority };
+}
+
+async function loadMoreTasks() {
+    if (!taskNextCursor || loadingMoreTasks) return;
+    const generation = taskListGeneration;
+    const container = document.getElementById('tasks-container');
+    if (!container) return;
+
+    loadingMoreTasks = true;
+    try {
+        const { status, priority } = taskQuery(taskFilter);
+        const page = await fetchTasks(status, priority, taskNextCursor);
+        if (generation !== taskListGeneration) return;
+        currentTasks = currentTasks.concat(page.tasks);
+        taskNextCursor = page.next_cursor;
+        container.insertAdjacentHTML('beforeend', generateTasksHTML(page.tasks));
+    } catch (error) {
+        console.error('Error loading more tasks:', error);
+    } finally {
+        loadingMoreTasks = false;
+    }
+}
+
 function generateTasksHTML(tasks) {
     return tasks.map(task => {
         const isCompleted = task.status === 'completed';
@@ -672,8 +839,8 @@ function generateTasksHTML(tasks) {
 async function toggleTask(taskId) {
     try {
         await toggleTaskStatus(taskId);
-        // Reload current tasks to reflect the change
-        await loadTasks(taskFilter);
+        // The change arrives as a task_changed event; reload only without live updates
+        if (!liveUpdatesConnected()) await loadTasks(taskFilter);
     } catch (error) {
         alert('Failed to update task status');
         console.error('Toggle task error:', error);
@@ -687,7 +854,7 @@ async function removeTask(taskId) {
     
     try {
         await deleteTask(taskId);
-        await loadTasks(taskFilter);
+        if (!liveUpdatesConnected()) await loadTasks(taskFilter);
     } catch (error) {
         alert('Failed to delete task');
         console.error('Delete task error:', error);
@@ -749,7 +916,7 @@ async function saveNewTask() {
         
         await createTask(taskData);
         closeAddTaskModal();
-        await loadTasks(taskFilter);
+        if (!liveUpdatesConnected()) await loadTasks(taskFilter);
         
     } catch (error) {
         alert('Failed to create task');
@@ -0,0 +1,43 @@
+"""The app reads its settings from the environment when it is imported, so they are
+pointed at a temporary directory before the first `import app`."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix="minimalizemail-tests-")
+TEST_ENV = {
+    "DATABASE_URL": f"sqlite:///{os.path.join(WORKDIR, 'test.db')}",
+    "LLM_CACHE_PATH": os.path.join(WORKDIR, "llm_cache.db"),
+    "PREFERENCES_VERSION_PATH": os.path.join(WORKDIR, "preferences.version"),
+    "ATTACHMENT_STORE_PATH": os.path.join(WORKDIR, "attachments"),
+    "GOOGLE_API_KEY": "test",
+    "GOOGLE_TOKEN_PATH": os.path.join(WORKDIR, "token.pkl"),
+    "STARTUP_WARMUP": "false",
+    "STATS_RECONCILE_SECONDS": "3600",
+    "EMAIL_WORKERS_IN_WEB": "false",
+}
+os.environ.update(TEST_ENV)
+
+@pytest.fixture(scope="session")
+def app_module():
+    import app
+    with app.app.app_context():
+        app.migrate_database()
+    return app
+
+@pytest.fixture
+def db_session(app_module):
+    """An app context on a database emptied of emails and jobs"""
+    with app_module.app.app_context():
+        for model in (app_module.ProcessingJob, app_module.SideEffect, app_module.Task, app_module.EmailTag,
+                      app_module.Attachment, app_module.EmailTrace, app_module.Email):
+            model.query.delete()
+        app_module.db.session.execute(app_module.db.text("DELETE FROM email_fts"))
+        app_module.db.session.commit()
+        app_module.stats_reconciler.reconcile()
+        yield app_module.db.session
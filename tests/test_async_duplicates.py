@@ -0,0 +1,47 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+BODY = "ALERT: disk usage on web-01 is at 97% since 10:42, please investigate the storage cluster."
+
+def add_alert(app, received_at, host):
+    email = app.Email(from_address="monitoring@example.com", to_address="ops@example.com",
+                      subject=f"ALERT: disk usage on {host}", body=BODY.replace("web-01", host),
+                      text_body=BODY.replace("web-01", host), received_at=received_at)
+    app.db.session.add(email)
+    app.db.session.flush()
+    return email.id
+
+def test_duplicates_wait_on_the_loop_not_in_the_db_executor(app_module, db_session, monkeypatch):
+    """A storm of near-duplicates must not occupy every database thread while their
+    original still needs one to store its result"""
+    app = app_module
+    monkeypatch.setattr(app, "duplicate_index", app.NearDuplicateIndex(0.9, 60, wait_seconds=10))
+    pipeline_runs = []
+
+    async def fake_pipeline(inputs, mode, trace):
+        pipeline_runs.append(inputs["email_subject"])
+        await asyncio.sleep(0.3)
+        return {"email_tag": ["urgent"], "ai_summary": "Disk almost full", "email_reply": ""}
+    monkeypatch.setattr(app, "arun_pipeline", fake_pipeline)
+
+    start = datetime.now(timezone.utc)
+    ids = [add_alert(app, start + timedelta(milliseconds=index), f"web-{index:02d}") for index in range(10)]
+    db_session.commit()
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=2))
+        original = asyncio.create_task(app.aprocess_email(ids[0]))
+        await asyncio.sleep(0.1)  # the original is registered and in its pipeline
+        await asyncio.gather(original, *(app.aprocess_email(email_id) for email_id in ids[1:]))
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - started < 5
+    assert len(pipeline_runs) == 1
+    db_session.expire_all()
+    emails = [db_session.get(app.Email, email_id) for email_id in ids]
+    assert all(email.is_processed and not email.processing_error for email in emails)
+    assert [email.duplicate_of_id for email in emails[1:]] == [ids[0]] * 9
+    assert db_session.get(app.StatsCounters, 1).urgent_emails == 10
@@ -0,0 +1,43 @@
+import json
+
+import sqlalchemy
+
+from conftest import TEST_ENV
+
+def publish_from_another_process(event_type, data):
+    """Writes to the feed the way `flask run-workers` would, on its own engine"""
+    engine = sqlalchemy.create_engine(TEST_ENV["DATABASE_URL"])
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text("INSERT INTO change_event (type, data) VALUES (:type, :data)"),
+                     {"type": event_type, "data": json.dumps(data)})
+    engine.dispose()
+
+def test_stream_receives_events_of_other_processes_and_resumes(app_module, db_session):
+    app = app_module
+    first = app.event_broker.publish("task_changed", {"id": 1})
+    stream = app.event_broker.stream(first, heartbeat_seconds=60)
+    assert next(stream) == "retry: 3000\n\n"
+
+    publish_from_another_process("email_processed", {"id": 7})
+    chunk = next(stream)
+    stream.close()
+    assert chunk == f'id: {first + 1}\nevent: email_processed\ndata: {{"id": 7}}\n\n'
+
+    resumed = app.event_broker.events_after(first - 1)
+    assert [(event_id, event_type) for event_id, event_type, _ in resumed] == [
+        (first, "task_changed"), (first + 1, "email_processed")]
+
+def test_resuming_from_a_pruned_event_resets_the_client(app_module, db_session):
+    app = app_module
+    first = app.event_broker.publish("task_changed", {"id": 1})
+    latest = app.event_broker.publish("task_changed", {"id": 2})
+    with app.db.engine.begin() as conn:
+        conn.execute(app.db.delete(app.ChangeEvent).where(app.ChangeEvent.id == first))
+    assert app.event_broker.events_after(first - 1) == [(latest, "reset", {})]
+
+def test_event_streams_are_capped(app_module, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(app.event_broker, "max_subscribers", 0)
+    response = app.app.test_client().get("/api/events")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
@@ -0,0 +1,51 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage
+
+class FakeBatchModel:
+    def __init__(self):
+        self.batches = []
+
+    def invoke(self, messages, config=None):
+        count = messages[1].content.count("Email ID:")
+        self.batches.append(count)
+        return AIMessage(content=json.dumps({str(index): "other" for index in range(1, count + 1)}))
+
+def classify_without_preferences(app, monkeypatch):
+    monkeypatch.setattr(app, "build_classification_system_message", lambda instructions="": f"Classify. {instructions}")
+
+def test_lone_email_is_sent_without_waiting_for_the_window(app_module, monkeypatch):
+    app = app_module
+    classify_without_preferences(app, monkeypatch)
+    monkeypatch.setattr(app, "classify_single_email", lambda system_message, body, config=None: "spam")
+    batcher = app.ClassificationBatcher(window_ms=10_000, max_size=10)
+
+    started = time.monotonic()
+    assert batcher.classify("Win a prize") == "spam"
+    assert time.monotonic() - started < 1
+    assert batcher.stats()["single_calls"] == 1
+
+def test_emails_arriving_while_one_is_in_flight_share_a_request(app_module, monkeypatch):
+    app = app_module
+    classify_without_preferences(app, monkeypatch)
+    release = threading.Event()
+
+    def slow_single(system_message, body, config=None):
+        release.wait(5)
+        return "urgent"
+    model = FakeBatchModel()
+    monkeypatch.setattr(app, "classify_single_email", slow_single)
+    monkeypatch.setattr(app, "vanilla_model", model)
+    batcher = app.ClassificationBatcher(window_ms=10_000, max_size=2)
+
+    first = batcher._submit("Server down")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        later = list(pool.map(batcher.classify, ["Newsletter", "Lunch menu"]))
+    release.set()
+
+    assert first.result(timeout=5) == "urgent"
+    assert later == ["other", "other"]
+    assert model.batches == [2]
@@ -0,0 +1,22 @@
+import pytest
+from google.api_core.exceptions import ResourceExhausted
+from langchain_google_genai import chat_models
+
+def test_throttled_calls_are_not_retried_by_the_library(app_module, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(chat_models, "_create_retry_decorator", chat_models._create_retry_decorator)
+    app.install_gemini_retry()
+    calls = []
+
+    def generate(**kwargs):
+        calls.append(kwargs)
+        raise ResourceExhausted("quota")
+    with pytest.raises(ResourceExhausted):
+        chat_models._chat_with_retry(generation_method=generate)
+    assert len(calls) == 1
+
+def test_a_changed_retry_decorator_fails_at_model_construction(app_module, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(chat_models, "_create_retry_decorator", lambda max_retries=6: None)
+    with pytest.raises(RuntimeError, match="_create_retry_decorator changed"):
+        app.install_gemini_retry()
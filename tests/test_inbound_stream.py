@@ -0,0 +1,90 @@
+import base64
+import hashlib
+import io
+import json
+import os
+
+import pytest
+
+class ChunkedStream:
+    """A request stream returning at most `size` bytes per read"""
+
+    def __init__(self, data, size):
+        self.data = io.BytesIO(data)
+        self.size = size
+
+    def read(self, count=-1):
+        return self.data.read(min(count, self.size) if count >= 0 else self.size)
+
+DOCUMENTS = [
+    '{"a": "tab\\there \\"quoted\\" back\\\\slash \\/ \\u00e9t\\u00E9"}',
+    '{"emoji": "\\ud83d\\ude00 and 😀", "text": "café 日本"}',
+    '[0, -1, 3.25, -0.5e-3, 6.02E+23, 123456789012345678901234567890123456789, true, false, null]',
+    '{"nested": {"list": [{"x": []}, {}, [[""]]]}, "empty": ""}',
+    ' \r\n\t{ "spaced" :\n[ 1 ,\t2 ] }\n',
+]
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64 * 1024])
+def test_parser_matches_json_loads_across_chunk_boundaries(app_module, document, size):
+    stream = ChunkedStream(document.encode(), size)
+    assert app_module.StreamingJsonParser(stream).parse() == json.loads(document)
+
+@pytest.mark.parametrize("document", [
+    '{"a": 1', '{"a": "unterminated', '{"a" 1}', '{"a": 1,}', '[1 2]', '{"a": tru}',
+    '{"a": "\\x41"}', '{"a": "\\u12"}', '{"a": "line\nbreak"}', '{"a": 01}', '{"a": 1} 2', '',
+])
+@pytest.mark.parametrize("size", [1, 4, 64 * 1024])
+def test_parser_rejects_malformed_and_truncated_json(app_module, document, size):
+    with pytest.raises(ValueError):
+        json.loads(document)
+    with pytest.raises(ValueError):
+        app_module.StreamingJsonParser(ChunkedStream(document.encode(), size)).parse()
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 64 * 1024])
+def test_base64_decoder_handles_split_quads_and_json_escapes(app_module, size):
+    content = bytes(range(256)) * 3 + b"?>?"
+    encoded = base64.encodebytes(content).replace(b"/", b"\\/").replace(b"\n", b"\\r\\n")
+    out = io.BytesIO()
+    decoder = app_module.Base64StreamDecoder(out)
+    for start in range(0, len(encoded), size):
+        decoder.write(encoded[start:start + size])
+    decoder.close()
+    assert out.getvalue() == content
+
+@pytest.mark.parametrize("encoded", [b"QUJD*", b"QUJDR"])
+def test_base64_decoder_rejects_invalid_content(app_module, encoded):
+    decoder = app_module.Base64StreamDecoder(io.BytesIO())
+    with pytest.raises(ValueError):
+        decoder.write(encoded)
+        decoder.close()
+
+def incoming_files(app):
+    root = app.blob_store.root
+    return [name for _, _, names in os.walk(root) for name in names if name.startswith(app.blob_store.INCOMING_PREFIX)]
+
+@pytest.mark.parametrize("size", [1, 3, 64 * 1024])
+def test_inbound_attachments_are_stored_while_parsing(app_module, size):
+    app = app_module
+    content = os.urandom(3000)
+    payload = {"Subject": "Invoice €", "Attachments": [
+        {"Name": "a.bin", "Content": base64.b64encode(content).decode()},
+        {"Name": "note.txt", "Content": base64.b64encode(b"hello").decode(), "ContentType": "text/plain"},
+    ]}
+    data, blobs = app.read_inbound_payload(ChunkedStream(json.dumps(payload).replace("/", "\\/").encode(), size))
+
+    assert data["Subject"] == payload["Subject"]
+    assert [item["Content"] for item in data["Attachments"]] == [None, None]
+    assert blobs == {0: (hashlib.sha256(content).hexdigest(), len(content)),
+                     1: (hashlib.sha256(b"hello").hexdigest(), 5)}
+    with open(app.blob_store.path(blobs[0][0]), "rb") as f:
+        assert f.read() == content
+
+@pytest.mark.parametrize("body", [
+    b'{"Attachments": [{"Content": "aGVsbG8', b'{"Attachments": [{"Content": "aGVs*G8="}]}', b'["not", "an", "object"]',
+])
+def test_rejected_inbound_payload_leaves_no_partial_blobs(app_module, body):
+    before = incoming_files(app_module)
+    with pytest.raises(ValueError):
+        app_module.read_inbound_payload(ChunkedStream(body, 4))
+    assert incoming_files(app_module) == before
@@ -0,0 +1,76 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+def add_email(app, subject="Quarterly report"):
+    email = app.Email(from_address="alice@example.com", to_address="inbox@example.com", subject=subject,
+                      body="Please review the attached quarterly report.", text_body="Please review the attached quarterly report.",
+                      received_at=datetime.now(timezone.utc))
+    app.db.session.add(email)
+    app.db.session.flush()
+    return email
+
+def make_queue(app, max_attempts=2):
+    return app.EmailJobQueue(concurrency=1, lease_seconds=60, max_attempts=max_attempts, poll_seconds=0.1,
+                             retry_backoff_seconds=10)
+
+def test_pipeline_failure_is_raised_to_the_worker(app_module, db_session, monkeypatch):
+    app = app_module
+    email = add_email(app)
+    db_session.commit()
+
+    def failing_pipeline(inputs, mode, trace):
+        raise RuntimeError("Gemini unavailable")
+    monkeypatch.setattr(app, "run_pipeline", failing_pipeline)
+    with pytest.raises(RuntimeError, match="Gemini unavailable"):
+        app.process_email_async(email.id)
+    db_session.expire_all()
+    assert not db_session.get(app.Email, email.id).is_processed
+
+def test_failed_job_is_retried_with_backoff_then_given_up(app_module, db_session):
+    app = app_module
+    queue = make_queue(app)
+    email = add_email(app)
+    queue.enqueue(email.id)
+    db_session.commit()
+    last_event_id = app.event_broker.latest_id()
+
+    job_id, email_id, _, _ = queue._next_job("test")
+    queue._job_done(job_id, email_id, time.monotonic(), "Gemini unavailable")
+    db_session.expire_all()
+    job = db_session.get(app.ProcessingJob, job_id)
+    assert job.status == "queued"
+    assert job.last_error == "Gemini unavailable"
+    assert job.available_at.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc) + timedelta(seconds=9)
+    assert queue._next_job("test") is None  # not before the backoff
+
+    job.available_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+    db_session.commit()
+    job_id, email_id, _, _ = queue._next_job("test")
+    queue._job_done(job_id, email_id, time.monotonic(), "Gemini still unavailable")
+
+    db_session.expire_all()
+    assert db_session.get(app.ProcessingJob, job_id).status == "failed"
+    email = db_session.get(app.Email, email_id)
+    assert email.is_processed and email.processing_error == "Gemini still unavailable"
+    assert db_session.get(app.StatsCounters, 1).processed_emails == 1
+    stats = queue.stats()
+    assert (stats["jobs_completed"], stats["jobs_retried"], stats["jobs_failed"]) == (0, 1, 1)
+    assert [event[1] for event in app.event_broker.events_after(last_event_id)] == ["email_processed", "stats_delta"]
+
+def test_expired_lease_past_max_attempts_is_finalised(app_module, db_session):
+    app = app_module
+    queue = make_queue(app, max_attempts=1)
+    email = add_email(app)
+    job = queue.enqueue(email.id)
+    db_session.flush()
+    job.status, job.attempts = "running", 1
+    job.lease_expires_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+    db_session.commit()
+
+    assert queue._next_job("test") is None
+    db_session.expire_all()
+    email = db_session.get(app.Email, email.id)
+    assert email.is_processed and email.processing_error == "Gave up after 1 attempts"
+    assert db_session.get(app.StatsCounters, 1).processed_emails == 1
@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+
+from test_job_queue import add_email, make_queue
+
+def email_state(subject="Weekly newsletter", headers=None):
+    return {"email_subject": subject, "email_from": "news@example.com", "email_to": "inbox@example.com",
+            "email_body": "Hello", "email_headers": headers or {}}
+
+def test_sender_priority_headers_route_to_the_urgent_lane(app_module, db_session):
+    app = app_module
+    assert app.route_email(email_state(headers={"x-priority": "1 (Highest)"}), "live")["llm_lane"] == "urgent"
+    assert app.route_email(email_state(headers={"importance": "High"}), "backfill")["llm_lane"] == "urgent"
+    assert app.route_email(email_state(headers={"x-priority": "3 (Normal)"}), "live")["llm_lane"] == "live"
+
+def test_urgent_rule_routes_to_the_urgent_lane_and_classifies(app_module, db_session):
+    app = app_module
+    rule = app.ClassificationRule(user_id="default_user", field="subject", pattern="outage", tag="urgent")
+    db_session.add(rule)
+    db_session.commit()
+    app.rule_engine.invalidate("default_user")
+    try:
+        inputs = app.route_email(email_state(subject="Database outage"), "backfill")
+        assert inputs["llm_lane"] == "urgent"
+        assert app.classify_email(inputs) == {"email_tag": ["urgent"]}
+    finally:
+        db_session.delete(rule)
+        db_session.commit()
+        app.rule_engine.invalidate("default_user")
+
+def test_nodes_run_in_the_lane_of_their_state(app_module):
+    app = app_module
+    node = app.state_lane(lambda state: app.llm_lane.get())
+    assert node({"llm_lane": "urgent"}) == "urgent"
+    assert node({}) == app.llm_lane.get()
+
+def test_retried_job_keeps_its_lane(app_module, db_session):
+    app = app_module
+    queue = make_queue(app)
+    live, bulk = add_email(app), add_email(app, "Archived report")
+    queue.enqueue_many([live.id])
+    queue.enqueue_many([bulk.id], [datetime.now(timezone.utc)], lane="backfill")
+    db_session.commit()
+    lanes = {}
+    for _ in range(2):
+        job_id, email_id, _, lane = queue._next_job("worker-1")
+        lanes[email_id] = lane
+        queue._retry_or_give_up(job_id, email_id, "Gemini unavailable")
+    db_session.expire_all()
+    job = db_session.scalars(app.db.select(app.ProcessingJob).filter_by(email_id=live.id)).one()
+    assert job.available_at is not None and job.lane == "live"
+    assert lanes == {live.id: "live", bulk.id: "backfill"}
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import ROOT, TEST_ENV
+
+# The schema of the first release, before schema_migrations existed
+BASELINE_SCHEMA = """
+CREATE TABLE email (
+    id INTEGER NOT NULL,
+    from_address VARCHAR(255) NOT NULL,
+    to_address VARCHAR(255) NOT NULL,
+    subject VARCHAR(500) NOT NULL,
+    body TEXT NOT NULL,
+    text_body TEXT,
+    html_body TEXT,
+    received_at DATETIME,
+    processed_at DATETIME,
+    ai_summary TEXT,
+    ai_reply TEXT,
+    tags JSON,
+    priority VARCHAR(50),
+    jira_ticket_id VARCHAR(100),
+    calendar_event_id VARCHAR(200),
+    calendar_event_link VARCHAR(500),
+    meet_link VARCHAR(500),
+    event_start_time DATETIME,
+    event_end_time DATETIME,
+    event_attendees JSON,
+    is_processed BOOLEAN,
+    processing_error TEXT,
+    PRIMARY KEY (id)
+);
+CREATE TABLE user_preferences (
+    id INTEGER NOT NULL,
+    user_id VARCHAR(100) NOT NULL,
+    work_summary TEXT,
+    urgent_criteria TEXT,
+    high_priority_criteria TEXT,
+    created_at DATETIME,
+    updated_at DATETIME,
+    PRIMARY KEY (id),
+    UNIQUE (user_id)
+);
+CREATE TABLE task (
+    id INTEGER NOT NULL,
+    email_id INTEGER,
+    title VARCHAR(500) NOT NULL,
+    description TEXT,
+    priority VARCHAR(50),
+    status VARCHAR(50),
+    due_date DATETIME,
+    created_at DATETIME,
+    completed_at DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(email_id) REFERENCES email (id)
+);
+INSERT INTO email (id, from_address, to_address, subject, body, text_body, received_at, ai_summary,
+                   tags, priority, jira_ticket_id, is_processed)
+VALUES (1, 'ops@example.com', 'inbox@example.com', 'Database outage', 'The primary database is down.',
+        'The primary database is down.', '2024-05-01 09:00:00', 'Outage of the primary database',
+        '["urgent"]', 'urgent', 'OPS-42', 1),
+       (2, 'bob@example.com', 'inbox@example.com', 'Lunch', 'Lunch on Friday?',
+        NULL, '2024-05-01 10:00:00', NULL, NULL, NULL, NULL, 0);
+INSERT INTO task (id, email_id, title, priority, status, created_at)
+VALUES (1, 1, 'Restore the database', 'high', 'pending', '2024-05-01 09:05:00');
+"""
+
+MIGRATE_SCRIPT = """
+import json
+import app
+with app.app.app_context():
+    applied = app.migrate_database()
+    counters = app.stats_reconciler.counters()
+    print(json.dumps({
+        "applied": applied,
+        "migrations": len(app.MIGRATIONS),
+        "stats": {name: getattr(counters, name) for name in
+                  ("total_emails", "processed_emails", "urgent_emails", "tickets_created", "total_tasks")},
+    }))
+"""
+
+def migrate(tmp_path, schema: str):
+    """Create a database from `schema` and migrate it in a fresh process"""
+    db_path = tmp_path / "baseline.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(schema)
+    env = {**os.environ, **TEST_ENV,
+           "DATABASE_URL": f"sqlite:///{db_path}",
+           "LLM_CACHE_PATH": str(tmp_path / "llm_cache.db"),
+           "PREFERENCES_VERSION_PATH": str(tmp_path / "preferences.version"),
+           "ATTACHMENT_STORE_PATH": str(tmp_path / "attachments")}
+    result = subprocess.run([sys.executable, "-c", MIGRATE_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return db_path, env, json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_baseline_database_upgrades_through_every_migration(tmp_path):
+    db_path, env, report = migrate(tmp_path, BASELINE_SCHEMA)
+    assert len(report["applied"]) == report["migrations"]
+    assert report["stats"] == {"total_emails": 2, "processed_emails": 1, "urgent_emails": 1,
+                               "tickets_created": 1, "total_tasks": 1}
+
+    with sqlite3.connect(db_path) as conn:
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_migrations ORDER BY version")]
+        assert versions == list(range(1, report["migrations"] + 1))
+        email_columns = {row[1] for row in conn.execute("PRAGMA table_info(email)")}
+        assert {"headers", "fingerprint", "duplicate_of_id", "message_id", "clean_body"} <= email_columns
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(email)")}
+        assert {"ix_email_processed_received", "ix_email_message_id"} <= indexes
+        assert conn.execute("SELECT tag FROM email_tag WHERE email_id = 1 ORDER BY tag").fetchall() == [
+            ("issue",), ("urgent",)]
+        assert conn.execute("SELECT rowid FROM email_fts WHERE email_fts MATCH 'outage'").fetchall() == [(1,)]
+
+    rerun = subprocess.run([sys.executable, "-c", MIGRATE_SCRIPT], cwd=ROOT, env=env,
+                           capture_output=True, text=True, timeout=120)
+    assert rerun.returncode == 0, rerun.stderr
+    assert json.loads(rerun.stdout.strip().splitlines()[-1])["applied"] == []
+
+def test_queued_jobs_without_a_lane_run_as_live_mail(tmp_path):
+    # A retried job of a release before the lane column: available_at is set by the backoff
+    schema = BASELINE_SCHEMA + """
+    CREATE TABLE processing_job (
+        id INTEGER NOT NULL, email_id INTEGER NOT NULL, status VARCHAR(20), attempts INTEGER,
+        worker_id VARCHAR(100), lease_expires_at DATETIME, available_at DATETIME, created_at DATETIME,
+        started_at DATETIME, finished_at DATETIME, last_error TEXT, PRIMARY KEY (id)
+    );
+    INSERT INTO processing_job (id, email_id, status, attempts, available_at)
+    VALUES (1, 2, 'queued', 1, '2024-05-01 10:05:00');
+    """
+    db_path, _, _ = migrate(tmp_path, schema)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT lane FROM processing_job WHERE id = 1").fetchone() == ("live",)
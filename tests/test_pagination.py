@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+
+from test_job_queue import add_email
+
+def add_processed_emails(app, count, tags_of=lambda index: []):
+    """`count` processed emails received at the same instant, so pages split on ties"""
+    received_at = datetime(2025, 1, 1, 9, 0, tzinfo=timezone.utc)
+    ids = []
+    for index in range(count):
+        email = add_email(app, f"Email {index}")
+        email.received_at, email.is_processed, email.tags = received_at, True, tags_of(index)
+        app.sync_email_tags(email)
+        ids.append(email.id)
+    app.db.session.commit()
+    return ids
+
+def walk(client, url, start_cursor="", direction="next_cursor"):
+    ids, cursor = [], start_cursor
+    while cursor is not None:
+        page = client.get(f"{url}&cursor={cursor}").get_json()
+        ids.append([email["id"] for email in page["emails"]])
+        cursor = page[direction]
+    return ids, page
+
+def test_pages_split_ties_on_received_at_and_walk_back(app_module, db_session):
+    app = app_module
+    ids = add_processed_emails(app, 5)
+    client = app.app.test_client()
+    newest_first = sorted(ids, reverse=True)
+
+    pages, last_page = walk(client, "/api/emails?limit=2&fields=id")
+    assert pages == [newest_first[0:2], newest_first[2:4], newest_first[4:]]
+
+    back, first_page = walk(client, "/api/emails?limit=2&fields=id", last_page["prev_cursor"], "prev_cursor")
+    assert back == [newest_first[2:4], newest_first[0:2]]
+    assert first_page["prev_cursor"] is None
+
+def test_pages_of_a_tag_filter(app_module, db_session):
+    app = app_module
+    ids = add_processed_emails(app, 5, lambda index: ["Meeting"] if index % 2 == 0 else ["newsletter"])
+    meetings = sorted(ids[0::2], reverse=True)
+
+    pages, _ = walk(app.app.test_client(), "/api/emails?filter=meeting&limit=2&fields=id")
+    assert pages == [meetings[0:2], meetings[2:]]
+
+def test_list_shape_without_a_cursor(app_module, db_session):
+    app = app_module
+    ids = add_processed_emails(app, 3)
+    response = app.app.test_client().get("/api/emails?limit=2&fields=id")
+
+    assert [email["id"] for email in response.get_json()] == sorted(ids, reverse=True)[:2]
+    next_url = response.headers["Link"].split(">")[0].lstrip("<")
+    assert [email["id"] for email in app.app.test_client().get(next_url).get_json()["emails"]] == [min(ids)]
+    assert isinstance(app.app.test_client().get("/api/tasks").get_json(), list)
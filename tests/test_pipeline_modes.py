@@ -0,0 +1,52 @@
+import contextvars
+
+import httpx
+import pytest
+
+from benchmark import SCENARIOS, FakeGeminiModel
+from test_job_queue import add_email
+from test_side_effects import FakeJira
+
+@pytest.fixture
+def fake_integrations(app_module, monkeypatch):
+    """The fake Gemini model of benchmark.py, and JIRA, Calendar and Telegram stubs. Both
+    modes see the same email, so near-duplicate reuse is turned off."""
+    app = app_module
+    monkeypatch.setattr(app, "find_near_duplicate", lambda email: None)
+    fake = app.rate_limited(FakeGeminiModel)(latency_ms=0, jitter_ms=0)
+    monkeypatch.setattr(app, "vanilla_model", fake)
+    monkeypatch.setattr(app, "model", fake.bind_tools(app.tools))
+    monkeypatch.setattr(app, "analysis_model", fake.with_structured_output(app.EmailAnalysis))
+    monkeypatch.setattr(app.calendar_client, "insert_event", lambda event: {
+        "id": "evt1", "htmlLink": "https://calendar.example.com/evt1", "start": event["start"], "end": event["end"],
+        "conferenceData": {"entryPoints": [{"uri": "https://meet.example.com/abc"}]}})
+    monkeypatch.setattr(app.telegram_client, "request", lambda method, url, **kwargs: httpx.Response(
+        200, json={"ok": True}, request=httpx.Request(method, f"https://telegram.example.com{url}")))
+
+def stored_result(app, db_session, monkeypatch, mode, subject, body):
+    monkeypatch.setattr(app, "jira_client", FakeJira())
+    monkeypatch.setattr(app, "choose_pipeline_mode", lambda: mode)
+    email = add_email(app, subject)
+    email.body = email.text_body = body
+    db_session.commit()
+    contextvars.copy_context().run(app.process_email_async, email.id)
+    db_session.expire_all()
+    email = db_session.get(app.Email, email.id)
+    return {
+        "tags": email.tags, "priority": email.priority, "jira_ticket_id": email.jira_ticket_id,
+        "calendar_event_id": email.calendar_event_id, "meet_link": email.meet_link,
+        "tasks": [(task.title, task.priority) for task in email.tasks],
+        # The fake words summaries and replies differently per call, so only their presence compares
+        "summary": bool(email.ai_summary), "reply": bool(email.ai_reply),
+    }
+
+@pytest.mark.parametrize("scenario", ["incident", "meeting", "newsletter"])
+def test_graph_and_fused_modes_store_equivalent_results(app_module, db_session, monkeypatch, fake_integrations, scenario):
+    app = app_module
+    subject, body = SCENARIOS[scenario]
+    values = {"service": "billing", "time": "09:00", "topic": "roadmap", "number": 1234}
+    subject, body = subject.format(**values), body.format(**values)
+
+    graph = stored_result(app, db_session, monkeypatch, "graph", subject, body)
+    fused = stored_result(app, db_session, monkeypatch, "fused", subject, body)
+    assert graph == fused
@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+
+from test_job_queue import add_email
+
+def add_indexed_email(app, subject, body, received_at):
+    email = add_email(app, subject)
+    email.body = email.text_body = body
+    email.received_at, email.is_processed = received_at, True
+    app.index_email_for_search(email)
+    return email.id
+
+def search(app, query):
+    return app.app.test_client().get(f"/api/search?fields=id&{query}").get_json()
+
+def test_user_input_cannot_inject_fts_syntax(app_module, db_session):
+    app = app_module
+    assert app.fts_query('outage" OR body:* NEAR(db  repl*') == '"outage""" "OR" "body:"* "NEAR(db" "repl"*'
+    add_indexed_email(app, "Outage", "OR NEAR(db", datetime(2025, 1, 1, 9, 0, tzinfo=timezone.utc))
+    db_session.commit()
+    assert len(search(app, "q=NEAR(db%20OR")["results"]) == 1
+
+def test_ranking_cursor_walks_every_match_once(app_module, db_session):
+    app = app_module
+    received_at = datetime(2025, 1, 1, 9, 0, tzinfo=timezone.utc)
+    strong = add_indexed_email(app, "Database outage", "The database outage continues.", received_at)
+    weak = [add_indexed_email(app, f"Weekly report {index}", "A short database note.", received_at) for index in range(3)]
+    add_indexed_email(app, "Lunch", "Pizza on Friday.", received_at)
+    db_session.commit()
+
+    ranked = [result["id"] for result in search(app, "q=database&limit=10")["results"]]
+    assert ranked[0] == strong and sorted(ranked[1:]) == sorted(weak)
+
+    walked, cursor = [], ""
+    while cursor is not None:
+        page = search(app, f"q=database&limit=1&cursor={cursor}")
+        walked += [result["id"] for result in page["results"]]
+        cursor = page["next_cursor"]
+    assert walked == ranked
+
+def test_date_bounds_compare_in_utc(app_module, db_session):
+    app = app_module
+    morning = add_indexed_email(app, "Outage", "Morning outage", datetime(2025, 1, 1, 9, 0, tzinfo=timezone.utc))
+    evening = add_indexed_email(app, "Outage", "Evening outage", datetime(2025, 1, 1, 18, 0, tzinfo=timezone.utc))
+    db_session.commit()
+
+    def ids(query):
+        return sorted(result["id"] for result in search(app, f"q=outage&{query}")["results"])
+
+    assert ids("since=2025-01-01") == [morning, evening]
+    assert ids("until=2025-01-02") == [morning, evening]
+    # 10:30 at UTC+2 is 08:30 UTC, and 19:30 is 17:30 UTC
+    assert ids("since=2025-01-01T10:30:00%2B02:00") == [morning, evening]
+    assert ids("until=2025-01-01T19:30:00%2B02:00") == [morning]
+    assert ids("since=2025-01-01T09:00:00Z&until=2025-01-01T18:00:00Z") == [morning]
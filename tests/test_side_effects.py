@@ -0,0 +1,79 @@
+import contextvars
+
+import httpx
+import pytest
+
+from test_job_queue import add_email
+
+class FakeJira:
+    """Records JIRA requests and answers label searches from the tickets it created"""
+
+    def __init__(self):
+        self.tickets = {}  # label -> key
+        self.created = []
+
+    def request(self, method, path, recover=None, **kwargs):
+        request = httpx.Request(method, f"https://jira.example.com{path}")
+        if method == "GET":
+            label = kwargs["params"]["jql"].split('"')[1]
+            issues = [{"key": self.tickets[label]}] if label in self.tickets else []
+            return httpx.Response(200, json={"issues": issues}, request=request)
+        key = f"OPS-{len(self.created) + 1}"
+        self.created.append(kwargs["json"]["fields"]["summary"])
+        self.tickets[kwargs["json"]["fields"]["labels"][0]] = key
+        return httpx.Response(201, json={"key": key}, request=request)
+
+def test_retried_email_finds_its_ticket_whatever_the_issue_text(app_module, monkeypatch):
+    app = app_module
+    jira = FakeJira()
+    monkeypatch.setattr(app, "jira_client", jira)
+
+    def run(issue):
+        app.current_email_id.set(42)
+        app.tool_call_counts.set({})
+        return app.create_jira_ticket.invoke({"issue": issue})
+
+    def attempt(issue):
+        return contextvars.copy_context().run(run, issue)
+
+    first = attempt("Database is down")
+    second = attempt("The primary database is unavailable")
+    assert first["ticket_id"] == second["ticket_id"] == "OPS-1"
+    assert jira.created == ["Database is down"]
+
+def test_retried_email_does_not_repeat_its_side_effects(app_module, db_session, monkeypatch):
+    app = app_module
+    email = add_email(app, "Outage review")
+    db_session.commit()
+    inserted, sent = [], []
+
+    def insert_event(event):
+        inserted.append(event)
+        return {"id": "evt1", "htmlLink": "https://calendar.example.com/evt1", "start": event["start"],
+                "end": event["end"], "conferenceData": {"entryPoints": [{"uri": "https://meet.example.com/abc"}]}}
+
+    def post(method, url, **kwargs):
+        sent.append(kwargs["json"]["text"])
+        return httpx.Response(200, json={"ok": True}, request=httpx.Request(method, f"https://telegram.example.com{url}"))
+    monkeypatch.setattr(app.calendar_client, "insert_event", insert_event)
+    monkeypatch.setattr(app.telegram_client, "request", post)
+
+    attempts = []
+
+    def pipeline(inputs, mode, trace):
+        attempts.append(app.create_calendar_event.invoke({"meeting": "Outage review", "time_description": "tomorrow at 5pm"}))
+        app.send_fused_alert({"alert_message": "Database outage"})
+        if len(attempts) == 1:
+            raise RuntimeError("Gemini unavailable")
+        return {"email_tag": ["urgent"], "event_summary": attempts[-1]["event_summary"]}
+    monkeypatch.setattr(app, "run_pipeline", pipeline)
+
+    with pytest.raises(RuntimeError):
+        app.process_email_async(email.id)
+    app.process_email_async(email.id)
+
+    assert len(inserted) == 1 and sent == ["Database outage"]
+    assert attempts[0] == attempts[1]
+    assert inserted[0]["conferenceData"]["createRequest"]["requestId"] == f"minimalizemail-{email.id}-create_calendar_event:1"
+    db_session.expire_all()
+    assert db_session.get(app.Email, email.id).is_processed
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta, timezone
+
+from test_job_queue import add_email
+
+def test_urgent_counter_matches_reconciled_tags(app_module, db_session):
+    app = app_module
+    email = add_email(app, "Server down")
+    before = app.email_stats_counts(email)
+    email.tags = [" Urgent"]
+    email.is_processed = True
+    app.sync_email_tags(email)
+    delta = app.stats_delta(before, app.email_stats_counts(email))
+    app.apply_stats_delta({**delta, "total_emails": 1})
+    db_session.commit()
+
+    assert delta["urgent_emails"] == 1
+    counters = app.stats_reconciler.counters()
+    db_session.refresh(counters)
+    incremental = counters.urgent_emails
+    assert incremental == app.stats_reconciler.reconcile().urgent_emails == 1
+
+def test_overdue_tasks_are_counted_when_read(app_module, db_session):
+    app = app_module
+    now = datetime.now(timezone.utc)
+    db_session.add_all([
+        app.Task(title="Past due", status="pending", priority="high", due_date=now - timedelta(hours=1)),
+        app.Task(title="Due later", status="pending", priority="low", due_date=now + timedelta(days=1)),
+        app.Task(title="Done late", status="completed", priority="low", due_date=now - timedelta(days=1)),
+    ])
+    db_session.commit()
+    app.stats_reconciler.reconcile()
+
+    stats = app.app.test_client().get("/api/tasks/stats").get_json()
+    assert stats["overdue_tasks"] == 1
+    assert stats["pending_tasks"] == 2